@@ -0,0 +1,222 @@
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from models import ActivityRollup, DailyActiveUser, Message, User, get_db
+from message_manager import _dialect_insert
+from sqlalchemy import select, delete, or_, and_
+from sqlalchemy.exc import SQLAlchemyError
+
+def hour_bucket(at):
+    """Truncate a time to the start of its hour"""
+    return at.replace(minute=0, second=0, microsecond=0)
+
+def day_bucket(at):
+    """Truncate a time to the start of its day"""
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+class ActivityRollups:
+    """
+    Incrementally maintained activity counters for operational dashboards.
+    Events are counted in memory per time bucket and flushed in one batch,
+    adding to the activity_rollups rows, so answering "messages per hour"
+    or "active users today" reads a few primary-key rows instead of
+    scanning messages and users. Each worker flushes its own counts, so
+    other workers' activity shows up within one flush interval.
+    """
+
+    # metric -> bucket function
+    METRICS = {
+        'messages': hour_bucket,
+        'registrations': day_bucket,
+        'active_users': day_bucket
+    }
+
+    MAX_HOURS = 24 * 7
+    MAX_DAYS = 90
+
+    # Rows per multi-row INSERT of active users, kept under SQLite's bound parameter limit
+    _ACTIVE_CHUNK = 400
+
+    def __init__(self):
+        """Initialize empty counters"""
+        self._lock = threading.Lock()
+        self._counts = Counter()  # (metric, bucket) -> count not yet flushed
+        self._active = set()  # (day, user_id) not yet flushed
+        self._seen = set()  # (day, user_id) already flushed by this worker
+        self.flushed_at = None
+
+    # Recording
+
+    def _add(self, metric, at, count=1):
+        self._counts[(metric, self.METRICS[metric](at or datetime.utcnow()))] += count
+
+    def record_active(self, user_id, at=None):
+        """Count a user as active on the day of at (default now)"""
+        key = (day_bucket(at or datetime.utcnow()), user_id)
+        with self._lock:
+            if key not in self._seen:
+                self._active.add(key)
+
+    def record_message(self, sender_id, at=None):
+        """Count a stored message, whose sender is active"""
+        with self._lock:
+            self._add('messages', at)
+        self.record_active(sender_id, at)
+
+    def record_registration(self, user_id, at=None):
+        """Count a registered user, who is active"""
+        with self._lock:
+            self._add('registrations', at)
+        self.record_active(user_id, at)
+
+    # Flushing
+
+    def _insert_active(self, db, insert, active):
+        """Insert the users seen per day, returning the number that were not already recorded"""
+        by_day = {}
+        for day, user_id in sorted(active):
+            by_day.setdefault(day, []).append({'day': day, 'user_id': user_id})
+
+        new_users = Counter()
+        for day, rows in by_day.items():
+            for start in range(0, len(rows), self._ACTIVE_CHUNK):
+                result = db.execute(
+                    insert(DailyActiveUser).values(rows[start:start + self._ACTIVE_CHUNK]).on_conflict_do_nothing()
+                )
+                new_users[day] += result.rowcount
+        return new_users
+
+    def flush(self):
+        """
+        Write the pending counts to the rollup tables in one transaction
+        Counts are kept for the next flush if it fails
+        Returns the number of rollup rows updated
+        """
+        with self._lock:
+            counts, active = self._counts, self._active
+            self._counts, self._active = Counter(), set()
+
+        if not counts and not active:
+            self.flushed_at = datetime.utcnow()
+            return 0
+
+        db = get_db()
+        try:
+            insert = _dialect_insert(db)
+
+            for day, new_users in self._insert_active(db, insert, active).items():
+                if new_users:
+                    counts[('active_users', day)] += new_users
+
+            for (metric, bucket), count in counts.items():
+                stmt = insert(ActivityRollup).values(metric=metric, bucket=bucket, count=count)
+                db.execute(stmt.on_conflict_do_update(
+                    index_elements=[ActivityRollup.metric, ActivityRollup.bucket],
+                    set_={'count': ActivityRollup.count + stmt.excluded.count}
+                ))
+
+            # Only today's and yesterday's users are needed to deduplicate late events
+            cutoff = day_bucket(datetime.utcnow()) - timedelta(days=1)
+            db.execute(delete(DailyActiveUser).where(DailyActiveUser.day < cutoff))
+            db.commit()
+
+        except SQLAlchemyError as e:
+            db.rollback()
+            with self._lock:
+                self._counts.update(counts)
+                self._active |= active
+            raise e
+        finally:
+            db.close()
+
+        with self._lock:
+            self._seen = {key for key in self._seen | active if key[0] >= cutoff}
+        self.flushed_at = datetime.utcnow()
+        return len(counts)
+
+    # Reading
+
+    def stats(self, hours=24, days=7):
+        """
+        Messages per hour for the last `hours` hours, and registrations and
+        active users per day for the last `days` days, oldest first
+        Reads at most hours + 2 * days rollup rows
+        """
+        hours = max(1, min(hours, self.MAX_HOURS))
+        days = max(1, min(days, self.MAX_DAYS))
+
+        now = datetime.utcnow()
+        hour_buckets = [hour_bucket(now) - timedelta(hours=i) for i in reversed(range(hours))]
+        day_buckets = [day_bucket(now) - timedelta(days=i) for i in reversed(range(days))]
+
+        db = get_db()
+        try:
+            rows = db.execute(select(ActivityRollup.metric, ActivityRollup.bucket, ActivityRollup.count).where(or_(
+                and_(ActivityRollup.metric == 'messages', ActivityRollup.bucket >= hour_buckets[0]),
+                and_(ActivityRollup.metric.in_(['registrations', 'active_users']), ActivityRollup.bucket >= day_buckets[0])
+            ))).all()
+        finally:
+            db.close()
+
+        counts = {(row.metric, row.bucket): row.count for row in rows}
+
+        def series(metric, buckets, label):
+            return [{label: bucket.isoformat(), 'count': counts.get((metric, bucket), 0)} for bucket in buckets]
+
+        return {
+            'as_of': now.isoformat(),
+            'flushed_at': self.flushed_at.isoformat() if self.flushed_at else None,
+            'messages_per_hour': series('messages', hour_buckets, 'hour'),
+            'registrations_per_day': series('registrations', day_buckets, 'day'),
+            'active_users_per_day': series('active_users', day_buckets, 'day'),
+            'active_users_today': counts.get(('active_users', day_buckets[-1]), 0)
+        }
+
+    # Backfill
+
+    def backfill(self, shards=None):
+        """
+        Build the rollups from existing messages and users if they are empty
+        Users count as active only on their last_active day, the one recorded
+        Returns the number of rollup rows created
+        """
+        db = get_db()
+        try:
+            if db.query(ActivityRollup.metric).first() is not None:
+                return 0
+
+            counts = Counter()
+            recent = []  # users already counted active on a day flushes may still record them for
+            cutoff = day_bucket(datetime.utcnow()) - timedelta(days=1)
+            for user_id, created_at, last_active in db.query(User.id, User.created_at, User.last_active).yield_per(1000):
+                if created_at:
+                    counts[('registrations', day_bucket(created_at))] += 1
+                if last_active:
+                    counts[('active_users', day_bucket(last_active))] += 1
+                    if day_bucket(last_active) >= cutoff:
+                        recent.append({'day': day_bucket(last_active), 'user_id': user_id})
+
+            sessions = [shards.session(name) for name in shards.names] if shards else [db]
+            for message_db in sessions:
+                try:
+                    for (created_at,) in message_db.query(Message.created_at).yield_per(1000):
+                        counts[('messages', hour_bucket(created_at))] += 1
+                finally:
+                    if message_db is not db:
+                        message_db.close()
+
+            db.bulk_insert_mappings(ActivityRollup, [
+                {'metric': metric, 'bucket': bucket, 'count': count}
+                for (metric, bucket), count in counts.items()
+            ])
+            db.bulk_insert_mappings(DailyActiveUser, recent)
+            db.commit()
+
+            return len(counts)
+
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+        finally:
+            db.close()
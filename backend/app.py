@@ -2,18 +2,27 @@ import eventlet
 eventlet.monkey_patch()
 
 
-from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, join_room, leave_room, emit, disconnect
+from flask import Flask, Response, request, jsonify
+from flask_socketio import SocketIO, ConnectionRefusedError, join_room, leave_room, emit, disconnect
 from flask_cors import CORS
 import os
 import json
 from dotenv import load_dotenv
 from user_manager import UserManager
+from message_manager import MessageManager
+from session_store import create_session_store
+from profiler import SamplingProfiler
+from socket_limits import SocketLimits
+from query_log import QueryStats
 from crypto import CryptoManager
-from models import init_db, Message, get_db
+from models import engine, init_db, PARTITION_MESSAGES
+from partitions import maintain_partitions
+from shards import create_shard_map
+from activity import ActivityRollups
 import functools
-import uuid
-from datetime import datetime
+import hashlib
+import hmac
+from datetime import datetime, timezone
 import traceback
 
 # Load environment variables
@@ -39,12 +48,75 @@ socketio = SocketIO(app, cors_allowed_origins=["https://zecret.vercel.app", "htt
 # Initialize database
 init_db()
 
+# Message shards from MESSAGE_SHARDS; unset keeps messages on the main database
+message_shards = create_shard_map()
+if message_shards:
+    message_shards.init_shards()
+
+# Months of messages kept when the messages table is partitioned; unset keeps everything
+MESSAGE_RETENTION_MONTHS = int(os.getenv('MESSAGE_RETENTION_MONTHS', 0)) or None
+
+# How often the monthly message partitions are maintained (seconds)
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv('PARTITION_MAINTENANCE_INTERVAL', 6 * 3600))
+
+if PARTITION_MESSAGES:
+    maintain_partitions(MESSAGE_RETENTION_MONTHS)
+
+# Token for the operational /api/admin endpoints; they are disabled when unset
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Statements slower than this are logged with their query plan (milliseconds)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+
+query_stats = QueryStats(SLOW_QUERY_MS, log=app.logger.warning)
+query_stats.attach(engine)
+if message_shards:
+    for shard_engine in set(message_shards.engines.values()) - {engine}:
+        query_stats.attach(shard_engine)
+
+# How often expired sessions are swept from the session store (seconds)
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', 60))
+
+# How often each worker's activity counts are flushed to the rollup tables (seconds)
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv('ACTIVITY_FLUSH_INTERVAL', 30))
+
+activity = ActivityRollups()
+
 # Initialize user manager
-user_manager = UserManager(app.config['SECRET_KEY'])
+session_store = create_session_store(
+    os.getenv('SESSION_STORE_URL'),
+    max_size=int(os.getenv('SESSION_STORE_MAX_SIZE', 100000))
+)
+user_manager = UserManager(app.config['SECRET_KEY'], session_store=session_store, activity=activity)
+
+# Initialize message manager
+message_manager = MessageManager(shards=message_shards, activity=activity)
 
 # SocketIO session storage
 socket_sessions = {}  # sid -> session_id
 
+# Socket admission and outbound backpressure limits (0 = unlimited)
+socket_limits = SocketLimits(
+    max_connections=int(os.getenv('SOCKET_MAX_CONNECTIONS', 0)),
+    max_per_user=int(os.getenv('SOCKET_MAX_PER_USER', 0)),
+    max_queue=int(os.getenv('SOCKET_MAX_QUEUE', 1000)),
+    slow_consumer=os.getenv('SOCKET_SLOW_CONSUMER', 'disconnect'),
+    redirect_url=os.getenv('SOCKET_REDIRECT_URL')
+)
+socket_limits.install(socketio.server)
+
+# Longest window an /api/admin/profile request may sample (seconds)
+MAX_PROFILE_SECONDS = 60
+
+def profiled_handlers():
+    """Label every REST route and socket event handler, for profile attribution"""
+    handlers = {f"route:{endpoint}": view for endpoint, view in app.view_functions.items()}
+    for event, handler in socketio.server.handlers.get('/', {}).items():
+        handlers[f"event:{event}"] = handler
+    return handlers
+
+profiler = SamplingProfiler(profiled_handlers)
+
 # Utility functions
 def authenticated_only(f):
     @functools.wraps(f)
@@ -55,12 +127,83 @@ def authenticated_only(f):
         return f(*args, **kwargs)
     return wrapped
 
+def admin_only(f):
+    """Restrict a route to requests carrying the ADMIN_TOKEN"""
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({'error': 'Forbidden'}), 403
+        return f(*args, **kwargs)
+    return wrapped
+
+def sweep_sessions():
+    """Background task removing expired sessions from the session store"""
+    while True:
+        socketio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            session_store.sweep()
+        except Exception as e:
+            app.logger.error(f"Session sweep failed: {str(e)}")
+
+socketio.start_background_task(sweep_sessions)
+
+def flush_activity():
+    """Background task writing this worker's activity counts to the rollup tables"""
+    while True:
+        socketio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            activity.flush()
+        except Exception as e:
+            app.logger.error(f"Activity flush failed: {str(e)}")
+
+socketio.start_background_task(flush_activity)
+
+def maintain_message_partitions():
+    """Background task creating upcoming message partitions and dropping expired ones"""
+    while True:
+        socketio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+        try:
+            maintain_partitions(MESSAGE_RETENTION_MONTHS)
+        except Exception as e:
+            app.logger.error(f"Partition maintenance failed: {str(e)}")
+
+if PARTITION_MESSAGES:
+    socketio.start_background_task(maintain_message_partitions)
+
 def get_user_from_socket(sid):
     """Get the user associated with a socket ID"""
     if sid in socket_sessions:
         session_id = socket_sessions[sid]
         return user_manager.get_user_for_session(session_id)
     return None
+
+def add_validators(response, etag, last_modified=None, max_age=0):
+    """Attach cache validators to a response; clients must revalidate unless max_age is set"""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.headers['Cache-Control'] = f'private, max-age={max_age}' if max_age else 'private, no-cache'
+    return response
+
+def not_modified(etag, last_modified=None, max_age=0):
+    """
+    Check the request's conditional headers against the current validators
+    Returns a 304 response if the client's copy is still current, None otherwise
+    """
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = bool(
+            last_modified and request.if_modified_since and
+            last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+        )
+    
+    if not fresh:
+        return None
+    
+    return add_validators(app.response_class(status=304), etag, last_modified, max_age)
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     app.logger.error(f"Unhandled exception: {str(e)}")
@@ -79,12 +222,15 @@ def register():
     """Register a new anonymous user"""
     data = request.json
     display_name = data.get('display_name')
+    suite = data.get('suite') or CryptoManager.LEGACY_SUITE
+    
+    if suite not in CryptoManager.SUITES:
+        return jsonify({'error': 'Unsupported crypto suite'}), 400
     
     try:
-        user = user_manager.register_anonymous_user(display_name)
-        
-        # Create a session for the new user
-        session = user_manager.create_session(user['id'])
+        # Register the user and create its session in a single transaction
+        user = user_manager.register_anonymous_user(display_name, start_session=True, suite=suite)
+        session = user['session']
         
         # Return necessary information to the client
         return jsonify({
@@ -92,7 +238,8 @@ def register():
             'user': {
                 'id': user['id'],
                 'display_name': user['display_name'],
-                'public_key': user['public_key']
+                'public_key': user['public_key'],
+                'suite': user['suite']
             },
             'access_code': user['access_code'],  # This is the "password" they must save
             'private_key': user['private_key'],  # Client must save this for decryption
@@ -112,13 +259,13 @@ def login():
         return jsonify({'error': 'Access code is required'}), 400
     
     try:
-        user = user_manager.login_with_access_code(access_code)
+        # Log in and create a session in a single round-trip
+        session = user_manager.login_and_create_session(access_code)
         
-        if not user:
+        if not session:
             return jsonify({'error': 'Invalid access code'}), 401
         
-        # Create a session
-        session = user_manager.create_session(user['id'])
+        user = session['user']
         
         # Return session information
         return jsonify({
@@ -126,7 +273,8 @@ def login():
             'user': {
                 'id': user['id'],
                 'display_name': user['display_name'],
-                'public_key': user['public_key']
+                'public_key': user['public_key'],
+                'suite': user['suite']
             },
             'token': session['token']
         })
@@ -154,6 +302,33 @@ def get_online_users():
     
     return jsonify({'users': online_users})
 
+@app.route('/api/users/search', methods=['GET'])
+def search_users():
+    """Search the user directory by display name prefix"""
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    payload = user_manager.validate_token(token)
+    
+    if not payload:
+        return jsonify({'error': 'Invalid or expired token'}), 401
+    
+    prefix = request.args.get('q', '')
+    cursor = request.args.get('cursor')
+    include_keys = request.args.get('include_keys', '').lower() in ('1', 'true')
+    
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return jsonify({'error': 'Invalid limit'}), 400
+    
+    try:
+        page = user_manager.search_users(prefix, limit=limit, cursor=cursor, include_keys=include_keys)
+        return jsonify(page)
+    except ValueError as e:
+        # Invalid prefix or cursor
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/api/users/<user_id>/public-key', methods=['GET'])
 def get_public_key(user_id):
     """Get a user's public key"""
@@ -163,12 +338,23 @@ def get_public_key(user_id):
     if not payload:
         return jsonify({'error': 'Invalid or expired token'}), 401
     
+    # Public keys never change, so the user's existence is the only thing to check
+    created_at = user_manager.get_created_at(user_id)
+    
+    if not created_at:
+        return jsonify({'error': 'User not found'}), 404
+    
+    etag = f"key-{user_id}"
+    cached = not_modified(etag, created_at, max_age=3600)
+    if cached:
+        return cached
+    
     public_key = user_manager.get_public_key(user_id)
     
     if not public_key:
         return jsonify({'error': 'User not found'}), 404
     
-    return jsonify({'public_key': public_key})
+    return add_validators(jsonify(public_key), etag, created_at, max_age=3600)
 
 @app.route('/api/users/profile', methods=['PUT'])
 def update_profile():
@@ -202,18 +388,23 @@ def get_user_profile():
     
     # Get the user info from the token
     user_id = payload.get('user_id')
-    user = user_manager.get_user_by_id(user_id)
+    user = user_manager.get_profile(user_id)
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
+    etag = hashlib.sha256((user['display_name'] or '').encode()).hexdigest()[:16]
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
     # Return user profile data
-    return jsonify({
+    return add_validators(jsonify({
         'user': {
             'id': user['id'],
             'display_name': user.get('display_name', 'Anonymous'),
         }
-    })
+    }), etag)
 
 
 @app.route('/api/messages', methods=['POST'])
@@ -230,35 +421,28 @@ def store_message():
     encrypted_content = data.get('encrypted_content')
     encrypted_key = data.get('encrypted_key')
     signature = data.get('signature')
+    suite = data.get('suite') or CryptoManager.LEGACY_SUITE
     
     if not all([recipient_id, encrypted_content, encrypted_key, signature]):
         return jsonify({'error': 'Missing required message fields'}), 400
     
-    db = get_db()
+    if suite not in CryptoManager.SUITES:
+        return jsonify({'error': 'Unsupported crypto suite'}), 400
+    
     try:
-        # Convert dictionary to JSON string before storing
-        encrypted_content_json = json.dumps(encrypted_content)
-      
-        # Create message
-        message = Message(
-            id=str(uuid.uuid4()),
+        message = message_manager.store_message(
             sender_id=payload['user_id'],
             recipient_id=recipient_id,
-            encrypted_content=encrypted_content_json,  # Now it's a JSON string
+            encrypted_content=encrypted_content,
             encrypted_key=encrypted_key,
-            signature=signature
+            signature=signature,
+            suite=suite
         )
         
-        db.add(message)
-        db.commit()
-        
-        return jsonify({'message': 'Message stored successfully', 'id': message.id})
+        return jsonify({'message': 'Message stored successfully', 'id': message['id']})
     except Exception as e:
-        db.rollback()
         app.logger.error(f"Error storing message: {str(e)}")
         return jsonify({'error': 'Failed to store message'}), 500
-    finally:
-        db.close()
 
 @app.route('/api/messages', methods=['GET'])
 def get_messages():
@@ -275,34 +459,164 @@ def get_messages():
     if not other_user_id:
         return jsonify({'error': 'Other user ID is required'}), 400
     
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return jsonify({'error': 'Invalid since timestamp'}), 400
+    
     # Get messages between the two users
-    db = get_db()
     try:
-        # Query messages in both directions
-        messages = db.query(Message).filter(
-            ((Message.sender_id == user_id) & (Message.recipient_id == other_user_id)) | 
-            ((Message.sender_id == other_user_id) & (Message.recipient_id == user_id))
-        ).order_by(Message.created_at).all()
+        # Validate the client's cached copy against the conversation index first
+        state = message_manager.get_conversation_state(user_id, other_user_id)
+        etag = message_manager.history_etag(state)
         
-        # Format messages
-        formatted_messages = []
-        for msg in messages:
-            formatted_messages.append({
-                'id': msg.id,
-                'sender_id': msg.sender_id,
-                'recipient_id': msg.recipient_id,
-                'encrypted_content': msg.encrypted_content,
-                'encrypted_key': msg.encrypted_key,
-                'signature': msg.signature,
-                'timestamp': msg.created_at.isoformat()
-            })
+        cached = not_modified(etag)
+        if cached:
+            return cached
         
-        return jsonify({'messages': formatted_messages})
+        # The ETag is read before the rows, so a message committed in between at worst costs a later refetch
+        # No Last-Modified: a late commit can add a message older than the newest one
+        messages = message_manager.get_messages(user_id, other_user_id, since=since)
+        return add_validators(jsonify({'messages': messages}), etag)
     except Exception as e:
         app.logger.error(f"Error fetching messages: {str(e)}")
         return jsonify({'error': 'Failed to fetch messages'}), 500
-    finally:
-        db.close()
+
+@app.route('/api/messages/export', methods=['GET'])
+def export_messages():
+    """Stream the full history with another user as NDJSON, one message per line"""
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    payload = user_manager.validate_token(token)
+    
+    if not payload:
+        return jsonify({'error': 'Invalid or expired token'}), 401
+    
+    other_user_id = request.args.get('user_id')
+    
+    if not other_user_id:
+        return jsonify({'error': 'Other user ID is required'}), 400
+    
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return jsonify({'error': 'Invalid since timestamp'}), 400
+    
+    messages = message_manager.iter_messages(payload['user_id'], other_user_id, since=since)
+    lines = (json.dumps(msg) + '\n' for msg in messages)
+    
+    return Response(lines, mimetype='application/x-ndjson')
+
+@app.route('/api/conversations', methods=['GET'])
+def get_conversations():
+    """Get the authenticated user's inbox, most recently active conversation first"""
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    payload = user_manager.validate_token(token)
+    
+    if not payload:
+        return jsonify({'error': 'Invalid or expired token'}), 401
+    
+    limit = request.args.get('limit', type=int)
+    before = request.args.get('before')
+    
+    if limit is not None and limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    
+    if before:
+        try:
+            before = MessageManager.decode_conversations_cursor(before)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    
+    try:
+        page = message_manager.get_conversations(payload['user_id'], limit=limit, before=before)
+        return jsonify(page)
+    except Exception as e:
+        app.logger.error(f"Error fetching conversations: {str(e)}")
+        return jsonify({'error': 'Failed to fetch conversations'}), 500
+
+@app.route('/api/conversations/<user_id>/read', methods=['POST'])
+def mark_conversation_read(user_id):
+    """Reset the unread counter of a conversation for the authenticated user"""
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    payload = user_manager.validate_token(token)
+    
+    if not payload:
+        return jsonify({'error': 'Invalid or expired token'}), 401
+    
+    if not message_manager.mark_conversation_read(payload['user_id'], user_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    
+    return jsonify({'message': 'Conversation marked as read'})
+
+@app.route('/api/admin/metrics', methods=['GET'])
+@admin_only
+def get_metrics():
+    """Operational gauges for this worker"""
+    return jsonify({
+        'sessions': session_store.stats(),
+        'socket_connections': len(socket_sessions),
+        'sockets': socket_limits.stats()
+    })
+
+@app.route('/api/admin/stats', methods=['GET'])
+@admin_only
+def get_activity_stats():
+    """Messages per hour, registrations and active users per day, from the activity rollups"""
+    hours = request.args.get('hours', 24, type=int)
+    days = request.args.get('days', 7, type=int)
+    
+    try:
+        # Include this worker's pending counts; other workers' land within ACTIVITY_FLUSH_INTERVAL
+        activity.flush()
+    except Exception as e:
+        app.logger.error(f"Activity flush failed: {str(e)}")
+    
+    return jsonify(activity.stats(hours, days))
+
+@app.route('/api/admin/queries', methods=['GET', 'DELETE'])
+@admin_only
+def get_query_stats():
+    """Top statements by time spent, with slow-query plans; DELETE starts a new window"""
+    if request.method == 'DELETE':
+        query_stats.reset()
+        return jsonify({'message': 'Query statistics reset'})
+    
+    limit = request.args.get('limit', 20, type=int)
+    order_by = request.args.get('order_by', 'total_ms')
+    
+    if order_by not in QueryStats.ORDERINGS:
+        return jsonify({'error': f"order_by must be one of {', '.join(QueryStats.ORDERINGS)}"}), 400
+    
+    return jsonify(query_stats.summary(limit, order_by))
+
+@app.route('/api/admin/profile', methods=['GET'])
+@admin_only
+def profile_process():
+    """Sample this worker's stacks for a bounded window and return them as collapsed stacks"""
+    seconds = request.args.get('seconds', 10, type=float)
+    hz = request.args.get('hz', 200, type=int)
+    include_waiting = request.args.get('waiting') == '1'
+    
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or not 0 < hz <= 1000:
+        return jsonify({'error': f'seconds must be in (0, {MAX_PROFILE_SECONDS}] and hz in (0, 1000]'}), 400
+    
+    try:
+        profiler.start(seconds, 1.0 / hz, include_waiting)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    # Yields to the hub, so the worker keeps serving while it is sampled
+    socketio.sleep(seconds)
+    collapsed = profiler.stop()
+    
+    response = Response(collapsed, mimetype='text/plain')
+    response.headers['Content-Disposition'] = f'attachment; filename="zecret-{int(profiler.started_at)}.collapsed"'
+    response.headers['X-Profile-Samples'] = str(profiler.samples)
+    return response
 
 # WebSocket event handlers
 @socketio.on('connect')
@@ -318,12 +632,23 @@ def on_connect():
     if not payload:
         return False  # Reject connection
     
-    # Store session for this socket
-    user_id = payload['user_id']
-    user = user_manager.get_user(user_id)
+    # Refuse over-limit sockets before doing any work, telling the client why; admitted ones hold their slot
+    rejection = socket_limits.admit(request.sid, payload['user_id'])
+    if rejection:
+        raise ConnectionRefusedError(rejection['reason'], rejection)
+    
+    # Create a new session for this socket (also verifies the user exists), pinned while it is connected
+    try:
+        session = user_manager.create_session(payload['user_id'], pinned=True)
+    except BaseException:
+        socket_limits.unregister(request.sid)
+        raise
     
-    # Create a new session or get existing one
-    session = user_manager.create_session(user_id)
+    if not session:
+        socket_limits.unregister(request.sid)
+        return False  # Reject connection
+    
+    user = session['user']
     socket_sessions[request.sid] = session['session_id']
     
     # Notify other users that this user is online
@@ -371,12 +696,15 @@ def verify_room(data):
 @socketio.on('disconnect')
 def on_disconnect():
     """Handle socket disconnection"""
+    user_id = socket_limits.user_for(request.sid)
+    socket_limits.unregister(request.sid)
+    
     if request.sid in socket_sessions:
         session_id = socket_sessions[request.sid]
         user = user_manager.get_user_for_session(session_id)
         
         # End the session
-        user_manager.end_session(session_id)
+        user_manager.end_session(session_id, user_id=user_id)
         del socket_sessions[request.sid]
         
         # Notify other users that this user is offline
@@ -450,40 +778,45 @@ def on_message(data):
     encrypted_content = secure_message.get('encrypted_content')
     encrypted_key = secure_message.get('encrypted_key')
     signature = secure_message.get('signature')
+    suite = secure_message.get('suite') or CryptoManager.LEGACY_SUITE
     
     if not all([recipient_id, encrypted_content, encrypted_key, signature]):
         emit('error', {'message': 'Invalid secure message format'})
         return
     
-    # Generate a unique message ID if not provided
-    message_id = data.get('id') or str(uuid.uuid4())
+    if suite not in CryptoManager.SUITES:
+        emit('error', {'message': 'Unsupported crypto suite'})
+        return
+    
+    # Client-supplied ids make retries idempotent; otherwise a time-ordered id is assigned
+    message_id = data.get('id')
     
     # Store the message in the database
-    db = get_db()
     try:
-        encrypted_content_json = json.dumps(encrypted_content)
-    
-        message = Message(
-            id=message_id,
+        message = message_manager.store_message(
             sender_id=user['id'],
             recipient_id=recipient_id,
-            encrypted_content=encrypted_content_json,
+            encrypted_content=encrypted_content,
             encrypted_key=encrypted_key,
             signature=signature,
+            message_id=message_id,
+            suite=suite
         )
         
-        db.add(message)
-        db.commit()
+        # A retried message was already stored and broadcast; just repeat the ack
+        if message['duplicate']:
+            emit('message_sent', {'id': message['id'], 'room': room, 'success': True})
+            return
         
         # Add sender info for the recipient
         message_data = {
-            'id': message.id,
+            'id': message['id'],
             'sender': {
                 'id': user['id'],
                 'display_name': user['display_name']
             },
             'secure_message': secure_message,
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': message['created_at'].isoformat()
         }
         
         # CRITICAL: Debug info
@@ -495,16 +828,13 @@ def on_message(data):
         emit('message', message_data, room=room, broadcast=True, include_self=False)
         
         # CRITICAL: Emit success back to sender
-        emit('message_sent', {'id': message.id, 'room': room, 'success': True})
+        emit('message_sent', {'id': message['id'], 'room': room, 'success': True})
         
-        print(f"Message broadcast completed for ID: {message.id}")
+        print(f"Message broadcast completed for ID: {message['id']}")
         
     except Exception as e:
-        db.rollback()
         print(f"Error in message handling: {str(e)}")
         emit('error', {'message': f'Failed to store message: {str(e)}'})
-    finally:
-        db.close()
 @app.after_request
 def add_cors_headers(response):
     origin = request.headers.get('Origin')
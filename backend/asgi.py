@@ -0,0 +1,836 @@
+"""
+Asyncio entry point for the Zecret backend.
+Serves the same REST routes and Socket.IO events as app.py over ASGI,
+with non-blocking database access through the async engine in models.py.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port $PORT
+"""
+
+import os
+import asyncio
+import hmac
+import json
+import hashlib
+import functools
+import logging
+import traceback
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs
+
+import socketio
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from crypto import CryptoManager
+from user_manager import AsyncUserManager
+from message_manager import AsyncMessageManager
+from session_store import create_session_store
+from profiler import SamplingProfiler
+from socket_limits import SocketLimits
+from query_log import QueryStats
+from models import get_async_engine, init_async_db, PARTITION_MESSAGES
+from partitions import maintain_partitions
+from shards import create_shard_map
+from activity import ActivityRollups
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SECRET_KEY = os.getenv('SECRET_KEY', '3d6f45a5e1384ab23e9b68f5c3156739c6a7b1518694b92dbe55990bc6f2c9a6')
+
+allowed_origins = ["https://zecret.vercel.app", "http://localhost:3000", "https://zecret-qxavsbcl0-cashnfts-projects.vercel.app"]
+
+# Initialize Socket.IO
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins=allowed_origins)
+
+# Token for the operational /api/admin endpoints; they are disabled when unset
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Statements slower than this are logged with their query plan (milliseconds)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+
+query_stats = QueryStats(SLOW_QUERY_MS, log=logger.warning)
+query_stats.attach(get_async_engine().sync_engine)
+
+# How often expired sessions are swept from the session store (seconds)
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', 60))
+
+# Months of messages kept when the messages table is partitioned; unset keeps everything
+MESSAGE_RETENTION_MONTHS = int(os.getenv('MESSAGE_RETENTION_MONTHS', 0)) or None
+
+# How often the monthly message partitions are maintained (seconds)
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv('PARTITION_MAINTENANCE_INTERVAL', 6 * 3600))
+
+# How often each worker's activity counts are flushed to the rollup tables (seconds)
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv('ACTIVITY_FLUSH_INTERVAL', 30))
+
+# Initialize managers
+activity = ActivityRollups()
+session_store = create_session_store(
+    os.getenv('SESSION_STORE_URL'),
+    max_size=int(os.getenv('SESSION_STORE_MAX_SIZE', 100000))
+)
+user_manager = AsyncUserManager(SECRET_KEY, session_store=session_store, activity=activity)
+# Message shards from MESSAGE_SHARDS; unset keeps messages on the main database
+message_shards = create_shard_map()
+message_manager = AsyncMessageManager(shards=message_shards, activity=activity)
+
+# SocketIO session storage
+socket_sessions = {}  # sid -> session_id
+
+# Socket admission and outbound backpressure limits (0 = unlimited)
+socket_limits = SocketLimits(
+    max_connections=int(os.getenv('SOCKET_MAX_CONNECTIONS', 0)),
+    max_per_user=int(os.getenv('SOCKET_MAX_PER_USER', 0)),
+    max_queue=int(os.getenv('SOCKET_MAX_QUEUE', 1000)),
+    slow_consumer=os.getenv('SOCKET_SLOW_CONSUMER', 'disconnect'),
+    redirect_url=os.getenv('SOCKET_REDIRECT_URL')
+)
+socket_limits.install(sio)
+
+# Longest window an /api/admin/profile request may sample (seconds)
+MAX_PROFILE_SECONDS = 60
+
+def profiled_handlers():
+    """Label every REST route and socket event handler, for profile attribution"""
+    handlers = {f"route:{route.name}": route.endpoint for route in rest_app.routes}
+    for event, handler in sio.handlers.get('/', {}).items():
+        handlers[f"event:{event}"] = handler
+    return handlers
+
+profiler = SamplingProfiler(profiled_handlers)
+
+# Utility functions
+def authenticate(request):
+    """Get the token payload for a REST request, or None"""
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    return user_manager.validate_token(token)
+
+def unauthorized():
+    return JSONResponse({'error': 'Invalid or expired token'}, status_code=401)
+
+async def json_body(request):
+    """Parse a JSON request body, treating a malformed body as empty"""
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def add_validators(response, etag, last_modified=None, max_age=0):
+    """Attach cache validators to a response; clients must revalidate unless max_age is set"""
+    response.headers['ETag'] = f'"{etag}"'
+    if last_modified:
+        response.headers['Last-Modified'] = last_modified.replace(tzinfo=timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+    response.headers['Cache-Control'] = f'private, max-age={max_age}' if max_age else 'private, no-cache'
+    return response
+
+def not_modified(request, etag, last_modified=None, max_age=0):
+    """
+    Check the request's conditional headers against the current validators
+    Returns a 304 response if the client's copy is still current, None otherwise
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = request.headers.get('If-Modified-Since')
+
+    if if_none_match:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        fresh = '*' in tags or f'"{etag}"' in tags
+    elif last_modified and if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+            fresh = last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= since
+        except (TypeError, ValueError):
+            fresh = False
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+
+    return add_validators(Response(status_code=304), etag, last_modified, max_age)
+
+def is_admin(request):
+    """Check that a request carries the ADMIN_TOKEN"""
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def forbidden():
+    return JSONResponse({'error': 'Forbidden'}, status_code=403)
+
+async def sweep_sessions():
+    """Background task removing expired sessions from the session store"""
+    while True:
+        await sio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            session_store.sweep()
+        except Exception as e:
+            logger.error(f"Session sweep failed: {str(e)}")
+
+async def flush_activity():
+    """Background task writing this worker's activity counts to the rollup tables"""
+    while True:
+        await sio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        try:
+            # A batch of upserts per interval, on the sync engine off the event loop
+            await asyncio.to_thread(activity.flush)
+        except Exception as e:
+            logger.error(f"Activity flush failed: {str(e)}")
+
+async def maintain_message_partitions():
+    """Background task creating upcoming message partitions and dropping expired ones"""
+    while True:
+        await sio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+        try:
+            await asyncio.to_thread(maintain_partitions, MESSAGE_RETENTION_MONTHS)
+        except Exception as e:
+            logger.error(f"Partition maintenance failed: {str(e)}")
+
+async def init_message_shards():
+    if message_shards:
+        await asyncio.to_thread(message_shards.init_shards)
+
+async def start_background_tasks():
+    sio.start_background_task(sweep_sessions)
+    sio.start_background_task(flush_activity)
+    if PARTITION_MESSAGES:
+        # DDL is rare, so it runs on the sync engine off the event loop
+        await asyncio.to_thread(maintain_partitions, MESSAGE_RETENTION_MONTHS)
+        sio.start_background_task(maintain_message_partitions)
+
+def authenticated_only(f):
+    @functools.wraps(f)
+    async def wrapped(sid, *args):
+        if sid not in socket_sessions:
+            await sio.disconnect(sid)
+            return
+        return await f(sid, *args)
+    return wrapped
+
+async def get_user_from_socket(sid):
+    """Get the user associated with a socket ID"""
+    if sid in socket_sessions:
+        session_id = socket_sessions[sid]
+        return await user_manager.get_user_for_session(session_id)
+    return None
+
+async def handle_exception(request, exc):
+    logger.error(f"Unhandled exception: {str(exc)}")
+    logger.error(traceback.format_exc())
+    return JSONResponse({'error': 'Internal server error. Please try again later.'}, status_code=500)
+
+# REST API Routes
+async def index(request):
+    return JSONResponse({'message': 'Secure Anonymous Chat API'})
+
+async def register(request):
+    """Register a new anonymous user"""
+    data = await json_body(request)
+    display_name = data.get('display_name')
+    suite = data.get('suite') or CryptoManager.LEGACY_SUITE
+
+    if suite not in CryptoManager.SUITES:
+        return JSONResponse({'error': 'Unsupported crypto suite'}, status_code=400)
+
+    try:
+        # Register the user and create its session in a single transaction
+        user = await user_manager.register_anonymous_user(display_name, start_session=True, suite=suite)
+        session = user['session']
+
+        return JSONResponse({
+            'message': 'Anonymous user registered successfully',
+            'user': {
+                'id': user['id'],
+                'display_name': user['display_name'],
+                'public_key': user['public_key'],
+                'suite': user['suite']
+            },
+            'access_code': user['access_code'],  # This is the "password" they must save
+            'private_key': user['private_key'],  # Client must save this for decryption
+            'token': session['token']
+        }, status_code=201)
+    except Exception as e:
+        logger.error(f"Registration error: {str(e)}")
+        return JSONResponse({'error': 'Registration failed'}, status_code=500)
+
+async def login(request):
+    """Log in with an access code"""
+    data = await json_body(request)
+    access_code = data.get('access_code')
+
+    if not access_code:
+        return JSONResponse({'error': 'Access code is required'}, status_code=400)
+
+    try:
+        # Log in and create a session in a single round-trip
+        session = await user_manager.login_and_create_session(access_code)
+
+        if not session:
+            return JSONResponse({'error': 'Invalid access code'}, status_code=401)
+
+        user = session['user']
+
+        return JSONResponse({
+            'message': 'Login successful',
+            'user': {
+                'id': user['id'],
+                'display_name': user['display_name'],
+                'public_key': user['public_key'],
+                'suite': user['suite']
+            },
+            'token': session['token']
+        })
+    except Exception as e:
+        logger.error(f"Login error: {str(e)}")
+        return JSONResponse({'error': 'Login failed'}, status_code=500)
+
+async def get_online_users(request):
+    """Get a list of online users"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    current_user_id = payload['user_id']
+    online_users = await user_manager.get_online_users()
+
+    # Filter out the requestor
+    online_users = [
+        user for user in online_users if user['id'] != current_user_id
+    ]
+
+    return JSONResponse({'users': online_users})
+
+async def search_users(request):
+    """Search the user directory by display name prefix"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    prefix = request.query_params.get('q', '')
+    cursor = request.query_params.get('cursor')
+    include_keys = request.query_params.get('include_keys', '').lower() in ('1', 'true')
+
+    try:
+        limit = int(request.query_params['limit']) if 'limit' in request.query_params else None
+    except ValueError:
+        return JSONResponse({'error': 'Invalid limit'}, status_code=400)
+
+    try:
+        page = await user_manager.search_users(prefix, limit=limit, cursor=cursor, include_keys=include_keys)
+        return JSONResponse(page)
+    except ValueError as e:
+        # Invalid prefix or cursor
+        return JSONResponse({'error': str(e)}, status_code=400)
+
+async def get_public_key(request):
+    """Get a user's public key"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    user_id = request.path_params['user_id']
+
+    # Public keys never change, so the user's existence is the only thing to check
+    created_at = await user_manager.get_created_at(user_id)
+
+    if not created_at:
+        return JSONResponse({'error': 'User not found'}, status_code=404)
+
+    etag = f"key-{user_id}"
+    cached = not_modified(request, etag, created_at, max_age=3600)
+    if cached:
+        return cached
+
+    public_key = await user_manager.get_public_key(user_id)
+
+    if not public_key:
+        return JSONResponse({'error': 'User not found'}, status_code=404)
+
+    return add_validators(JSONResponse(public_key), etag, created_at, max_age=3600)
+
+async def update_profile(request):
+    """Update user profile (currently just display name)"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    data = await json_body(request)
+    display_name = data.get('display_name')
+
+    if not display_name:
+        return JSONResponse({'error': 'Display name is required'}, status_code=400)
+
+    success = await user_manager.update_display_name(payload['user_id'], display_name)
+
+    if not success:
+        return JSONResponse({'error': 'Failed to update profile'}, status_code=500)
+
+    return JSONResponse({'message': 'Profile updated successfully'})
+
+async def get_user_profile(request):
+    """Get the authenticated user's profile"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    user = await user_manager.get_profile(payload.get('user_id'))
+
+    if not user:
+        return JSONResponse({'error': 'User not found'}, status_code=404)
+
+    etag = hashlib.sha256((user['display_name'] or '').encode()).hexdigest()[:16]
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    return add_validators(JSONResponse({
+        'user': {
+            'id': user['id'],
+            'display_name': user.get('display_name', 'Anonymous'),
+        }
+    }), etag)
+
+async def store_message(request):
+    """Store an encrypted message sent over REST"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    data = await json_body(request)
+    recipient_id = data.get('recipient_id')
+    encrypted_content = data.get('encrypted_content')
+    encrypted_key = data.get('encrypted_key')
+    signature = data.get('signature')
+    suite = data.get('suite') or CryptoManager.LEGACY_SUITE
+
+    if not all([recipient_id, encrypted_content, encrypted_key, signature]):
+        return JSONResponse({'error': 'Missing required message fields'}, status_code=400)
+
+    if suite not in CryptoManager.SUITES:
+        return JSONResponse({'error': 'Unsupported crypto suite'}, status_code=400)
+
+    try:
+        message = await message_manager.store_message(
+            sender_id=payload['user_id'],
+            recipient_id=recipient_id,
+            encrypted_content=encrypted_content,
+            encrypted_key=encrypted_key,
+            signature=signature,
+            suite=suite
+        )
+
+        return JSONResponse({'message': 'Message stored successfully', 'id': message['id']})
+    except Exception as e:
+        logger.error(f"Error storing message: {str(e)}")
+        return JSONResponse({'error': 'Failed to store message'}, status_code=500)
+
+async def get_messages(request):
+    """Get messages for the authenticated user"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    user_id = payload['user_id']
+    other_user_id = request.query_params.get('user_id')
+
+    if not other_user_id:
+        return JSONResponse({'error': 'Other user ID is required'}, status_code=400)
+
+    try:
+        since = request.query_params.get('since')
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        return JSONResponse({'error': 'Invalid since timestamp'}, status_code=400)
+
+    try:
+        # Validate the client's cached copy against the conversation index first
+        state = await message_manager.get_conversation_state(user_id, other_user_id)
+        etag = message_manager.history_etag(state)
+
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+
+        # The ETag is read before the rows, so a message committed in between at worst costs a later refetch
+        # No Last-Modified: a late commit can add a message older than the newest one
+        messages = await message_manager.get_messages(user_id, other_user_id, since=since)
+        return add_validators(JSONResponse({'messages': messages}), etag)
+    except Exception as e:
+        logger.error(f"Error fetching messages: {str(e)}")
+        return JSONResponse({'error': 'Failed to fetch messages'}, status_code=500)
+
+async def export_messages(request):
+    """Stream the full history with another user as NDJSON, one message per line"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    other_user_id = request.query_params.get('user_id')
+
+    if not other_user_id:
+        return JSONResponse({'error': 'Other user ID is required'}, status_code=400)
+
+    try:
+        since = request.query_params.get('since')
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        return JSONResponse({'error': 'Invalid since timestamp'}, status_code=400)
+
+    async def lines():
+        async for msg in message_manager.iter_messages(payload['user_id'], other_user_id, since=since):
+            yield json.dumps(msg) + '\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+async def get_conversations(request):
+    """Get the authenticated user's inbox, most recently active conversation first"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    try:
+        limit = int(request.query_params['limit']) if 'limit' in request.query_params else None
+        before = request.query_params.get('before')
+        before = AsyncMessageManager.decode_conversations_cursor(before) if before else None
+    except ValueError:
+        return JSONResponse({'error': 'Invalid cursor'}, status_code=400)
+
+    if limit is not None and limit < 1:
+        return JSONResponse({'error': 'limit must be at least 1'}, status_code=400)
+
+    try:
+        page = await message_manager.get_conversations(payload['user_id'], limit=limit, before=before)
+        return JSONResponse(page)
+    except Exception as e:
+        logger.error(f"Error fetching conversations: {str(e)}")
+        return JSONResponse({'error': 'Failed to fetch conversations'}, status_code=500)
+
+async def mark_conversation_read(request):
+    """Reset the unread counter of a conversation for the authenticated user"""
+    payload = authenticate(request)
+    if not payload:
+        return unauthorized()
+
+    if not await message_manager.mark_conversation_read(payload['user_id'], request.path_params['user_id']):
+        return JSONResponse({'error': 'Conversation not found'}, status_code=404)
+
+    return JSONResponse({'message': 'Conversation marked as read'})
+
+async def get_metrics(request):
+    """Operational gauges for this worker"""
+    if not is_admin(request):
+        return forbidden()
+
+    # A shared store's stats are a round-trip (and a key scan), kept off the event loop
+    sessions = await asyncio.to_thread(session_store.stats) if session_store.blocking else session_store.stats()
+
+    return JSONResponse({
+        'sessions': sessions,
+        'socket_connections': len(socket_sessions),
+        'sockets': socket_limits.stats()
+    })
+
+async def get_activity_stats(request):
+    """Messages per hour, registrations and active users per day, from the activity rollups"""
+    if not is_admin(request):
+        return forbidden()
+
+    try:
+        hours = int(request.query_params.get('hours', 24))
+        days = int(request.query_params.get('days', 7))
+    except ValueError:
+        hours, days = 24, 7
+
+    try:
+        # Include this worker's pending counts; other workers' land within ACTIVITY_FLUSH_INTERVAL
+        await asyncio.to_thread(activity.flush)
+    except Exception as e:
+        logger.error(f"Activity flush failed: {str(e)}")
+
+    return JSONResponse(await asyncio.to_thread(activity.stats, hours, days))
+
+async def get_query_stats(request):
+    """Top statements by time spent, with slow-query plans; DELETE starts a new window"""
+    if not is_admin(request):
+        return forbidden()
+
+    if request.method == 'DELETE':
+        query_stats.reset()
+        return JSONResponse({'message': 'Query statistics reset'})
+
+    try:
+        limit = int(request.query_params.get('limit', 20))
+    except ValueError:
+        limit = 20
+    order_by = request.query_params.get('order_by', 'total_ms')
+
+    if order_by not in QueryStats.ORDERINGS:
+        return JSONResponse(
+            {'error': f"order_by must be one of {', '.join(QueryStats.ORDERINGS)}"}, status_code=400
+        )
+
+    return JSONResponse(query_stats.summary(limit, order_by))
+
+async def profile_process(request):
+    """Sample this worker's stacks for a bounded window and return them as collapsed stacks"""
+    if not is_admin(request):
+        return forbidden()
+
+    try:
+        seconds = float(request.query_params.get('seconds', 10))
+        hz = int(request.query_params.get('hz', 200))
+    except ValueError:
+        seconds = hz = 0
+    include_waiting = request.query_params.get('waiting') == '1'
+
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or not 0 < hz <= 1000:
+        return JSONResponse(
+            {'error': f'seconds must be in (0, {MAX_PROFILE_SECONDS}] and hz in (0, 1000]'}, status_code=400
+        )
+
+    try:
+        profiler.start(seconds, 1.0 / hz, include_waiting)
+    except RuntimeError as e:
+        return JSONResponse({'error': str(e)}, status_code=409)
+
+    await asyncio.sleep(seconds)
+    collapsed = await asyncio.to_thread(profiler.stop)
+
+    return Response(collapsed, media_type='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="zecret-{int(profiler.started_at)}.collapsed"',
+        'X-Profile-Samples': str(profiler.samples)
+    })
+
+# WebSocket event handlers
+@sio.event
+async def connect(sid, environ, auth=None):
+    """Handle new socket connection"""
+    token = parse_qs(environ.get('QUERY_STRING', '')).get('token', [None])[0]
+
+    if not token:
+        return False  # Reject connection
+
+    payload = user_manager.validate_token(token)
+
+    if not payload:
+        return False  # Reject connection
+
+    # Refuse over-limit sockets before doing any work, telling the client why; admitted ones hold their slot
+    rejection = socket_limits.admit(sid, payload['user_id'])
+    if rejection:
+        raise socketio.exceptions.ConnectionRefusedError(rejection['reason'], rejection)
+
+    # Create a new session for this socket (also verifies the user exists), pinned while it is connected
+    try:
+        session = await user_manager.create_session(payload['user_id'], pinned=True)
+    except BaseException:
+        # Including cancellation while awaiting
+        socket_limits.unregister(sid)
+        raise
+
+    if not session:
+        socket_limits.unregister(sid)
+        return False  # Reject connection
+
+    user = session['user']
+    socket_sessions[sid] = session['session_id']
+
+    # Notify other users that this user is online
+    await sio.emit('user_online', {
+        'user': {
+            'id': user['id'],
+            'display_name': user['display_name']
+        }
+    }, skip_sid=sid)
+
+    return True
+
+@sio.event
+@authenticated_only
+async def verify_room(sid, data):
+    """Verify that a room exists and users are in it"""
+    room = data.get('room')
+    user_ids = data.get('user_ids', [])
+
+    if not room:
+        await sio.emit('error', {'message': 'Room name is required'}, to=sid)
+        return
+
+    user = await get_user_from_socket(sid)
+
+    # Make sure this user is in the room
+    sio.enter_room(sid, room)
+
+    # Emit to all users in the room to confirm membership
+    await sio.emit('room_verified', {
+        'room': room,
+        'user_ids': user_ids,
+        'verified_by': user['id']
+    }, room=room)
+
+    # Return confirmation to the caller
+    await sio.emit('room_verification_result', {
+        'room': room,
+        'success': True
+    }, to=sid)
+
+@sio.event
+async def disconnect(sid):
+    """Handle socket disconnection"""
+    user_id = socket_limits.user_for(sid)
+    socket_limits.unregister(sid)
+
+    if sid in socket_sessions:
+        session_id = socket_sessions.pop(sid)
+        user = await user_manager.get_user_for_session(session_id)
+
+        # End the session
+        await user_manager.end_session(session_id, user_id=user_id)
+
+        # Notify other users that this user is offline
+        if user:
+            await sio.emit('user_offline', {
+                'user': {
+                    'id': user['id'],
+                    'display_name': user['display_name']
+                }
+            }, skip_sid=sid)
+
+@sio.event
+@authenticated_only
+async def join(sid, data):
+    """Join a chat room with another user"""
+    room = data.get('room')
+    target_user_id = data.get('user_id')
+
+    if not room and target_user_id:
+        # If room is not specified but user_id is, create the standard room name
+        user = await get_user_from_socket(sid)
+        if user:
+            room = "_".join(sorted([user['id'], target_user_id]))
+        else:
+            await sio.emit('error', {'message': 'Authentication required to join room'}, to=sid)
+            return
+
+    if not room:
+        await sio.emit('error', {'message': 'Room name or target user ID is required'}, to=sid)
+        return
+
+    sio.enter_room(sid, room)
+
+    await sio.emit('joined', {'room': room, 'with': target_user_id}, to=sid)
+
+@sio.event
+@authenticated_only
+async def leave(sid, data):
+    """Leave a chat room"""
+    room = data.get('room')
+
+    if not room:
+        await sio.emit('error', {'message': 'Room name is required'}, to=sid)
+        return
+
+    sio.leave_room(sid, room)
+    await sio.emit('left', {'room': room}, to=sid)
+
+@sio.event
+@authenticated_only
+async def message(sid, data):
+    """Handle a new message"""
+    room = data.get('room')
+    secure_message = data.get('secure_message')
+
+    if not room or not secure_message:
+        await sio.emit('error', {'message': 'Room and secure message are required'}, to=sid)
+        return
+
+    user = await get_user_from_socket(sid)
+    if not user:
+        await sio.emit('error', {'message': 'Authentication required'}, to=sid)
+        return
+
+    # Parse the secure message
+    recipient_id = secure_message.get('recipient_id')
+    encrypted_content = secure_message.get('encrypted_content')
+    encrypted_key = secure_message.get('encrypted_key')
+    signature = secure_message.get('signature')
+    suite = secure_message.get('suite') or CryptoManager.LEGACY_SUITE
+
+    if not all([recipient_id, encrypted_content, encrypted_key, signature]):
+        await sio.emit('error', {'message': 'Invalid secure message format'}, to=sid)
+        return
+
+    if suite not in CryptoManager.SUITES:
+        await sio.emit('error', {'message': 'Unsupported crypto suite'}, to=sid)
+        return
+
+    try:
+        message = await message_manager.store_message(
+            sender_id=user['id'],
+            recipient_id=recipient_id,
+            encrypted_content=encrypted_content,
+            encrypted_key=encrypted_key,
+            signature=signature,
+            message_id=data.get('id'),
+            suite=suite
+        )
+
+        # A retried message was already stored and broadcast; just repeat the ack
+        if not message['duplicate']:
+            await sio.emit('message', {
+                'id': message['id'],
+                'sender': {
+                    'id': user['id'],
+                    'display_name': user['display_name']
+                },
+                'secure_message': secure_message,
+                'timestamp': message['created_at'].isoformat()
+            }, room=room, skip_sid=sid)
+
+        await sio.emit('message_sent', {'id': message['id'], 'room': room, 'success': True}, to=sid)
+
+    except Exception as e:
+        logger.error(f"Error in message handling: {str(e)}")
+        await sio.emit('error', {'message': f'Failed to store message: {str(e)}'}, to=sid)
+
+rest_app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/api/register', register, methods=['POST']),
+        Route('/api/login', login, methods=['POST']),
+        Route('/api/users/online', get_online_users, methods=['GET']),
+        Route('/api/users/search', search_users, methods=['GET']),
+        Route('/api/users/{user_id}/public-key', get_public_key, methods=['GET']),
+        Route('/api/users/profile', update_profile, methods=['PUT']),
+        Route('/api/users/profile', get_user_profile, methods=['GET']),
+        Route('/api/messages', store_message, methods=['POST']),
+        Route('/api/messages', get_messages, methods=['GET']),
+        Route('/api/messages/export', export_messages, methods=['GET']),
+        Route('/api/conversations', get_conversations, methods=['GET']),
+        Route('/api/conversations/{user_id}/read', mark_conversation_read, methods=['POST']),
+        Route('/api/admin/metrics', get_metrics, methods=['GET']),
+        Route('/api/admin/stats', get_activity_stats, methods=['GET']),
+        Route('/api/admin/queries', get_query_stats, methods=['GET', 'DELETE']),
+        Route('/api/admin/profile', profile_process, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=allowed_origins,
+            allow_credentials=True,
+            allow_methods=['GET', 'PUT', 'POST', 'DELETE', 'OPTIONS'],
+            allow_headers=['Content-Type', 'Authorization']
+        )
+    ],
+    exception_handlers={Exception: handle_exception},
+    on_startup=[init_async_db, init_message_shards, start_background_tasks]
+)
+
+app = socketio.ASGIApp(sio, other_asgi_app=rest_app)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Crypto suite benchmark for the Zecret backend.
+Times each CryptoManager suite's key generation (the registration cost),
+message preparation (encrypt and sign) and decryption (verify and decrypt),
+and records the key and per-message sizes each suite puts on the wire.
+Also measures the throughput of decrypting a history page one message at a
+time with decrypt_message against the batch decrypt_messages API.
+
+Usage:
+  python bench_crypto.py [--suites a,b] [--iterations N] [--message-bytes N]
+                         [--page-size N] [--workers N] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+from datetime import datetime
+
+import cryptography
+
+from bench_db import percentile
+from crypto import CryptoManager
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the CryptoManager suites")
+    parser.add_argument('--suites', help="Comma-separated suites to run (default: all)")
+    parser.add_argument('--iterations', type=int, default=200, help="Timed calls per operation")
+    parser.add_argument('--keygen-iterations', type=int, default=50, help="Timed key generations per suite")
+    parser.add_argument('--message-bytes', type=int, default=256, help="Plaintext size of the benchmark message")
+    parser.add_argument('--page-size', type=int, default=500, help="Messages per history page (0 skips the page benchmark)")
+    parser.add_argument('--page-repeats', type=int, default=1, help="Timed decryptions of the page per path")
+    parser.add_argument('--workers', type=int, help="Worker threads for the batch path (default: ThreadPoolExecutor's)")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    return parser.parse_args()
+
+def time_calls(call, iterations, warmup=5):
+    """Time call and return its latency summary in milliseconds"""
+    for _ in range(warmup):
+        call()
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'mean_ms': statistics.fmean(latencies),
+        'p50_ms': percentile(latencies, 0.50),
+        'p99_ms': percentile(latencies, 0.99),
+        'ops_per_second': 1000 / statistics.fmean(latencies)
+    }
+
+def time_page(call, page_size, repeats):
+    """Time decrypting a whole history page and return its throughput"""
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = call()
+        durations.append(time.perf_counter() - start)
+
+    assert len(results) == page_size
+    seconds = statistics.median(durations)
+    return {
+        'page_ms': seconds * 1000,
+        'messages_per_second': page_size / seconds
+    }
+
+def run_page(sender, recipient, page, args):
+    """Compare the per-message and batch paths on one history page"""
+    public_keys = {'sender': sender['public_key']}
+
+    result = {
+        'page_size': len(page),
+        # The current path: both key PEMs are parsed again for every message
+        'per_message': time_page(
+            lambda: [CryptoManager.decrypt_message(m, recipient['private_key'], sender['public_key']) for m in page],
+            len(page), args.page_repeats
+        ),
+        'batch_serial': time_page(
+            lambda: CryptoManager.decrypt_messages(page, recipient['private_key'], public_keys, max_workers=1),
+            len(page), args.page_repeats
+        ),
+        'batch_threaded': time_page(
+            lambda: CryptoManager.decrypt_messages(page, recipient['private_key'], public_keys, max_workers=args.workers),
+            len(page), args.page_repeats
+        )
+    }
+
+    errors = [entry['error'] for entry in CryptoManager.decrypt_messages(page, recipient['private_key'], public_keys) if entry['error']]
+    assert not errors, errors[0]
+
+    print(f"{'':<22} page of {len(page)}: per-message {result['per_message']['messages_per_second']:>8.0f} msg/s  "
+          f"batch {result['batch_serial']['messages_per_second']:>8.0f} msg/s  "
+          f"batch threaded {result['batch_threaded']['messages_per_second']:>8.0f} msg/s")
+    return result
+
+def run_suite(suite, args):
+    """Benchmark one suite, with both participants holding keys of that suite"""
+    sender = CryptoManager.generate_keypair(suite)
+    recipient = CryptoManager.generate_keypair(suite)
+    text = 'x' * args.message_bytes
+
+    def prepare():
+        return CryptoManager.prepare_message(
+            'sender', 'recipient', text, sender['private_key'], recipient['public_key'], suite
+        )
+
+    secure_message = prepare()
+
+    def decrypt():
+        return CryptoManager.decrypt_message(secure_message, recipient['private_key'], sender['public_key'])
+
+    assert decrypt()['text'] == text
+
+    result = {
+        'keygen': time_calls(lambda: CryptoManager.generate_keypair(suite), args.keygen_iterations, warmup=1),
+        'prepare_message': time_calls(prepare, args.iterations),
+        'decrypt_message': time_calls(decrypt, args.iterations),
+        'sizes': {
+            'public_key': len(sender['public_key']),
+            'private_key': len(sender['private_key']),
+            'encrypted_content': len(json.dumps(secure_message['encrypted_message'])),
+            'encrypted_key': len(secure_message['encrypted_key']),
+            'signature': len(secure_message['signature']),
+            'message': len(json.dumps(secure_message))
+        }
+    }
+
+    print(f"{suite:<22} keygen {result['keygen']['p50_ms']:>8.3f}ms  "
+          f"prepare {result['prepare_message']['p50_ms']:>7.3f}ms  "
+          f"decrypt {result['decrypt_message']['p50_ms']:>7.3f}ms  "
+          f"message {result['sizes']['message']:>5} bytes")
+
+    if args.page_size:
+        # Loaded keys are accepted in place of their strings, which keeps building the page fast
+        sender_key = CryptoManager.load_private_key(sender['private_key'])
+        recipient_key = CryptoManager.load_public_key(recipient['public_key'])
+        page = [
+            CryptoManager.prepare_message('sender', 'recipient', text, sender_key, recipient_key, suite)
+            for _ in range(args.page_size)
+        ]
+        result['history_page'] = run_page(sender, recipient, page, args)
+
+    return result
+
+def environment():
+    return {
+        'started_at': datetime.utcnow().isoformat(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'cryptography': cryptography.__version__,
+        'openssl': cryptography.hazmat.backends.openssl.backend.openssl_version_text()
+    }
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    suites = list(CryptoManager.SUITES)
+    if args.suites:
+        selected = [suite.strip() for suite in args.suites.split(',') if suite.strip()]
+        unknown = set(selected) - set(suites)
+        if unknown:
+            raise SystemExit(f"Unknown suites: {', '.join(sorted(unknown))}")
+        suites = selected
+
+    results = {'environment': environment(), 'message_bytes': args.message_bytes, 'suites': {}}
+    for suite in suites:
+        results['suites'][suite] = run_suite(suite, args)
+
+    legacy = results['suites'].get(CryptoManager.LEGACY_SUITE)
+    if legacy:
+        print(f"\nRelative to {CryptoManager.LEGACY_SUITE}:")
+        for suite, result in results['suites'].items():
+            if suite != CryptoManager.LEGACY_SUITE:
+                print(f"{suite:<22} keygen {legacy['keygen']['p50_ms'] / result['keygen']['p50_ms']:>7.1f}x  "
+                      f"prepare {legacy['prepare_message']['p50_ms'] / result['prepare_message']['p50_ms']:>5.1f}x  "
+                      f"decrypt {legacy['decrypt_message']['p50_ms'] / result['decrypt_message']['p50_ms']:>5.1f}x faster  "
+                      f"message {result['sizes']['message'] / legacy['sizes']['message'] - 1:>+6.1%}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
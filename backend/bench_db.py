@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""
+Database-layer benchmark suite for the Zecret backend.
+Seeds a database with realistic volumes of users, messages and conversation
+index rows, then runs each UserManager/MessageManager query path behind the
+REST routes and socket events. Records latency percentiles, statements per
+call and the query plan of every statement, and writes them as JSON so runs
+can be compared across releases and index changes.
+
+Usage:
+  python bench_db.py [--users N] [--messages N] [--database-url URL]
+                     [--reuse] [--output results.json] [--compare baseline.json]
+
+Defaults to a throwaway SQLite database. Seeding 10M messages takes a while;
+point --database-url at a persistent database and pass --reuse on later runs.
+The write paths (logins, store_message, mark_conversation_read) add to the
+seeded data, so reused databases grow slightly between runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the database query paths")
+    parser.add_argument('--users', type=int, default=10000, help="Number of users to seed")
+    parser.add_argument('--messages', type=int, default=100000, help="Number of messages to seed")
+    parser.add_argument('--peers', type=int, default=10, help="Conversation partners per user")
+    parser.add_argument('--days', type=int, default=365, help="Days of history the messages are spread over")
+    parser.add_argument('--online-fraction', type=float, default=0.05, help="Fraction of users marked online")
+    parser.add_argument('--iterations', type=int, default=200, help="Timed calls per query path")
+    parser.add_argument('--warmup', type=int, default=10, help="Untimed calls per query path")
+    parser.add_argument('--paths', help="Comma-separated query paths to run (default: all)")
+    parser.add_argument('--database-url', help="Database to benchmark (default: temporary SQLite file)")
+    parser.add_argument('--reuse', action='store_true', help="Skip seeding if the database already has users")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed for the generated data")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', help="Print latency changes against a previous results file")
+    return parser.parse_args()
+
+def seed_database(args, chunk_size=10000):
+    """
+    Insert users, messages and the matching conversation index rows
+    Each user talks to a fixed set of peers, and messages are spread evenly
+    over the last args.days days, oldest first
+    """
+    rng = random.Random(args.seed)
+    user_ids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(args.users)]
+    online = set(rng.sample(range(args.users), int(args.users * args.online_fraction)))
+    now = datetime.utcnow()
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        users = User.__table__
+        for offset in range(0, args.users, chunk_size):
+            insert_chunk(conn, users, [
+                row_for(users, {
+                    'id': user_ids[i],
+                    'public_key': 'bench-public-key',
+                    'access_code_hash': UserManager._hash_access_code(f"bench-{i}"),
+                    'display_name': f"bench-{i}",
+                    'created_at': now - timedelta(days=args.days),
+                    'last_active': now,
+                    'is_online': i in online
+                })
+                for i in range(offset, min(offset + chunk_size, args.users))
+            ])
+
+    peers = [
+        sorted({rng.randrange(args.users) for _ in range(args.peers)} - {i}) or [(i + 1) % args.users]
+        for i in range(args.users)
+    ]
+
+    first_at = now - timedelta(days=args.days)
+    step = timedelta(days=args.days) / max(args.messages, 1)
+    latest = {}  # (owner_id, peer_id) -> (message_id, created_at)
+
+    if PARTITION_MESSAGES:
+        from partitions import ensure_partitions
+        with engine.begin() as conn:
+            ensure_partitions(conn, since=first_at)
+
+    messages = Message.__table__
+    for offset in range(0, args.messages, chunk_size):
+        rows = []
+        for n in range(offset, min(offset + chunk_size, args.messages)):
+            sender = rng.randrange(args.users)
+            recipient = rng.choice(peers[sender])
+            message_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            created_at = first_at + step * n
+            rows.append(row_for(messages, {
+                'id': message_id,
+                'sender_id': user_ids[sender],
+                'recipient_id': user_ids[recipient],
+                'encrypted_content': '{"ciphertext": "' + 'A' * 64 + '", "iv": "' + 'B' * 16 + '"}',
+                'encrypted_key': 'K' * 344,
+                'signature': 'S' * 344,
+                'created_at': created_at
+            }))
+            latest[(user_ids[sender], user_ids[recipient])] = (message_id, created_at)
+            latest[(user_ids[recipient], user_ids[sender])] = (message_id, created_at)
+
+        with engine.begin() as conn:
+            insert_chunk(conn, messages, rows)
+        print(f"seeded {offset + len(rows)} messages", end='\r')
+
+    with engine.begin() as conn:
+        conversations = Conversation.__table__
+        entries = list(latest.items())
+        for offset in range(0, len(entries), chunk_size):
+            insert_chunk(conn, conversations, [
+                row_for(conversations, {
+                    'owner_id': owner_id,
+                    'peer_id': peer_id,
+                    'last_message_id': message_id,
+                    'last_message_at': created_at,
+                    'unread_count': 0
+                })
+                for (owner_id, peer_id), (message_id, created_at) in entries[offset:offset + chunk_size]
+            ])
+
+    print(f"seeded {args.users} users, {args.messages} messages, {len(latest)} conversation entries "
+          f"in {time.perf_counter() - start:.1f}s")
+
+def row_for(table, values):
+    """
+    Order a row's values like the table's columns, as insert_chunk expects
+    Columns missing from values take their scalar default
+    """
+    return tuple(
+        values[column.name] if column.name in values else column.default.arg
+        for column in table.columns
+    )
+
+def load_samples(count=1000):
+    """Pick the users, access codes and conversations the query paths are run against"""
+    with engine.connect() as conn:
+        pairs = conn.execute(
+            select(Conversation.owner_id, Conversation.peer_id).order_by(func.random()).limit(count)
+        ).all()
+        names = conn.execute(
+            select(User.display_name).where(User.display_name.like('bench-%')).order_by(func.random()).limit(count)
+        ).scalars().all()
+
+    if not pairs or not names:
+        raise SystemExit("The database has no seeded data; run without --reuse first")
+
+    return {
+        'pairs': [tuple(pair) for pair in pairs],
+        'access_codes': names,  # seeded users' access codes match their display names
+    }
+
+def query_paths(user_manager, message_manager, samples):
+    """The query path callables, each taking a random generator"""
+    pairs = samples['pairs']
+    codes = samples['access_codes']
+    week_ago = datetime.utcnow() - timedelta(days=7)
+
+    def pair(rng):
+        return rng.choice(pairs)
+
+    return {
+        'login_with_access_code': lambda rng: user_manager.login_with_access_code(rng.choice(codes)),
+        'login_and_create_session': lambda rng: user_manager.login_and_create_session(rng.choice(codes)),
+        'get_user': lambda rng: user_manager.get_user(pair(rng)[0]),
+        'get_profile': lambda rng: user_manager.get_profile(pair(rng)[0]),
+        'get_public_key': lambda rng: user_manager.get_public_key(pair(rng)[0]),
+        'get_online_users': lambda rng: user_manager.get_online_users(),
+        'search_users': lambda rng: user_manager.search_users(f"bench-{rng.randrange(100)}"),
+        'get_conversations': lambda rng: message_manager.get_conversations(pair(rng)[0]),
+        'get_conversation_state': lambda rng: message_manager.get_conversation_state(*pair(rng)),
+        'get_messages': lambda rng: message_manager.get_messages(*pair(rng)),
+        'get_messages_last_week': lambda rng: message_manager.get_messages(*pair(rng), since=week_ago),
+        'store_message': lambda rng: message_manager.store_message(
+            *pair(rng), {'ciphertext': 'A' * 64, 'iv': 'B' * 16}, 'K' * 344, 'S' * 344
+        ),
+        'mark_conversation_read': lambda rng: message_manager.mark_conversation_read(*pair(rng)),
+    }
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def capture_statements(call, rng):
+    """Run a call once and return the distinct statements it executed, with their parameters"""
+    captured = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement not in [s for s, _ in captured]:
+            captured.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        call(rng)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return captured
+
+def plan_for(statement, parameters):
+    """Get the query plan of a statement as text lines, without running it"""
+    with engine.connect() as conn:
+        return explain(conn.connection.dbapi_connection, engine.dialect.name, statement, parameters)
+
+def run_path(name, call, iterations, warmup, rng, counter):
+    """Time one query path and return its latency summary and query plans"""
+    for _ in range(warmup):
+        call(rng)
+
+    counter['statements'] = 0
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call(rng)
+        latencies.append((time.perf_counter() - start) * 1000)
+    statements = counter['statements']
+
+    plans = [
+        {'statement': statement, 'plan': plan_for(statement, parameters)}
+        for statement, parameters in capture_statements(call, rng)
+    ]
+
+    latencies.sort()
+    result = {
+        'iterations': iterations,
+        'mean_ms': statistics.fmean(latencies),
+        'p50_ms': percentile(latencies, 0.50),
+        'p90_ms': percentile(latencies, 0.90),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1],
+        'statements_per_call': statements / iterations,
+        'plans': plans
+    }
+
+    print(f"{name:<26} p50 {result['p50_ms']:>8.2f}ms  p90 {result['p90_ms']:>8.2f}ms  "
+          f"p99 {result['p99_ms']:>8.2f}ms  {result['statements_per_call']:>4.1f} stmts")
+    return result
+
+def table_counts():
+    with engine.connect() as conn:
+        return {
+            table.name: conn.execute(select(func.count()).select_from(table)).scalar()
+            for table in (User.__table__, Message.__table__, Conversation.__table__)
+        }
+
+def environment():
+    """Describe the run, so results files can be told apart"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    with engine.connect() as conn:
+        server_version = '.'.join(str(part) for part in conn.dialect.server_version_info or ())
+
+    return {
+        'started_at': datetime.utcnow().isoformat(),
+        'commit': commit,
+        'dialect': engine.dialect.name,
+        'server_version': server_version,
+        'partitioned_messages': PARTITION_MESSAGES,
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__
+    }
+
+def compare(results, baseline_path):
+    """Print each path's p50/p99 change against a baseline results file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    print(f"\nCompared with {baseline_path} (commit {baseline['environment'].get('commit')}):")
+    for name, result in results['paths'].items():
+        before = baseline['paths'].get(name)
+        if not before:
+            print(f"{name:<26} (new)")
+            continue
+        print(f"{name:<26} p50 {result['p50_ms'] / before['p50_ms'] - 1:>+7.1%}  "
+              f"p99 {result['p99_ms'] / before['p99_ms'] - 1:>+7.1%}  "
+              f"stmts {before['statements_per_call']:.1f} -> {result['statements_per_call']:.1f}")
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    tmpdir = None
+    if not args.database_url:
+        tmpdir = tempfile.TemporaryDirectory()
+        args.database_url = f"sqlite:///{os.path.join(tmpdir.name, 'bench_db.db')}"
+    os.environ['DATABASE_URL'] = args.database_url
+
+    # Imported after DATABASE_URL is set, since models binds the engine at import time
+    import sqlalchemy
+    from sqlalchemy import event, func, select
+    from models import User, Message, Conversation, PARTITION_MESSAGES, engine, init_db
+    from user_manager import UserManager
+    from message_manager import MessageManager
+    from migrate_db import insert_chunk
+    from query_log import explain
+
+    init_db()
+
+    with engine.connect() as conn:
+        seeded = conn.execute(select(User.id).limit(1)).first() is not None
+    if seeded and not args.reuse:
+        raise SystemExit("The database already has users; pass --reuse to benchmark it as is")
+    if not seeded:
+        seed_database(args)
+
+    counter = {'statements': 0}
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(*_):
+        counter['statements'] += 1
+
+    user_manager = UserManager('bench-secret')
+    message_manager = MessageManager()
+    paths = query_paths(user_manager, message_manager, load_samples())
+
+    if args.paths:
+        selected = [name.strip() for name in args.paths.split(',') if name.strip()]
+        unknown = set(selected) - set(paths)
+        if unknown:
+            raise SystemExit(f"Unknown query paths: {', '.join(sorted(unknown))}")
+        paths = {name: paths[name] for name in selected}
+
+    results = {'environment': environment(), 'tables': table_counts(), 'paths': {}}
+    print(f"{results['environment']['dialect']}: {results['tables']}")
+
+    rng = random.Random(args.seed)
+    for name, call in paths.items():
+        results['paths'][name] = run_path(name, call, args.iterations, args.warmup, rng, counter)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if tmpdir:
+        engine.dispose()
+        tmpdir.cleanup()
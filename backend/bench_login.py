@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Login throughput benchmark for the Zecret backend.
+Compares the legacy login flow (login_with_access_code followed by
+create_session: four round-trips, two transactions) with the consolidated
+UserManager.login_and_create_session path.
+
+Usage: python bench_login.py [--users N] [--logins N] [--database-url URL]
+Defaults to a throwaway SQLite database.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark login and session creation")
+    parser.add_argument('--users', type=int, default=1000, help="Number of users to seed")
+    parser.add_argument('--logins', type=int, default=2000, help="Number of logins per flow")
+    parser.add_argument('--database-url', help="Database to benchmark (default: temporary SQLite file)")
+    return parser.parse_args()
+
+def seed_users(count):
+    """Insert users with known access codes, skipping RSA key generation"""
+    db = get_db()
+    try:
+        db.bulk_insert_mappings(User, [{
+            'id': str(uuid.uuid4()),
+            'public_key': 'bench-public-key',
+            'access_code_hash': UserManager._hash_access_code(f"bench-{i}"),
+            'display_name': f"bench-{i}"
+        } for i in range(count)])
+        db.commit()
+    finally:
+        db.close()
+
+def legacy_login(user_manager, access_code):
+    """The login flow as it was before sessions were consolidated"""
+    db = get_db()
+    try:
+        access_code_hash = UserManager._hash_access_code(access_code)
+        user = db.query(User).filter(User.access_code_hash == access_code_hash).first()
+        user.last_active = datetime.utcnow()
+        user.is_online = True
+        db.commit()
+        user_id = user.id
+    finally:
+        db.close()
+
+    db = get_db()
+    try:
+        user = db.query(User).filter(User.id == user_id).first()
+        user_info = {'id': user.id, 'public_key': user.public_key, 'display_name': user.display_name}
+    finally:
+        db.close()
+
+    db = get_db()
+    try:
+        db_user = db.query(User).filter(User.id == user_id).first()
+        db_user.is_online = True
+        db_user.last_active = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+    return user_manager._issue_session(user_info)
+
+def run(name, login, user_manager, codes, counters):
+    """Run one flow over the given access codes and print its results"""
+    counters['statements'] = counters['commits'] = 0
+    start = time.perf_counter()
+    for code in codes:
+        login(user_manager, code)
+    elapsed = time.perf_counter() - start
+
+    print(f"{name:<14} {len(codes) / elapsed:>10.0f} logins/s "
+          f"{counters['statements'] / len(codes):>6.1f} statements/login "
+          f"{counters['commits'] / len(codes):>6.1f} commits/login")
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    tmpdir = None
+    if not args.database_url:
+        tmpdir = tempfile.TemporaryDirectory()
+        args.database_url = f"sqlite:///{os.path.join(tmpdir.name, 'bench_login.db')}"
+    os.environ['DATABASE_URL'] = args.database_url
+
+    # Imported after DATABASE_URL is set, since models binds the engine at import time
+    from sqlalchemy import event
+    from models import User, engine, get_db, init_db
+    from user_manager import UserManager
+
+    init_db()
+    seed_users(args.users)
+
+    counters = {'statements': 0, 'commits': 0}
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(*_):
+        counters['statements'] += 1
+
+    @event.listens_for(engine, 'commit')
+    def count_commit(*_):
+        counters['commits'] += 1
+
+    user_manager = UserManager('bench-secret')
+    codes = [f"bench-{random.randrange(args.users)}" for _ in range(args.logins)]
+
+    run("legacy", legacy_login, user_manager, codes, counters)
+    run("consolidated", UserManager.login_and_create_session, user_manager, codes, counters)
+
+    if tmpdir:
+        engine.dispose()
+        tmpdir.cleanup()
@@ -0,0 +1,449 @@
+"""
+Python client for the Zecret API, for bots and load generators.
+One ChatClient holds a keep-alive HTTP connection pool shared by any number
+of identities. Each ChatIdentity keeps its keys loaded and a single
+persistent Socket.IO connection that reconnects by itself, rejoins its
+rooms and catches up on the history it missed. Sends are pipelined: each
+one waits only for its own acknowledgement.
+
+Usage:
+  async with ChatClient('http://localhost:5000') as client:
+      alice = await client.register('alice')
+      bob = await client.register('bob')
+      await bob.connect()
+      await bob.join(alice.id)
+      await alice.connect()
+      await alice.send(bob.id, 'hello')
+      message = await bob.messages.get()
+"""
+
+import asyncio
+import json
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import aiohttp
+import socketio
+
+from crypto import CryptoManager
+
+class ChatClientError(RuntimeError):
+    """An API call failed; status is the HTTP status code, or None for socket errors"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class ChatClient:
+    """
+    Connection pool and public key cache shared by the identities driven
+    from one process
+    """
+
+    def __init__(self, base_url, max_connections=100, ack_timeout=10, suite=CryptoManager.AESGCM_SUITE):
+        """
+        Initialize the client
+        max_connections bounds the pooled HTTP connections (not the sockets)
+        suite is the crypto suite new identities register with
+        """
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self.ack_timeout = ack_timeout
+        self.suite = suite
+        self.session = None
+        self.socket_session = None
+        self.identities = []
+        self._public_keys = {}  # user_id -> future of the loaded public key record
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """Create the connection pools"""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            )
+            # A websocket holds its connection for life, so sockets get their own unbounded pool
+            self.socket_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+
+    async def close(self):
+        """Disconnect every identity and close the connection pool"""
+        await asyncio.gather(*(identity.close() for identity in self.identities), return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+            await self.socket_session.close()
+            self.session = self.socket_session = None
+
+    async def request(self, method, path, token=None, **kwargs):
+        """Make an API call over the pool and return its JSON body"""
+        await self.open()
+        headers = kwargs.pop('headers', {})
+        if token:
+            headers['Authorization'] = f"Bearer {token}"
+
+        async with self.session.request(method, self.base_url + path, headers=headers, **kwargs) as response:
+            body = await response.json(content_type=None) if response.status != 204 else None
+            if response.status >= 400:
+                error = body.get('error') if isinstance(body, dict) else None
+                raise ChatClientError(error or f"HTTP {response.status}", response.status)
+            return body
+
+    # Identities
+
+    async def register(self, display_name=None, suite=None):
+        """Register a new anonymous user and return its identity"""
+        body = await self.request('POST', '/api/register', json={
+            'display_name': display_name,
+            'suite': suite or self.suite
+        })
+        return self._add_identity(body['user'], body['token'], body['private_key'], body['access_code'])
+
+    async def login(self, access_code, private_key):
+        """Log in to an existing user and return its identity"""
+        body = await self.request('POST', '/api/login', json={'access_code': access_code})
+        return self._add_identity(body['user'], body['token'], private_key, access_code)
+
+    def _add_identity(self, user, token, private_key, access_code):
+        identity = ChatIdentity(self, user, token, private_key, access_code)
+        self.identities.append(identity)
+        return identity
+
+    async def public_key(self, user_id, identity):
+        """
+        Get a user's public key record, with the key already loaded
+        Public keys never change, so each one is fetched once per client,
+        however many identities ask for it
+        """
+        future = self._public_keys.get(user_id)
+        if future is None:
+            future = self._public_keys[user_id] = asyncio.ensure_future(self._fetch_public_key(user_id, identity))
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            # Let a later call retry a failed fetch
+            if self._public_keys.get(user_id) is future:
+                del self._public_keys[user_id]
+            raise
+
+    async def _fetch_public_key(self, user_id, identity):
+        body = await identity.request('GET', f"/api/users/{user_id}/public-key")
+        return {
+            'public_key': body['public_key'],
+            'suite': body.get('suite') or CryptoManager.LEGACY_SUITE,
+            'key': CryptoManager.load_public_key(body['public_key'])
+        }
+
+class ChatIdentity:
+    """
+    One user driven by a ChatClient: its keys, session token and socket.
+    Decrypted incoming messages are put on the messages queue, or passed to
+    on_message if it is set.
+    """
+
+    MAX_SEEN = 10000
+    # Catch-up re-reads this far behind the newest message seen, for messages
+    # that committed late with an earlier timestamp; _seen drops the repeats
+    CATCH_UP_OVERLAP = timedelta(minutes=1)
+
+    def __init__(self, client, user, token, private_key, access_code=None):
+        """Initialize the identity; the private key is parsed once here"""
+        self.client = client
+        self.id = user['id']
+        self.display_name = user.get('display_name')
+        self.public_key = user['public_key']
+        self.suite = user.get('suite') or CryptoManager.LEGACY_SUITE
+        self.token = token
+        self.private_key = private_key
+        self.access_code = access_code
+        self._key = CryptoManager.load_private_key(private_key)
+
+        self.messages = asyncio.Queue()
+        self.on_message = None
+        self.errors = []
+
+        self._sio = None
+        self._connected_once = False
+        self._peers = {}  # peer_id -> server time of the newest message seen, None before any
+        self._pending = {}  # message_id -> (payload, ack future)
+        self._seen = OrderedDict()  # ids of recently delivered messages, oldest first
+
+    def credentials(self):
+        """What must be saved to log this identity in again"""
+        return {'id': self.id, 'access_code': self.access_code, 'private_key': self.private_key}
+
+    @staticmethod
+    def room(user_id, peer_id):
+        """The room of a conversation, named as the server's join handler does"""
+        return "_".join(sorted([user_id, peer_id]))
+
+    async def request(self, method, path, **kwargs):
+        """Make an API call as this identity, logging in again once if the token expired"""
+        try:
+            return await self.client.request(method, path, token=self.token, **kwargs)
+        except ChatClientError as e:
+            if e.status != 401 or not self.access_code:
+                raise
+        await self.relogin()
+        return await self.client.request(method, path, token=self.token, **kwargs)
+
+    async def relogin(self):
+        """Get a new session token with the access code"""
+        body = await self.client.request('POST', '/api/login', json={'access_code': self.access_code})
+        self.token = body['token']
+        if self._sio is not None:
+            # Reconnection attempts reuse the URL the socket first connected with
+            self._sio.connection_url = self._socket_url()
+
+    # Socket
+
+    def _socket_url(self):
+        return f"{self.client.base_url}?token={self.token}"
+
+    async def connect(self):
+        """Open the identity's socket; it reconnects by itself until close()"""
+        if self._sio is not None:
+            return
+
+        await self.client.open()
+        self._sio = socketio.AsyncClient(http_session=self.client.socket_session, handle_sigint=False)
+        self._sio.on('connect', self._on_connect)
+        self._sio.on('connect_error', self._on_connect_error)
+        self._sio.on('message', self._on_message)
+        self._sio.on('message_sent', self._on_message_sent)
+        self._sio.on('error', self._on_error)
+
+        try:
+            await self._sio.connect(self._socket_url(), transports=['websocket'])
+        except socketio.exceptions.ConnectionError as e:
+            self._sio = None
+            raise ChatClientError(f"Socket connection failed: {e}")
+
+    async def close(self):
+        """Disconnect the socket and fail any unacknowledged sends"""
+        sio, self._sio = self._sio, None
+        if sio is not None:
+            await sio.disconnect()
+
+        for _, future in self._pending.values():
+            if not future.done():
+                future.set_exception(ChatClientError("Identity closed before the message was acknowledged"))
+        self._pending.clear()
+
+    async def _on_connect(self):
+        # Rooms and undelivered sends do not survive a reconnection
+        for peer_id in self._peers:
+            await self._sio.emit('join', {'user_id': peer_id})
+        for payload, _ in list(self._pending.values()):
+            await self._sio.emit('message', payload)
+
+        if self._connected_once:
+            self._sio.start_background_task(self._catch_up)
+        self._connected_once = True
+
+    async def _on_connect_error(self, data):
+        self.errors.append(data)
+        # The server refuses expired tokens; the next attempt uses a fresh one
+        if self.access_code and not (isinstance(data, dict) and data.get('reason')):
+            try:
+                await self.relogin()
+            except (ChatClientError, aiohttp.ClientError):
+                pass
+
+    async def _on_error(self, data):
+        self.errors.append(data)
+
+    async def _on_message_sent(self, data):
+        entry = self._pending.pop(data.get('id'), None)
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(data['id'])
+
+    async def _on_message(self, data):
+        secure_message = data.get('secure_message') or {}
+        if secure_message.get('recipient_id') != self.id:
+            return
+
+        sender_id = data['sender']['id']
+        message = {
+            'id': data['id'],
+            'sender_id': sender_id,
+            'recipient_id': self.id,
+            'suite': secure_message.get('suite'),
+            'encrypted_message': secure_message['encrypted_content'],
+            'encrypted_key': secure_message['encrypted_key'],
+            'signature': secure_message['signature'],
+            'timestamp': data['timestamp']
+        }
+        await self._deliver_all(sender_id, [message])
+
+    # Conversations
+
+    async def join(self, peer_id):
+        """
+        Receive a peer's messages live, and from then on catch up on them
+        after every reconnection
+        """
+        if peer_id not in self._peers:
+            # The watermark comes from the server's clock, never this machine's
+            body = await self.request('GET', '/api/messages', params={'user_id': peer_id})
+            watermark = None
+            if body['messages']:
+                watermark = datetime.fromisoformat(body['messages'][-1]['timestamp'])
+                # Already in the conversation, so not delivered again by the overlap
+                for message in body['messages']:
+                    if datetime.fromisoformat(message['timestamp']) >= watermark - self.CATCH_UP_OVERLAP:
+                        self._remember(message['id'])
+            self._peers.setdefault(peer_id, watermark)
+        if self._sio is not None and self._sio.connected:
+            await self._sio.emit('join', {'user_id': peer_id})
+
+    async def leave(self, peer_id):
+        """Stop receiving a peer's messages"""
+        self._peers.pop(peer_id, None)
+        if self._sio is not None and self._sio.connected:
+            await self._sio.emit('leave', {'room': self.room(self.id, peer_id)})
+
+    async def send(self, peer_id, text, message_id=None):
+        """
+        Encrypt and send a message over the socket, and wait for the server's
+        acknowledgement; returns the message id
+        Concurrent sends are pipelined. Sends not yet acknowledged are
+        repeated after a reconnection, which the server deduplicates by id
+        """
+        if self._sio is None:
+            raise ChatClientError("Identity is not connected; call connect() first")
+
+        peer = await self.client.public_key(peer_id, self)
+        suite = CryptoManager.negotiate_suite(self.suite, peer['suite'])
+        secure_message = CryptoManager.prepare_message(self.id, peer_id, text, self._key, peer['key'], suite)
+
+        message_id = message_id or str(uuid.uuid4())
+        payload = {
+            'room': self.room(self.id, peer_id),
+            'id': message_id,
+            'secure_message': {
+                'recipient_id': peer_id,
+                'encrypted_content': secure_message['encrypted_message'],
+                'encrypted_key': secure_message['encrypted_key'],
+                'signature': secure_message['signature'],
+                'suite': suite
+            }
+        }
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message_id] = (payload, future)
+        try:
+            if self._sio.connected:
+                await self._sio.emit('message', payload)
+            return await asyncio.wait_for(asyncio.shield(future), self.client.ack_timeout)
+        except asyncio.TimeoutError:
+            raise ChatClientError(f"Message {message_id} was not acknowledged within {self.client.ack_timeout}s")
+        finally:
+            self._pending.pop(message_id, None)
+
+    async def history(self, peer_id, since=None):
+        """
+        Get the conversation with a peer, oldest first, decrypting the
+        messages addressed to this identity in one batch
+        Messages this identity sent cannot be decrypted and have text None
+        """
+        params = {'user_id': peer_id}
+        if since is not None:
+            params['since'] = since.isoformat()
+        body = await self.request('GET', '/api/messages', params=params)
+
+        received = [message for message in body['messages'] if message['recipient_id'] == self.id]
+        decrypted = await self._decrypt(peer_id, [self._secure_message(message) for message in received])
+        results = dict(zip((message['id'] for message in received), decrypted))
+
+        return [
+            results.get(message['id']) or {
+                'id': message['id'],
+                'sender_id': message['sender_id'],
+                'text': None,
+                'timestamp': message['timestamp'],
+                'error': None
+            }
+            for message in body['messages']
+        ]
+
+    @staticmethod
+    def _secure_message(message):
+        """Convert a history record to decrypt_message's input"""
+        return {
+            'id': message['id'],
+            'sender_id': message['sender_id'],
+            'recipient_id': message['recipient_id'],
+            'suite': message.get('suite'),
+            'encrypted_message': json.loads(message['encrypted_content']),
+            'encrypted_key': message['encrypted_key'],
+            'signature': message['signature'],
+            'timestamp': message['timestamp']
+        }
+
+    async def _decrypt(self, sender_id, secure_messages):
+        """Verify and decrypt messages from one sender; large batches run off the event loop"""
+        if not secure_messages:
+            return []
+        peer = await self.client.public_key(sender_id, self)
+
+        def decrypt():
+            return CryptoManager.decrypt_messages(secure_messages, self._key, {sender_id: peer['key']}, max_workers=1)
+
+        entries = decrypt() if len(secure_messages) == 1 else await asyncio.to_thread(decrypt)
+        return [
+            {
+                'id': secure_message['id'],
+                'sender_id': sender_id,
+                'text': entry['message']['text'] if entry['message'] else None,
+                'timestamp': secure_message['timestamp'],
+                'error': entry['error']
+            }
+            for secure_message, entry in zip(secure_messages, entries)
+        ]
+
+    async def _deliver_all(self, sender_id, secure_messages):
+        """Decrypt and deliver messages not delivered before"""
+        fresh = [message for message in secure_messages if message['id'] not in self._seen]
+        for message in await self._decrypt(sender_id, fresh):
+            self._remember(message['id'])
+
+            timestamp = datetime.fromisoformat(message['timestamp'])
+            if sender_id in self._peers and (self._peers[sender_id] is None or timestamp > self._peers[sender_id]):
+                self._peers[sender_id] = timestamp
+
+            if self.on_message is not None:
+                result = self.on_message(self, message)
+                if asyncio.iscoroutine(result):
+                    await result
+            else:
+                await self.messages.put(message)
+
+    def _remember(self, message_id):
+        """Record a message as delivered, forgetting the oldest beyond MAX_SEEN"""
+        self._seen[message_id] = True
+        if len(self._seen) > self.MAX_SEEN:
+            self._seen.popitem(last=False)
+
+    async def _catch_up(self):
+        """Deliver the messages that arrived in joined rooms while the socket was down"""
+        for peer_id, watermark in list(self._peers.items()):
+            try:
+                params = {'user_id': peer_id}
+                if watermark is not None:
+                    params['since'] = (watermark - self.CATCH_UP_OVERLAP).isoformat()
+                body = await self.request('GET', '/api/messages', params=params)
+            except (ChatClientError, aiohttp.ClientError) as e:
+                self.errors.append({'message': f"Catch-up with {peer_id} failed: {e}"})
+                continue
+
+            missed = [
+                self._secure_message(message) for message in body['messages']
+                if message['sender_id'] == peer_id and message['recipient_id'] == self.id
+            ]
+            await self._deliver_all(peer_id, missed)
@@ -1,12 +1,16 @@
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, x25519, ed25519
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
 import os
 import base64
 import json
 import datetime
 import secrets
+from concurrent.futures import ThreadPoolExecutor
 
 class CryptoManager:
     """
@@ -14,8 +18,129 @@ class CryptoManager:
     - Key generation (RSA for asymmetric, AES for symmetric)
     - Message encryption/decryption
     - Signatures for message integrity
+    
+    Messages are encrypted under a versioned suite. The legacy suite uses
+    RSA-2048 (OAEP key transport, PSS signatures) with AES-256-CFB; the v2
+    suites use X25519 key agreement, Ed25519 signatures and an AEAD cipher.
+    A user's suite is fixed by their key pair, and v2 users accept either
+    v2 cipher.
     """
     
+    LEGACY_SUITE = 'rsa2048-aescfb-v1'
+    AESGCM_SUITE = 'x25519-aesgcm-v2'
+    CHACHA20_SUITE = 'x25519-chacha20-v2'
+    
+    # Suite tag -> (key type, AEAD cipher)
+    SUITES = {
+        LEGACY_SUITE: ('rsa', None),
+        AESGCM_SUITE: ('x25519-ed25519', AESGCM),
+        CHACHA20_SUITE: ('x25519-ed25519', ChaCha20Poly1305),
+    }
+    
+    @staticmethod
+    def negotiate_suite(sender_suite, recipient_suite):
+        """
+        Choose the suite for a message: the recipient's own suite, which
+        their key pair can decrypt; the sender's key type only affects the signature
+        """
+        if recipient_suite not in CryptoManager.SUITES:
+            raise ValueError(f"Unsupported crypto suite: {recipient_suite}")
+        # A v2 sender prefers its own cipher when the recipient can decrypt it too
+        if CryptoManager.SUITES.get(sender_suite, (None,))[0] == CryptoManager.SUITES[recipient_suite][0]:
+            return sender_suite
+        return recipient_suite
+    
+    @staticmethod
+    def generate_keypair(suite=LEGACY_SUITE):
+        """Generate a new key pair for the given suite"""
+        if suite not in CryptoManager.SUITES:
+            raise ValueError(f"Unsupported crypto suite: {suite}")
+        if CryptoManager.SUITES[suite][0] == 'rsa':
+            keypair = CryptoManager.generate_rsa_keypair()
+        else:
+            keypair = CryptoManager.generate_x25519_keypair()
+        keypair['suite'] = suite
+        return keypair
+    
+    @staticmethod
+    def generate_x25519_keypair():
+        """
+        Generate a v2 key pair: an X25519 key for key agreement and an Ed25519
+        key for signatures, each serialized as raw base64 inside a JSON object
+        """
+        kx_key = x25519.X25519PrivateKey.generate()
+        sign_key = ed25519.Ed25519PrivateKey.generate()
+        
+        return {
+            'private_key': json.dumps({
+                'kx': CryptoManager._raw_b64(kx_key, private=True),
+                'sign': CryptoManager._raw_b64(sign_key, private=True)
+            }),
+            'public_key': json.dumps({
+                'kx': CryptoManager._raw_b64(kx_key.public_key()),
+                'sign': CryptoManager._raw_b64(sign_key.public_key())
+            })
+        }
+    
+    @staticmethod
+    def _raw_b64(key, private=False):
+        if private:
+            raw = key.private_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PrivateFormat.Raw,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+        else:
+            raw = key.public_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PublicFormat.Raw
+            )
+        return base64.b64encode(raw).decode('utf-8')
+    
+    @staticmethod
+    def is_rsa_key(key):
+        """Check whether a serialized or loaded key belongs to the legacy RSA suite"""
+        if isinstance(key, str):
+            return key.lstrip().startswith('-----BEGIN')
+        return not isinstance(key, tuple)
+    
+    @staticmethod
+    def load_private_key(key_string):
+        """Load a private key of any suite, to be passed in place of its string to the other methods"""
+        if CryptoManager.is_rsa_key(key_string):
+            return CryptoManager.load_rsa_key(key_string, is_private=True)
+        return CryptoManager.load_x25519_keys(key_string, is_private=True)
+    
+    @staticmethod
+    def load_public_key(key_string):
+        """Load a public key of any suite, to be passed in place of its string to the other methods"""
+        if CryptoManager.is_rsa_key(key_string):
+            return CryptoManager.load_rsa_key(key_string, is_private=False)
+        return CryptoManager.load_x25519_keys(key_string, is_private=False)
+    
+    @staticmethod
+    def load_x25519_keys(key_string, is_private=True):
+        """
+        Load a v2 key pair's (X25519, Ed25519) keys from its string representation
+        Already loaded keys are returned as is
+        """
+        if isinstance(key_string, tuple):
+            return key_string
+        
+        keys = json.loads(key_string)
+        kx = base64.b64decode(keys['kx'])
+        sign = base64.b64decode(keys['sign'])
+        
+        if is_private:
+            return (
+                x25519.X25519PrivateKey.from_private_bytes(kx),
+                ed25519.Ed25519PrivateKey.from_private_bytes(sign)
+            )
+        return (
+            x25519.X25519PublicKey.from_public_bytes(kx),
+            ed25519.Ed25519PublicKey.from_public_bytes(sign)
+        )
+    
     @staticmethod
     def generate_rsa_keypair():
         """Generate a new RSA key pair for asymmetric encryption"""
@@ -45,7 +170,14 @@ class CryptoManager:
     
     @staticmethod
     def load_rsa_key(key_string, is_private=True):
-        """Load an RSA key from its string representation"""
+        """
+        Load an RSA key from its string representation
+        Already loaded keys are returned as is; parsing a private key PEM
+        includes a costly consistency check
+        """
+        if not isinstance(key_string, str):
+            return key_string
+        
         if is_private:
             return serialization.load_pem_private_key(
                 key_string.encode('utf-8'),
@@ -178,33 +310,157 @@ class CryptoManager:
             return False
     
     @staticmethod
-    def prepare_message(sender_id, recipient_id, message_text, sender_private_key, recipient_public_key):
+    def sign_ed25519(message, private_key_str):
+        """Create an Ed25519 signature for a message with a v2 private key"""
+        _, sign_key = CryptoManager.load_x25519_keys(private_key_str, is_private=True)
+        return base64.b64encode(sign_key.sign(message.encode('utf-8'))).decode('utf-8')
+    
+    @staticmethod
+    def verify_ed25519(message, signature, public_key_str):
+        """Verify a message's Ed25519 signature with a v2 public key"""
+        _, verify_key = CryptoManager.load_x25519_keys(public_key_str, is_private=False)
+        
+        try:
+            verify_key.verify(base64.b64decode(signature.encode('utf-8')), message.encode('utf-8'))
+            return True
+        except (InvalidSignature, ValueError):
+            return False
+    
+    @staticmethod
+    def _derive_key(shared_secret, suite, ephemeral_public, recipient_public):
+        """Derive a message key from an X25519 shared secret, bound to the suite and both public keys"""
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=suite.encode('utf-8') + ephemeral_public + recipient_public,
+            backend=default_backend()
+        ).derive(shared_secret)
+    
+    @staticmethod
+    def encrypt_with_x25519(message, public_key_str, suite, associated_data):
+        """
+        Encrypt data to a v2 public key using an ephemeral X25519 key and the suite's AEAD
+        Returns the encrypted data and the ephemeral public key, which takes
+        the place of the RSA-encrypted AES key
+        """
+        recipient_key, _ = CryptoManager.load_x25519_keys(public_key_str, is_private=False)
+        ephemeral_key = x25519.X25519PrivateKey.generate()
+        ephemeral_public = ephemeral_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        recipient_public = recipient_key.public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        
+        key = CryptoManager._derive_key(ephemeral_key.exchange(recipient_key), suite, ephemeral_public, recipient_public)
+        nonce = os.urandom(12)
+        ciphertext = CryptoManager.SUITES[suite][1](key).encrypt(nonce, message.encode('utf-8'), associated_data)
+        
+        result = {
+            'nonce': base64.b64encode(nonce).decode('utf-8'),
+            'ciphertext': base64.b64encode(ciphertext).decode('utf-8')
+        }
+        
+        return result, base64.b64encode(ephemeral_public).decode('utf-8')
+    
+    @staticmethod
+    def decrypt_with_x25519(encrypted_data, encrypted_key, private_key_str, suite, associated_data):
+        """Decrypt data encrypted by encrypt_with_x25519; raises InvalidTag if it was altered"""
+        private_key, _ = CryptoManager.load_x25519_keys(private_key_str, is_private=True)
+        ephemeral_public = base64.b64decode(encrypted_key.encode('utf-8'))
+        recipient_public = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        
+        shared_secret = private_key.exchange(x25519.X25519PublicKey.from_public_bytes(ephemeral_public))
+        key = CryptoManager._derive_key(shared_secret, suite, ephemeral_public, recipient_public)
+        
+        nonce = base64.b64decode(encrypted_data['nonce'].encode('utf-8'))
+        ciphertext = base64.b64decode(encrypted_data['ciphertext'].encode('utf-8'))
+        plaintext = CryptoManager.SUITES[suite][1](key).decrypt(nonce, ciphertext, associated_data)
+        
+        return plaintext.decode('utf-8')
+    
+    @staticmethod
+    def _associated_data(suite, sender_id, recipient_id):
+        """Header authenticated by the AEAD, so a ciphertext cannot be replayed to another conversation"""
+        return f"{suite}:{sender_id}:{recipient_id}".encode('utf-8')
+    
+    @staticmethod
+    def _signed_payload(suite, sender_id, recipient_id, encrypted_message, encrypted_key):
+        """
+        The text a message's signature covers
+        v2 suites also cover the header and ephemeral key, and use canonical
+        JSON so the signature survives re-serialization in transit
+        """
+        if suite == CryptoManager.LEGACY_SUITE:
+            return json.dumps(encrypted_message)
+        message_json = json.dumps(encrypted_message, sort_keys=True, separators=(',', ':'))
+        return '\n'.join([suite, sender_id, recipient_id, encrypted_key, message_json])
+    
+    @staticmethod
+    def sign_payload(payload, private_key_str):
+        """Sign with whichever key type the sender has (RSA-PSS or Ed25519)"""
+        if CryptoManager.is_rsa_key(private_key_str):
+            return CryptoManager.sign_message(payload, private_key_str)
+        return CryptoManager.sign_ed25519(payload, private_key_str)
+    
+    @staticmethod
+    def verify_payload(payload, signature, public_key_str):
+        """Verify with whichever key type the sender has (RSA-PSS or Ed25519)"""
+        if CryptoManager.is_rsa_key(public_key_str):
+            return CryptoManager.verify_signature(payload, signature, public_key_str)
+        return CryptoManager.verify_ed25519(payload, signature, public_key_str)
+    
+    @staticmethod
+    def prepare_message(sender_id, recipient_id, message_text, sender_private_key, recipient_public_key, suite=None):
         """
         Prepare a secure message for sending:
-        1. Generate a one-time AES key
-        2. Encrypt the message with AES
-        3. Encrypt the AES key with recipient's RSA public key
-        4. Sign the encrypted message with sender's RSA private key
+        1. Generate a one-time key (an AES key, or an ephemeral X25519 key agreement)
+        2. Encrypt the message with it
+        3. Encrypt the AES key with recipient's RSA public key (legacy suite only)
+        4. Sign the encrypted message with the sender's private key
+        
+        The suite defaults to the one matching the recipient's public key
         """
-        # Generate a one-time symmetric key for this message
-        aes_key = CryptoManager.generate_aes_key()
+        if suite is None:
+            suite = CryptoManager.LEGACY_SUITE if CryptoManager.is_rsa_key(recipient_public_key) else CryptoManager.AESGCM_SUITE
         
-        # Encrypt the message with AES
-        encrypted_message = CryptoManager.encrypt_with_aes(message_text, aes_key)
+        if suite not in CryptoManager.SUITES:
+            raise ValueError(f"Unsupported crypto suite: {suite}")
+        if (CryptoManager.SUITES[suite][0] == 'rsa') != CryptoManager.is_rsa_key(recipient_public_key):
+            raise ValueError(f"Recipient's public key cannot be used with suite {suite}")
         
-        # Convert message to JSON string for signing
-        message_json = json.dumps(encrypted_message)
+        if suite == CryptoManager.LEGACY_SUITE:
+            # Generate a one-time symmetric key for this message
+            aes_key = CryptoManager.generate_aes_key()
+            
+            # Encrypt the message with AES
+            encrypted_message = CryptoManager.encrypt_with_aes(message_text, aes_key)
+            
+            # Encrypt the AES key with the recipient's public key
+            encrypted_key = CryptoManager.encrypt_with_rsa(aes_key, recipient_public_key)
+        else:
+            encrypted_message, encrypted_key = CryptoManager.encrypt_with_x25519(
+                message_text,
+                recipient_public_key,
+                suite,
+                CryptoManager._associated_data(suite, sender_id, recipient_id)
+            )
         
         # Sign the encrypted message
-        signature = CryptoManager.sign_message(message_json, sender_private_key)
-        
-        # Encrypt the AES key with the recipient's public key
-        encrypted_key = CryptoManager.encrypt_with_rsa(aes_key, recipient_public_key)
+        payload = CryptoManager._signed_payload(suite, sender_id, recipient_id, encrypted_message, encrypted_key)
+        signature = CryptoManager.sign_payload(payload, sender_private_key)
         
         # Prepare the final message package
         secure_message = {
             'sender_id': sender_id,
             'recipient_id': recipient_id,
+            'suite': suite,
             'encrypted_message': encrypted_message,
             'encrypted_key': encrypted_key,
             'signature': signature,
@@ -218,15 +474,27 @@ class CryptoManager:
         """
         Decrypt a secure message:
         1. Verify the signature using sender's public key
-        2. Decrypt the AES key using recipient's private key
-        3. Decrypt the message using the AES key
+        2. Recover the one-time key using recipient's private key
+        3. Decrypt the message with it
+        
+        Messages without a suite tag predate suites and use the legacy one
         """
-        # Convert encrypted message to JSON for signature verification
-        message_json = json.dumps(secure_message['encrypted_message'])
+        suite = secure_message.get('suite') or CryptoManager.LEGACY_SUITE
+        if suite not in CryptoManager.SUITES:
+            raise ValueError(f"Unsupported crypto suite: {suite}")
+        
+        encrypted_key = secure_message['encrypted_key']
         
         # Verify the signature
-        is_authentic = CryptoManager.verify_signature(
-            message_json,
+        payload = CryptoManager._signed_payload(
+            suite,
+            secure_message['sender_id'],
+            secure_message['recipient_id'],
+            secure_message['encrypted_message'],
+            encrypted_key
+        )
+        is_authentic = CryptoManager.verify_payload(
+            payload,
             secure_message['signature'],
             sender_public_key
         )
@@ -234,18 +502,66 @@ class CryptoManager:
         if not is_authentic:
             raise ValueError("Message signature verification failed")
         
-        # Decrypt the AES key
-        encrypted_key = secure_message['encrypted_key']
-        aes_key = CryptoManager.decrypt_with_rsa(encrypted_key, recipient_private_key)
-        
-        # Decrypt the message with the AES key
-        decrypted_message = CryptoManager.decrypt_with_aes(
-            secure_message['encrypted_message'],
-            aes_key
-        )
+        if suite == CryptoManager.LEGACY_SUITE:
+            # Decrypt the AES key
+            aes_key = CryptoManager.decrypt_with_rsa(encrypted_key, recipient_private_key)
+            
+            # Decrypt the message with the AES key
+            decrypted_message = CryptoManager.decrypt_with_aes(
+                secure_message['encrypted_message'],
+                aes_key
+            )
+        else:
+            decrypted_message = CryptoManager.decrypt_with_x25519(
+                secure_message['encrypted_message'],
+                encrypted_key,
+                recipient_private_key,
+                suite,
+                CryptoManager._associated_data(suite, secure_message['sender_id'], secure_message['recipient_id'])
+            )
         
         return {
             'sender_id': secure_message['sender_id'],
             'text': decrypted_message,
             'timestamp': secure_message['timestamp']
-        }
\ No newline at end of file
+        }
+    
+    @staticmethod
+    def decrypt_messages(secure_messages, recipient_private_key, sender_public_keys, max_workers=None):
+        """
+        Verify and decrypt a batch of secure messages, such as a history page
+        sender_public_keys maps each sender_id to its public key; every key is
+        parsed once for the whole batch. Messages are processed in max_workers
+        threads (default: ThreadPoolExecutor's), since OpenSSL does the heavy lifting
+        
+        Returns one entry per message, in order: {'message': <decrypt_message
+        result>, 'error': None}, or {'message': None, 'error': <reason>} for
+        messages that fail verification or decryption
+        """
+        private_key = CryptoManager.load_private_key(recipient_private_key)
+        
+        public_keys = {}
+        key_errors = {}
+        for sender_id in {secure_message.get('sender_id') for secure_message in secure_messages}:
+            try:
+                public_keys[sender_id] = CryptoManager.load_public_key(sender_public_keys[sender_id])
+            except KeyError:
+                key_errors[sender_id] = f"No public key for sender {sender_id}"
+            except (ValueError, TypeError) as e:
+                key_errors[sender_id] = f"Invalid public key for sender {sender_id}: {e}"
+        
+        def decrypt(secure_message):
+            sender_id = secure_message.get('sender_id')
+            if sender_id in key_errors:
+                return {'message': None, 'error': key_errors[sender_id]}
+            try:
+                message = CryptoManager.decrypt_message(secure_message, private_key, public_keys[sender_id])
+                return {'message': message, 'error': None}
+            except Exception as e:
+                return {'message': None, 'error': str(e) or type(e).__name__}
+        
+        if max_workers == 1 or len(secure_messages) < 2:
+            return [decrypt(secure_message) for secure_message in secure_messages]
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(decrypt, secure_messages))
\ No newline at end of file
@@ -5,9 +5,22 @@ Creates all necessary tables in the configured database.
 """
 
 from models import init_db
+from message_manager import MessageManager
+from shards import create_shard_map
+from activity import ActivityRollups
 
 if __name__ == "__main__":
     print("Initializing the database...")
     init_db()
+    message_shards = create_shard_map()
+    if message_shards:
+        print(f"Initializing message shards: {', '.join(message_shards.names)}")
+        message_shards.init_shards()
+    backfilled = MessageManager(shards=message_shards).backfill_conversations()
+    if backfilled:
+        print(f"Built {backfilled} conversation index entries from existing messages")
+    rollups = ActivityRollups().backfill(shards=message_shards)
+    if rollups:
+        print(f"Built {rollups} activity rollup entries from existing messages and users")
     print("Database initialized successfully!")
     print("You can now run the application with 'python app.py'")
\ No newline at end of file
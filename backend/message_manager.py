@@ -0,0 +1,662 @@
+import asyncio
+import base64
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from crypto import CryptoManager
+from models import Message, MessageId, Conversation, User, PARTITION_MESSAGES, get_db, get_async_db
+from sqlalchemy import select, update, case, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+
+def _dialect_insert(db):
+    """Return the dialect-specific insert() supporting ON CONFLICT, or None"""
+    dialect = db.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert
+    if dialect == 'sqlite':
+        return sqlite.insert
+    return None
+
+def new_message_id():
+    """
+    Generate a time-ordered message id (UUIDv7 layout: 48-bit Unix
+    milliseconds followed by random bits), so new rows land at the end of
+    the primary-key index instead of at random pages
+    """
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), 'big')
+    value = value & ~(0xF << 76) | 0x7 << 76  # version 7
+    value = value & ~(0x3 << 62) | 0x2 << 62  # RFC 4122 variant
+    return str(uuid.UUID(int=value))
+
+class _RecentAcks:
+    """
+    Short-lived memory of acknowledged (sender_id, message_id) pairs, so
+    client retries are answered without touching the database
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (sender_id, message_id) -> (expires_at, ack)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return entry[1]
+
+    def add(self, key, ack):
+        now = time.monotonic()
+        self._entries[key] = (now + self.ttl, ack)
+        self._entries.move_to_end(key)
+
+        # Entries share one TTL, so the oldest are always at the front
+        while self._entries:
+            oldest_key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at >= now and len(self._entries) <= self.max_size:
+                break
+            self._entries.pop(oldest_key)
+
+class MessageManager:
+    """
+    Manages message persistence for the secure chat application.
+    Keeps the denormalized conversation index in step with every stored message.
+    With a ShardMap (see shards.py), each conversation's messages and index
+    rows are stored on the shard its participants hash to.
+    """
+
+    DEFAULT_PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 200
+
+    def __init__(self, dedupe_ttl=300, dedupe_max_size=10000, shards=None, activity=None):
+        """Initialize the message manager, optionally storing messages on shards and recording activity rollups"""
+        self._recent_acks = _RecentAcks(dedupe_ttl, dedupe_max_size)
+        self.shards = shards
+        self.activity = activity
+
+    def _db(self, user_id, other_user_id):
+        """Get a database session on the database holding a conversation"""
+        return self.shards.session_for(user_id, other_user_id) if self.shards else get_db()
+
+    def _new_message(self, sender_id, recipient_id, encrypted_content, encrypted_key, signature, message_id, suite):
+        """Build the Message row for a new message"""
+        if suite not in CryptoManager.SUITES:
+            raise ValueError(f"Unsupported crypto suite: {suite}")
+
+        return Message(
+            id=message_id or new_message_id(),
+            sender_id=sender_id,
+            recipient_id=recipient_id,
+            encrypted_content=json.dumps(encrypted_content),
+            encrypted_key=encrypted_key,
+            signature=signature,
+            crypto_suite=suite,
+            created_at=datetime.utcnow()
+        )
+
+    def _duplicate_ack(self, message, existing):
+        """Build the ack for a message whose id was already stored, if it is a retry from the same sender"""
+        if existing is None or existing.sender_id != message.sender_id:
+            raise ValueError("Message id is already in use")
+        return {'id': message.id, 'created_at': existing.created_at}
+
+    def store_message(self, sender_id, recipient_id, encrypted_content, encrypted_key, signature, message_id=None, suite=CryptoManager.LEGACY_SUITE):
+        """
+        Store an encrypted message and update both participants' conversation entries
+        Returns the stored message id and timestamp
+
+        Storing is idempotent for client-supplied ids: a retry from the same
+        sender returns the original message with 'duplicate' set instead of failing
+        """
+        if message_id:
+            ack = self._recent_acks.get((sender_id, message_id))
+            if ack:
+                return dict(ack, duplicate=True)
+
+        db = self._db(sender_id, recipient_id)
+        try:
+            message = self._new_message(sender_id, recipient_id, encrypted_content, encrypted_key, signature, message_id, suite)
+
+            if self._insert_message(db, message):
+                self._update_conversations(db, message)
+                db.commit()
+                if self.activity:
+                    self.activity.record_message(sender_id, message.created_at)
+                ack = {'id': message.id, 'created_at': message.created_at}
+                duplicate = False
+            else:
+                existing = db.execute(self._existing_message_statement(message.id)).first()
+                ack = self._duplicate_ack(message, existing)
+                duplicate = True
+
+            if message_id:
+                self._recent_acks.add((sender_id, message_id), ack)
+
+            return dict(ack, duplicate=duplicate)
+
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+        finally:
+            db.close()
+
+    @staticmethod
+    def _existing_message_statement(message_id):
+        """Build the lookup of an already stored message's sender and timestamp"""
+        table = MessageId if PARTITION_MESSAGES else Message
+        return select(table.sender_id, table.created_at).where(table.id == message_id)
+
+    @staticmethod
+    def _claim_statement(insert, message):
+        """Build the INSERT claiming a message's id in message_ids, doing nothing if it is taken"""
+        return insert(MessageId).values(
+            id=message.id,
+            sender_id=message.sender_id,
+            created_at=message.created_at
+        ).on_conflict_do_nothing(index_elements=[MessageId.id])
+
+    @staticmethod
+    def _message_insert_statement(insert, message):
+        """Build an INSERT of the message that does nothing if its primary key already exists"""
+        values = {
+            column.name: getattr(message, column.name)
+            for column in Message.__table__.columns
+            if getattr(message, column.name) is not None
+        }
+        # On a partitioned table the key is (id, created_at), so retries are caught by the message_ids claim
+        return insert(Message).values(**values).on_conflict_do_nothing(
+            index_elements=list(Message.__table__.primary_key.columns)
+        )
+
+    @staticmethod
+    def _conversation_upsert_statements(insert, message):
+        """
+        Build the upserts pointing the sender's and recipient's conversation rows at a new message
+        Concurrent stores can commit out of created_at order, so a row only
+        moves forward to a newer message; the unread counter and version always count it
+        """
+        sides = [(message.sender_id, message.recipient_id, 0)]
+        if message.recipient_id != message.sender_id:
+            sides.append((message.recipient_id, message.sender_id, 1))
+
+        statements = []
+        for owner_id, peer_id, unread_increment in sides:
+            stmt = insert(Conversation).values(
+                owner_id=owner_id,
+                peer_id=peer_id,
+                last_message_id=message.id,
+                last_message_at=message.created_at,
+                unread_count=unread_increment,
+                version=1
+            )
+            newer = stmt.excluded.last_message_at >= Conversation.last_message_at
+            statements.append(stmt.on_conflict_do_update(
+                index_elements=[Conversation.owner_id, Conversation.peer_id],
+                set_={
+                    'last_message_id': case((newer, stmt.excluded.last_message_id), else_=Conversation.last_message_id),
+                    'last_message_at': case((newer, stmt.excluded.last_message_at), else_=Conversation.last_message_at),
+                    'unread_count': Conversation.unread_count + unread_increment,
+                    'version': Conversation.version + 1
+                }
+            ))
+        return statements
+
+    def _insert_message(self, db, message):
+        """
+        Insert a message unless its id already exists
+        Returns True if the row was inserted
+        """
+        insert = _dialect_insert(db)
+
+        if insert is not None:
+            # Concurrent retries block on the claimed id until the first commits, then find it taken
+            if PARTITION_MESSAGES and db.execute(self._claim_statement(insert, message)).rowcount == 0:
+                return False
+            result = db.execute(self._message_insert_statement(insert, message))
+            return result.rowcount > 0
+
+        # Generic fallback for dialects without ON CONFLICT support
+        if db.get(Message, message.id) is not None:
+            return False
+        db.add(message)
+        return True
+
+    def _update_conversations(self, db, message):
+        """Upsert the sender's and recipient's conversation rows for a new message"""
+        insert = _dialect_insert(db)
+
+        if insert is not None:
+            for stmt in self._conversation_upsert_statements(insert, message):
+                db.execute(stmt)
+            return
+
+        # Generic fallback for dialects without ON CONFLICT support
+        self._update_conversation(db, message.sender_id, message.recipient_id, message, unread_increment=0)
+        if message.recipient_id != message.sender_id:
+            self._update_conversation(db, message.recipient_id, message.sender_id, message, unread_increment=1)
+
+    def _update_conversation(self, db, owner_id, peer_id, message, unread_increment):
+        """Point a conversation row at the given message, if newer, with an UPDATE, inserting it if missing"""
+        newer = Conversation.last_message_at <= message.created_at
+        result = db.execute(
+            update(Conversation)
+            .where(Conversation.owner_id == owner_id, Conversation.peer_id == peer_id)
+            .values(
+                last_message_id=case((newer, message.id), else_=Conversation.last_message_id),
+                last_message_at=case((newer, message.created_at), else_=Conversation.last_message_at),
+                unread_count=Conversation.unread_count + unread_increment,
+                version=Conversation.version + 1
+            )
+        )
+        if result.rowcount == 0:
+            db.add(Conversation(
+                owner_id=owner_id,
+                peer_id=peer_id,
+                last_message_id=message.id,
+                last_message_at=message.created_at,
+                unread_count=unread_increment,
+                version=1
+            ))
+
+    @staticmethod
+    def _between(user_id, other_user_id):
+        """Filter matching messages exchanged between two users in either direction"""
+        return (
+            ((Message.sender_id == user_id) & (Message.recipient_id == other_user_id)) |
+            ((Message.sender_id == other_user_id) & (Message.recipient_id == user_id))
+        )
+
+    # Columns needed to render a message; selecting them avoids building ORM objects
+    _MESSAGE_COLUMNS = (
+        Message.id, Message.sender_id, Message.recipient_id,
+        Message.encrypted_content, Message.encrypted_key, Message.signature, Message.crypto_suite,
+        Message.created_at
+    )
+
+    def _history_statement(self, user_id, other_user_id, since=None, until=None):
+        """
+        Build the query for the messages between two users, oldest first
+        Optional created_at bounds let a partitioned table skip the other months
+        """
+        stmt = select(*self._MESSAGE_COLUMNS).where(self._between(user_id, other_user_id))
+        if since is not None:
+            stmt = stmt.where(Message.created_at > since)
+        if until is not None:
+            stmt = stmt.where(Message.created_at <= until)
+        return stmt.order_by(Message.created_at)
+
+    @staticmethod
+    def _format_message(msg):
+        """Convert a Message row to its API representation"""
+        return {
+            'id': msg.id,
+            'sender_id': msg.sender_id,
+            'recipient_id': msg.recipient_id,
+            'encrypted_content': msg.encrypted_content,
+            'encrypted_key': msg.encrypted_key,
+            'signature': msg.signature,
+            'suite': msg.crypto_suite,
+            'timestamp': msg.created_at.isoformat()
+        }
+
+    @staticmethod
+    def history_etag(state):
+        """
+        The ETag of a conversation's history, from its index row's version
+        A message committing late with an earlier created_at leaves
+        last_message_id alone but still bumps the version
+        """
+        if not state:
+            return 'empty'
+        return f"{state['last_message_id']}.{state['version']}"
+
+    @staticmethod
+    def _conversation_state(row):
+        """Convert a (last_message_id, last_message_at, version) row to a conversation state"""
+        if not row:
+            return None
+
+        return {
+            'last_message_id': row.last_message_id,
+            'last_message_at': row.last_message_at,
+            'version': row.version
+        }
+
+    def _conversations_statement(self, user_id, limit, before, with_names=True):
+        """
+        Build the inbox page query, served by the (owner_id, last_message_at, peer_id) index
+        Shards hold no users, so their queries are built without the display names
+        """
+        if with_names:
+            stmt = select(Conversation, User.display_name).join(User, User.id == Conversation.peer_id)
+        else:
+            stmt = select(Conversation)
+        stmt = stmt.where(Conversation.owner_id == user_id)
+
+        if before:
+            stmt = stmt.where(tuple_(Conversation.last_message_at, Conversation.peer_id) < tuple_(*before))
+
+        # peer_id breaks ties between conversations last active at the same instant
+        return stmt.order_by(Conversation.last_message_at.desc(), Conversation.peer_id.desc()).limit(limit)
+
+    @staticmethod
+    def _encode_conversations_cursor(last_message_at, peer_id):
+        """Encode the position after an inbox entry as an opaque cursor"""
+        return base64.urlsafe_b64encode(json.dumps([last_message_at.isoformat(), peer_id]).encode()).decode()
+
+    @staticmethod
+    def decode_conversations_cursor(cursor):
+        """Decode an inbox cursor to (last_message_at, peer_id); raises ValueError if it is malformed"""
+        try:
+            last_message_at, peer_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.fromisoformat(last_message_at), str(peer_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    @classmethod
+    def _page_limit(cls, limit):
+        """Clamp a requested page size to 1..MAX_PAGE_SIZE"""
+        return max(1, min(cls.DEFAULT_PAGE_SIZE if limit is None else limit, cls.MAX_PAGE_SIZE))
+
+    def _conversations_page(self, rows, limit):
+        """Convert inbox rows to a page with its next cursor"""
+        conversations = [{
+            'user_id': conversation.peer_id,
+            'display_name': display_name,
+            'last_message_id': conversation.last_message_id,
+            'last_message_at': conversation.last_message_at.isoformat(),
+            'unread_count': conversation.unread_count
+        } for conversation, display_name in rows]
+
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1][0]
+            next_cursor = self._encode_conversations_cursor(last.last_message_at, last.peer_id)
+
+        return {
+            'conversations': conversations,
+            'next_cursor': next_cursor
+        }
+
+    @staticmethod
+    def _newest_conversations(pages, limit):
+        """Merge the inbox pages read from each shard into one page"""
+        conversations = [conversation for page in pages for conversation in page]
+        conversations.sort(key=lambda conversation: (conversation.last_message_at, conversation.peer_id), reverse=True)
+        return conversations[:limit]
+
+    @staticmethod
+    def _display_names_statement(conversations):
+        """Build the query for the display names of a merged inbox page's peers"""
+        return select(User.id, User.display_name).where(
+            User.id.in_({conversation.peer_id for conversation in conversations})
+        )
+
+    @staticmethod
+    def _mark_read_statement(user_id, peer_id):
+        """Build the UPDATE resetting a conversation's unread counter"""
+        return (
+            update(Conversation)
+            .where(Conversation.owner_id == user_id, Conversation.peer_id == peer_id)
+            .values(unread_count=0)
+        )
+
+    def get_messages(self, user_id, other_user_id, since=None, until=None):
+        """Get the messages exchanged between two users, oldest first, optionally within a time range"""
+        db = self._db(user_id, other_user_id)
+        try:
+            messages = db.execute(self._history_statement(user_id, other_user_id, since, until))
+            return [self._format_message(msg) for msg in messages]
+        finally:
+            db.close()
+
+    def iter_messages(self, user_id, other_user_id, batch_size=500, since=None):
+        """
+        Yield the messages between two users one at a time, oldest first
+        Rows are fetched in batches through a server-side cursor where the
+        driver supports one, so memory stays flat however long the history is
+        """
+        db = self._db(user_id, other_user_id)
+        try:
+            rows = db.execute(
+                self._history_statement(user_id, other_user_id, since).execution_options(yield_per=batch_size)
+            )
+            for msg in rows:
+                yield self._format_message(msg)
+        finally:
+            db.close()
+
+    def get_conversation_state(self, user_id, other_user_id):
+        """
+        Get the newest message id and time, and the version, of a conversation from its index row
+        A primary-key probe, cheap enough to validate cached histories
+        """
+        db = self._db(user_id, other_user_id)
+        try:
+            row = db.query(Conversation.last_message_id, Conversation.last_message_at, Conversation.version).filter(
+                Conversation.owner_id == user_id,
+                Conversation.peer_id == other_user_id
+            ).first()
+            return self._conversation_state(row)
+        finally:
+            db.close()
+
+    def get_conversations(self, user_id, limit=None, before=None):
+        """
+        Get a page of the user's conversations, most recently active first
+        `before` is the previous page's next_cursor, decoded by decode_conversations_cursor
+        """
+        limit = self._page_limit(limit)
+
+        if self.shards:
+            return self._conversations_page(self._sharded_conversations(user_id, limit, before), limit)
+
+        db = get_db()
+        try:
+            rows = db.execute(self._conversations_statement(user_id, limit, before)).all()
+            return self._conversations_page(rows, limit)
+        finally:
+            db.close()
+
+    def _sharded_conversations(self, user_id, limit, before):
+        """Read an inbox page from every shard and name its peers from the main database"""
+        pages = []
+        for name in self.shards.names:
+            db = self.shards.session(name)
+            try:
+                pages.append(db.execute(self._conversations_statement(user_id, limit, before, with_names=False)).scalars().all())
+            finally:
+                db.close()
+
+        conversations = self._newest_conversations(pages, limit)
+        if not conversations:
+            return []
+
+        db = get_db()
+        try:
+            names = dict(db.execute(self._display_names_statement(conversations)).all())
+            return [(conversation, names.get(conversation.peer_id)) for conversation in conversations]
+        finally:
+            db.close()
+
+    def mark_conversation_read(self, user_id, peer_id):
+        """Reset the user's unread counter for a conversation"""
+        db = self._db(user_id, peer_id)
+        try:
+            result = db.execute(self._mark_read_statement(user_id, peer_id))
+            db.commit()
+            return result.rowcount > 0
+        except SQLAlchemyError:
+            db.rollback()
+            return False
+        finally:
+            db.close()
+
+    def backfill_conversations(self):
+        """
+        Build the conversation index from existing messages, on each database whose index is empty
+        Historical messages are treated as read
+        Returns the number of conversation rows created
+        """
+        if not self.shards:
+            return self._backfill_conversations(get_db())
+        return sum(self._backfill_conversations(self.shards.session(name)) for name in self.shards.names)
+
+    def _backfill_conversations(self, db):
+        """Build the conversation index of one database from its messages"""
+        try:
+            if db.query(Conversation.owner_id).first() is not None:
+                return 0
+
+            latest = {}  # (owner_id, peer_id) -> (message_id, created_at)
+            rows = db.query(
+                Message.id, Message.sender_id, Message.recipient_id, Message.created_at
+            ).order_by(Message.created_at).yield_per(1000)
+
+            for message_id, sender_id, recipient_id, created_at in rows:
+                latest[(sender_id, recipient_id)] = (message_id, created_at)
+                latest[(recipient_id, sender_id)] = (message_id, created_at)
+
+            db.bulk_insert_mappings(Conversation, [{
+                'owner_id': owner_id,
+                'peer_id': peer_id,
+                'last_message_id': message_id,
+                'last_message_at': created_at,
+                'unread_count': 0
+            } for (owner_id, peer_id), (message_id, created_at) in latest.items()])
+            db.commit()
+
+            return len(latest)
+
+        except SQLAlchemyError as e:
+            db.rollback()
+            raise e
+        finally:
+            db.close()
+
+
+class AsyncMessageManager(MessageManager):
+    """
+    Asyncio variant of MessageManager for the ASGI server.
+    Requires a dialect with ON CONFLICT support (SQLite or PostgreSQL),
+    which covers every async driver in models.ASYNC_DRIVERS.
+    """
+
+    def _async_db(self, user_id, other_user_id):
+        """Get an async database session on the database holding a conversation"""
+        return self.shards.async_session_for(user_id, other_user_id) if self.shards else get_async_db()
+
+    async def store_message(self, sender_id, recipient_id, encrypted_content, encrypted_key, signature, message_id=None, suite=CryptoManager.LEGACY_SUITE):
+        """Store an encrypted message idempotently and update the conversation index"""
+        if message_id:
+            ack = self._recent_acks.get((sender_id, message_id))
+            if ack:
+                return dict(ack, duplicate=True)
+
+        async with self._async_db(sender_id, recipient_id) as db:
+            insert = _dialect_insert(db)
+            message = self._new_message(sender_id, recipient_id, encrypted_content, encrypted_key, signature, message_id, suite)
+
+            try:
+                inserted = True
+                if PARTITION_MESSAGES:
+                    inserted = (await db.execute(self._claim_statement(insert, message))).rowcount > 0
+                if inserted:
+                    result = await db.execute(self._message_insert_statement(insert, message))
+                    inserted = result.rowcount > 0
+
+                if inserted:
+                    for stmt in self._conversation_upsert_statements(insert, message):
+                        await db.execute(stmt)
+                    await db.commit()
+                    if self.activity:
+                        self.activity.record_message(sender_id, message.created_at)
+                    ack = {'id': message.id, 'created_at': message.created_at}
+                    duplicate = False
+                else:
+                    existing = (await db.execute(self._existing_message_statement(message.id))).first()
+                    ack = self._duplicate_ack(message, existing)
+                    duplicate = True
+
+            except SQLAlchemyError as e:
+                await db.rollback()
+                raise e
+
+        if message_id:
+            self._recent_acks.add((sender_id, message_id), ack)
+
+        return dict(ack, duplicate=duplicate)
+
+    async def get_messages(self, user_id, other_user_id, since=None, until=None):
+        """Get the messages exchanged between two users, oldest first, optionally within a time range"""
+        async with self._async_db(user_id, other_user_id) as db:
+            messages = await db.execute(self._history_statement(user_id, other_user_id, since, until))
+            return [self._format_message(msg) for msg in messages]
+
+    async def iter_messages(self, user_id, other_user_id, batch_size=500, since=None):
+        """Yield the messages between two users one at a time, oldest first, from a streamed result"""
+        async with self._async_db(user_id, other_user_id) as db:
+            rows = await db.stream(
+                self._history_statement(user_id, other_user_id, since).execution_options(yield_per=batch_size)
+            )
+            async for msg in rows:
+                yield self._format_message(msg)
+
+    async def get_conversation_state(self, user_id, other_user_id):
+        """Get the newest message id and time between two users from the conversation index"""
+        async with self._async_db(user_id, other_user_id) as db:
+            row = (await db.execute(
+                select(Conversation.last_message_id, Conversation.last_message_at, Conversation.version).where(
+                    Conversation.owner_id == user_id,
+                    Conversation.peer_id == other_user_id
+                )
+            )).first()
+            return self._conversation_state(row)
+
+    async def get_conversations(self, user_id, limit=None, before=None):
+        """Get a page of the user's conversations, most recently active first"""
+        limit = self._page_limit(limit)
+
+        if self.shards:
+            return self._conversations_page(await self._sharded_conversations(user_id, limit, before), limit)
+
+        async with get_async_db() as db:
+            rows = (await db.execute(self._conversations_statement(user_id, limit, before))).all()
+            return self._conversations_page(rows, limit)
+
+    async def _shard_conversations(self, name, user_id, limit, before):
+        """Read an inbox page from one shard"""
+        async with self.shards.async_session(name) as db:
+            return (await db.execute(self._conversations_statement(user_id, limit, before, with_names=False))).scalars().all()
+
+    async def _sharded_conversations(self, user_id, limit, before):
+        """Read an inbox page from every shard concurrently and name its peers from the main database"""
+        pages = await asyncio.gather(*(
+            self._shard_conversations(name, user_id, limit, before) for name in self.shards.names
+        ))
+
+        conversations = self._newest_conversations(pages, limit)
+        if not conversations:
+            return []
+
+        async with get_async_db() as db:
+            names = dict((await db.execute(self._display_names_statement(conversations))).all())
+            return [(conversation, names.get(conversation.peer_id)) for conversation in conversations]
+
+    async def mark_conversation_read(self, user_id, peer_id):
+        """Reset the user's unread counter for a conversation"""
+        async with self._async_db(user_id, peer_id) as db:
+            try:
+                result = await db.execute(self._mark_read_statement(user_id, peer_id))
+                await db.commit()
+                return result.rowcount > 0
+            except SQLAlchemyError:
+                await db.rollback()
+                return False
\ No newline at end of file
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Bulk copy tool for the Zecret database.
+Copies users, messages (with their claimed ids) and conversations between any two database URLs
+(e.g. SQLite -> Postgres for a cutover, or a seeded file into a perf
+environment) in primary-key order, one chunk per transaction.
+
+- Uses Postgres COPY when the target is Postgres, executemany otherwise
+- Resumable: progress is checkpointed to a state file after every chunk,
+  and each chunk first clears its key range on the target, so re-running
+  after an interruption never duplicates rows
+- Creates the target's monthly message partitions first when
+  MESSAGE_PARTITIONING=monthly, from the oldest source message on
+- Verifies row counts and checksums of both sides once copying is done
+
+Usage: python migrate_db.py --source URL --target URL [--chunk-size N]
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, select, and_, func, tuple_
+from models import Base, Message
+from partitions import ensure_partitions, is_partitioned
+
+TABLES = ['users', 'messages', 'message_ids', 'conversations']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Copy the Zecret tables between two databases")
+    parser.add_argument('--source', required=True, help="Source DATABASE_URL")
+    parser.add_argument('--target', required=True, help="Target DATABASE_URL")
+    parser.add_argument('--tables', default=','.join(TABLES), help="Comma-separated tables to copy")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="Rows per transaction")
+    parser.add_argument('--state-file', default='migrate_state.json', help="Checkpoint file used to resume")
+    parser.add_argument('--no-verify', action='store_true', help="Skip the checksum verification")
+    return parser.parse_args()
+
+def normalize_url(url):
+    if url.startswith('postgres:'):
+        return url.replace('postgres:', 'postgresql:', 1)
+    return url
+
+def load_state(path, source, target):
+    """Load the checkpoint for this source/target pair, or start fresh"""
+    run_id = hashlib.sha256(f"{source}|{target}".encode()).hexdigest()
+    if os.path.exists(path):
+        with open(path) as f:
+            state = json.load(f)
+        if state.get('run_id') == run_id:
+            return state
+    return {'run_id': run_id, 'tables': {}}
+
+def encode_key(key):
+    """Make a primary key JSON-serializable, tagging datetimes so they are parsed back on resume"""
+    return [{'datetime': value.isoformat()} if isinstance(value, datetime) else value for value in key]
+
+def decode_key(key):
+    """Parse a primary key written by encode_key"""
+    return [datetime.fromisoformat(value['datetime']) if isinstance(value, dict) else value for value in key]
+
+def save_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def key_after(pk_columns, last_key):
+    """Filter matching rows whose primary key sorts after last_key"""
+    if len(pk_columns) == 1:
+        return pk_columns[0] > last_key[0]
+    return tuple_(*pk_columns) > tuple_(*last_key)
+
+def key_at_most(pk_columns, key):
+    """Filter matching rows whose primary key sorts at or before key"""
+    if len(pk_columns) == 1:
+        return pk_columns[0] <= key[0]
+    return tuple_(*pk_columns) <= tuple_(*key)
+
+def copy_text_value(value):
+    """Format a value for Postgres COPY text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if hasattr(value, 'isoformat'):
+        return value.isoformat(' ')
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+def insert_chunk(conn, table, rows):
+    """Insert rows into the target, through COPY on Postgres and executemany elsewhere"""
+    if conn.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(copy_text_value(value) for value in row) + '\n')
+        buffer.seek(0)
+
+        columns = ', '.join(f'"{column.name}"' for column in table.columns)
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY "{table.name}" ({columns}) FROM STDIN', buffer)
+        finally:
+            cursor.close()
+        return
+
+    names = [column.name for column in table.columns]
+    conn.execute(table.insert(), [dict(zip(names, row)) for row in rows])
+
+def copy_table(source, target, table, chunk_size, state, state_file):
+    """Copy one table chunk by chunk, resuming from its checkpoint"""
+    progress = state['tables'].setdefault(table.name, {'last_key': None, 'rows': 0, 'done': False})
+    if progress['done']:
+        print(f"{table.name}: already copied ({progress['rows']} rows)")
+        return
+
+    pk_columns = list(table.primary_key.columns)
+    copied = 0
+    start = time.perf_counter()
+
+    while True:
+        query = select(*table.columns).order_by(*pk_columns).limit(chunk_size)
+        last_key = decode_key(progress['last_key']) if progress['last_key'] is not None else None
+        if last_key is not None:
+            query = query.where(key_after(pk_columns, last_key))
+
+        with source.connect() as conn:
+            rows = [tuple(row) for row in conn.execute(query)]
+
+        if not rows:
+            break
+
+        pk_indexes = [list(table.columns).index(column) for column in pk_columns]
+        chunk_last_key = [rows[-1][i] for i in pk_indexes]
+
+        with target.begin() as conn:
+            # Clear the chunk's key range first, so a chunk retried after a crash is not duplicated
+            conditions = [key_at_most(pk_columns, chunk_last_key)]
+            if last_key is not None:
+                conditions.append(key_after(pk_columns, last_key))
+            conn.execute(table.delete().where(and_(*conditions)))
+
+            insert_chunk(conn, table, rows)
+
+        progress['last_key'] = encode_key(chunk_last_key)
+        progress['rows'] += len(rows)
+        save_state(state_file, state)
+
+        copied += len(rows)
+        elapsed = time.perf_counter() - start
+        print(f"{table.name}: {progress['rows']} rows ({copied / elapsed:.0f} rows/s)", end='\r')
+
+    progress['done'] = True
+    save_state(state_file, state)
+
+    elapsed = time.perf_counter() - start
+    rate = copied / elapsed if elapsed else 0
+    print(f"{table.name}: copied {copied} rows in {elapsed:.1f}s ({rate:.0f} rows/s), {progress['rows']} total")
+
+def prepare_target(source, target):
+    """
+    Create the tables on the target, and when messages is partitioned there
+    (MESSAGE_PARTITIONING=monthly), its monthly partitions from the oldest
+    source message on, since a partitioned table without partitions rejects every row
+    """
+    Base.metadata.create_all(bind=target)
+    if target.dialect.name != 'postgresql':
+        return
+
+    with target.begin() as conn:
+        if not is_partitioned(conn):
+            return
+        with source.connect() as source_conn:
+            oldest = source_conn.execute(select(func.min(Message.created_at))).scalar()
+        created = ensure_partitions(conn, since=oldest)
+    if created:
+        print(f"messages: created {len(created)} partitions on the target")
+
+def table_checksum(engine, table, chunk_size):
+    """
+    Row count and checksum of a table
+    The checksum sums per-row SHA-256 digests, so it does not depend on
+    either database's collation or scan order
+    """
+    checksum = 0
+    count = 0
+
+    with engine.connect() as conn:
+        rows = conn.execution_options(yield_per=chunk_size).execute(select(*table.columns))
+        for row in rows:
+            row_digest = hashlib.sha256(json.dumps([copy_text_value(value) for value in row]).encode()).digest()
+            checksum = (checksum + int.from_bytes(row_digest[:16], 'big')) % (1 << 128)
+            count += 1
+
+    return count, f"{checksum:032x}"
+
+def verify_table(source, target, table, chunk_size):
+    """Compare a table's row count and checksum between source and target"""
+    source_count, source_digest = table_checksum(source, table, chunk_size)
+    target_count, target_digest = table_checksum(target, table, chunk_size)
+
+    if (source_count, source_digest) == (target_count, target_digest):
+        print(f"{table.name}: verified {source_count} rows (checksum {source_digest[:16]})")
+        return True
+
+    print(f"{table.name}: MISMATCH source {source_count} rows ({source_digest[:16]}), "
+          f"target {target_count} rows ({target_digest[:16]})")
+    return False
+
+if __name__ == "__main__":
+    args = parse_args()
+    source_url = normalize_url(args.source)
+    target_url = normalize_url(args.target)
+
+    source = create_engine(source_url)
+    target = create_engine(target_url)
+
+    prepare_target(source, target)
+
+    requested = [name.strip() for name in args.tables.split(',') if name.strip()]
+    tables = [table for table in Base.metadata.sorted_tables if table.name in requested]
+
+    state = load_state(args.state_file, source_url, target_url)
+
+    for table in tables:
+        copy_table(source, target, table, args.chunk_size, state, args.state_file)
+
+    if not args.no_verify:
+        results = [verify_table(source, target, table, args.chunk_size) for table in tables]
+        if not all(results):
+            raise SystemExit("Verification failed")
+
+    print("Migration completed successfully!")
@@ -1,10 +1,11 @@
-
 import os
-from sqlalchemy import create_engine, Column, String, Text, DateTime, Boolean, ForeignKey
+from sqlalchemy import create_engine, make_url, func, inspect, text, Column, String, Text, DateTime, Boolean, Integer, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.schema import CreateIndex
 import datetime
 from dotenv import load_dotenv
+from crypto import CryptoManager
 
 # Load environment variables
 load_dotenv()
@@ -19,6 +20,12 @@ if DATABASE_URL and DATABASE_URL.startswith('postgres:'):
 print(f"Using DATABASE_URL: {DATABASE_URL}")
 print(f"Using DATABASE_URL: {DATABASE_URL}")
 
+# Monthly range partitioning of messages on created_at (Postgres only, see partitions.py)
+PARTITION_MESSAGES = (
+    os.getenv('MESSAGE_PARTITIONING', '').lower() == 'monthly'
+    and make_url(DATABASE_URL).get_backend_name() == 'postgresql'
+)
+
 # Create SQLAlchemy engine and session
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -31,13 +38,35 @@ class User(Base):
     __tablename__ = "users"
     
     id = Column(String(36), primary_key=True)  # UUID
-    public_key = Column(Text, nullable=False)  # Public key (PEM format)
+    public_key = Column(Text, nullable=False)  # Public key (PEM, or JSON for v2 suites)
+    crypto_suite = Column(String(32), nullable=False, default=CryptoManager.LEGACY_SUITE, server_default=CryptoManager.LEGACY_SUITE)
     access_code_hash = Column(String(128), nullable=False, unique=True)  # Hashed access code
     display_name = Column(String(50), nullable=True)  # Optional display name
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     last_active = Column(DateTime, default=datetime.datetime.utcnow)
     is_online = Column(Boolean, default=False)
 
+def display_name_key(dialect_name):
+    """
+    Sort key for directory search: the lowercased display name, compared
+    bytewise so that prefix matches form one contiguous index range
+    (SQLite's default collation already is bytewise)
+    """
+    key = func.lower(User.display_name)
+    return key.collate('C') if dialect_name == 'postgresql' else key
+
+def lower_display_name(dialect_name, text):
+    """Lowercase text the way the dialect's lower() does (SQLite's only folds ASCII)"""
+    if dialect_name == 'sqlite':
+        return text.translate(_ASCII_LOWER)
+    return text.lower()
+
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+# Ordered index serving prefix search and cursor pagination over the user directory
+Index('ix_users_display_name_key_pg', display_name_key('postgresql'), User.id).ddl_if(dialect='postgresql')
+Index('ix_users_display_name_key', display_name_key('sqlite'), User.id).ddl_if(dialect='sqlite')
+
 class Message(Base):
     """Encrypted message model"""
     __tablename__ = "messages"
@@ -48,15 +77,144 @@ class Message(Base):
     encrypted_content = Column(Text, nullable=False)  # Encrypted message content
     encrypted_key = Column(Text, nullable=False)  # Encrypted AES key
     signature = Column(Text, nullable=False)  # Digital signature
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    crypto_suite = Column(String(32), nullable=False, default=CryptoManager.LEGACY_SUITE, server_default=CryptoManager.LEGACY_SUITE)
+    # Partitioned tables need the partition key in their primary key
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, primary_key=PARTITION_MESSAGES)
     
     # Relationship to users
     sender = relationship("User", foreign_keys=[sender_id], backref="sent_messages")
     recipient = relationship("User", foreign_keys=[recipient_id], backref="received_messages")
+    
+    __table_args__ = (
+        # Serves history queries in either direction, time-ordered
+        Index("ix_messages_sender_recipient_created_at", "sender_id", "recipient_id", "created_at"),
+        {'postgresql_partition_by': 'RANGE (created_at)'} if PARTITION_MESSAGES else {},
+    )
+
+class MessageId(Base):
+    """
+    Claimed message id, written with every message when messages is partitioned.
+    A partitioned table's primary key must include created_at, so this
+    unpartitioned table is what keeps ids unique and stores idempotent.
+    """
+    __tablename__ = "message_ids"
+    
+    id = Column(String(36), primary_key=True)
+    sender_id = Column(String(36), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+class Conversation(Base):
+    """
+    Denormalized inbox entry, one row per participant of a conversation.
+    Maintained incrementally whenever a message is stored.
+    """
+    __tablename__ = "conversations"
+    
+    owner_id = Column(String(36), ForeignKey("users.id"), primary_key=True)  # User whose inbox this row belongs to
+    peer_id = Column(String(36), ForeignKey("users.id"), primary_key=True)  # The other participant
+    last_message_id = Column(String(36), nullable=False)
+    last_message_at = Column(DateTime, nullable=False)
+    unread_count = Column(Integer, nullable=False, default=0)
+    # Bumped by every stored message, including late ones that do not move last_message_at
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    
+    __table_args__ = (
+        # Serves the inbox listing and its keyset: WHERE owner_id = ? ORDER BY last_message_at DESC, peer_id DESC
+        Index("ix_conversations_owner_last_message_at_peer", "owner_id", "last_message_at", "peer_id"),
+    )
+
+class ActivityRollup(Base):
+    """
+    Precomputed activity count for one metric and time bucket.
+    Maintained in batches by activity.py, so dashboards never scan messages or users.
+    """
+    __tablename__ = "activity_rollups"
+    
+    metric = Column(String(32), primary_key=True)  # e.g. messages (hourly buckets), active_users (daily)
+    bucket = Column(DateTime, primary_key=True)  # Start of the hour or day
+    count = Column(Integer, nullable=False, default=0)
+
+class DailyActiveUser(Base):
+    """Users seen on a day, so the active_users rollup counts each user once; only recent days are kept"""
+    __tablename__ = "daily_active_users"
+    
+    day = Column(DateTime, primary_key=True)
+    user_id = Column(String(36), primary_key=True)
+
+# Async drivers used by the asyncio server (asgi.py)
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+_async_engine = None
+_async_session_factory = None
+
+def get_async_engine():
+    """
+    Get the async engine for the asyncio server
+    Created on first use so the eventlet deployment never needs the async drivers
+    """
+    global _async_engine, _async_session_factory
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        
+        url = make_url(DATABASE_URL)
+        _async_engine = create_async_engine(url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]))
+        _async_session_factory = async_sessionmaker(_async_engine, autoflush=False, expire_on_commit=False)
+    return _async_engine
+
+def get_async_db():
+    """Get an async database session, to be used as `async with get_async_db() as db:`"""
+    get_async_engine()
+    return _async_session_factory()
+
+async def init_async_db():
+    """Create all tables through the async engine"""
+    async with get_async_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
+
+def _create_missing_columns(conn, metadata=Base.metadata):
+    """
+    Add columns added to tables that already existed, which create_all skips
+    Such columns need a server default to fill the existing rows
+    """
+    inspector = inspect(conn)
+    ddl = conn.dialect.ddl_compiler(conn.dialect, None)
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                conn.execute(text(
+                    f"ALTER TABLE {ddl.preparer.format_table(table)} ADD COLUMN {ddl.get_column_specification(column)}"
+                ))
+
+def _create_missing_indexes(conn, metadata=Base.metadata):
+    """Create indexes added to tables that already existed, which create_all skips"""
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            # Invoked as a DDL listener so each index's ddl_if dialect is honoured
+            CreateIndex(index, if_not_exists=True)(index, conn)
+
+# Indexes replaced by wider ones, dropped from existing databases
+_SUPERSEDED_INDEXES = ['ix_conversations_owner_last_message_at']
+
+def _drop_superseded_indexes(conn):
+    """Drop indexes that a wider index has replaced"""
+    for name in _SUPERSEDED_INDEXES:
+        conn.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
 
 def init_db():
-    """Initialize the database by creating all tables"""
+    """Initialize the database by creating all tables and indexes"""
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _create_missing_columns(conn)
+        _create_missing_indexes(conn)
+        _drop_superseded_indexes(conn)
 
 def get_db():
     """Get a database session"""
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Partition maintenance for the messages table.
+With MESSAGE_PARTITIONING=monthly on Postgres, messages is range-partitioned
+by created_at into one table per month (messages_YYYY_MM) plus a DEFAULT
+partition. The servers keep the upcoming months created and, when
+MESSAGE_RETENTION_MONTHS is set, drop whole months past retention.
+
+Usage:
+  python partitions.py list
+  python partitions.py ensure [--since YYYY-MM] [--months-ahead N]
+  python partitions.py drop-before YYYY-MM
+  python partitions.py convert      # rebuild an existing unpartitioned messages table
+"""
+
+import argparse
+import re
+from datetime import datetime
+
+from sqlalchemy import text, delete
+from models import engine, Message, MessageId, PARTITION_MESSAGES
+
+MONTHS_AHEAD = 2
+
+_PARTITION_NAME = re.compile(r'^messages_(\d{4})_(\d{2})$')
+
+def month_start(value):
+    """First instant of the month containing value"""
+    return datetime(value.year, value.month, 1)
+
+def add_months(month, count):
+    """The month count months after (or before) the given month start"""
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+def is_partitioned(conn):
+    """Check whether the messages table is already a partitioned table"""
+    kind = conn.execute(text(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass('messages')"
+    )).scalar()
+    return kind == 'p'
+
+def list_partitions(conn):
+    """Get the names of the messages table's partitions"""
+    rows = conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'messages' ORDER BY child.relname"
+    ))
+    return [row[0] for row in rows]
+
+def _default_has_rows(conn, month):
+    """Check whether the DEFAULT partition holds rows of a month"""
+    return conn.execute(text(
+        "SELECT 1 FROM messages_default WHERE created_at >= :start AND created_at < :end LIMIT 1"
+    ), {'start': month, 'end': add_months(month, 1)}).first() is not None
+
+def _move_from_default(conn, month):
+    """Route a month's rows from the detached DEFAULT partition back through messages"""
+    columns = ', '.join(f'"{column.name}"' for column in Message.__table__.columns)
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    conn.execute(text(
+        f"INSERT INTO messages ({columns}) SELECT {columns} FROM messages_default "
+        "WHERE created_at >= :start AND created_at < :end"
+    ), bounds)
+    conn.execute(text("DELETE FROM messages_default WHERE created_at >= :start AND created_at < :end"), bounds)
+
+def ensure_partitions(conn, since=None, months_ahead=MONTHS_AHEAD):
+    """
+    Create the monthly partitions from since (default: this month) through
+    months_ahead months from now, and the DEFAULT partition
+    Postgres refuses a partition whose range has rows in the DEFAULT one, so
+    rows that landed there while maintenance lagged are moved into the new
+    partitions, with the DEFAULT partition detached meanwhile
+    Returns the names of the partitions created
+    """
+    existing = set(list_partitions(conn))
+    current = month_start(datetime.utcnow())
+    month = month_start(since) if since else current
+    last = add_months(current, months_ahead)
+
+    missing = []
+    while month <= last:
+        if partition_name(month) not in existing:
+            missing.append(month)
+        month = add_months(month, 1)
+
+    stranded = [month for month in missing if 'messages_default' in existing and _default_has_rows(conn, month)]
+    if stranded:
+        conn.execute(text('ALTER TABLE messages DETACH PARTITION messages_default'))
+
+    created = []
+    for month in missing:
+        name = partition_name(month)
+        conn.execute(text(
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF messages '
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')"
+        ))
+        created.append(name)
+
+    if stranded:
+        for month in stranded:
+            _move_from_default(conn, month)
+        conn.execute(text('ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT'))
+
+    # Catches rows outside every monthly range instead of failing the insert
+    if 'messages_default' not in existing:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT'))
+        created.append('messages_default')
+
+    return created
+
+def drop_partitions_before(conn, cutoff):
+    """
+    Drop the monthly partitions that end on or before cutoff's month
+    Retention costs one DROP TABLE per month instead of a large DELETE
+    Returns the names of the partitions dropped
+    """
+    cutoff = month_start(cutoff)
+    dropped = []
+
+    for name in list_partitions(conn):
+        match = _PARTITION_NAME.match(name)
+        if match and datetime(int(match.group(1)), int(match.group(2)), 1) < cutoff:
+            conn.execute(text(f'DROP TABLE "{name}"'))
+            dropped.append(name)
+
+    # Their claimed ids go too, so message_ids stays as small as the table it guards
+    conn.execute(delete(MessageId).where(MessageId.created_at < cutoff))
+    return dropped
+
+def maintain_partitions(retention_months=None):
+    """Create the upcoming partitions and drop those past retention, in one transaction"""
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            raise RuntimeError("messages is not partitioned yet; run 'python partitions.py convert' first")
+        created = ensure_partitions(conn)
+        dropped = []
+        if retention_months:
+            cutoff = add_months(month_start(datetime.utcnow()), -retention_months)
+            dropped = drop_partitions_before(conn, cutoff)
+    return created, dropped
+
+def convert_table(conn):
+    """
+    Rebuild an existing unpartitioned messages table as a partitioned one
+    Runs in the caller's transaction; writers are blocked until it commits
+    Returns the number of rows moved
+    """
+    conn.execute(text('ALTER TABLE messages RENAME TO messages_unpartitioned'))
+    conn.execute(text('ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey'))
+    conn.execute(text(
+        'ALTER INDEX IF EXISTS ix_messages_sender_recipient_created_at '
+        'RENAME TO ix_messages_unpartitioned_sender_recipient_created_at'
+    ))
+
+    Message.__table__.create(conn)
+
+    oldest = conn.execute(text('SELECT min(created_at) FROM messages_unpartitioned')).scalar()
+    ensure_partitions(conn, since=oldest)
+
+    columns = ', '.join(f'"{column.name}"' for column in Message.__table__.columns)
+    moved = conn.execute(text(
+        f'INSERT INTO messages ({columns}) SELECT {columns} FROM messages_unpartitioned'
+    )).rowcount
+
+    # The partitioned key no longer keeps ids unique, message_ids does
+    MessageId.__table__.create(conn, checkfirst=True)
+    conn.execute(text(
+        'INSERT INTO message_ids (id, sender_id, created_at) '
+        'SELECT id, sender_id, created_at FROM messages_unpartitioned ON CONFLICT (id) DO NOTHING'
+    ))
+    conn.execute(text('DROP TABLE messages_unpartitioned'))
+
+    return moved
+
+def parse_month(value):
+    try:
+        return datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected YYYY-MM, got {value!r}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of the messages table")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('list', help="List the existing partitions")
+
+    ensure = commands.add_parser('ensure', help="Create missing monthly partitions")
+    ensure.add_argument('--since', type=parse_month, help="First month to create (default: this month)")
+    ensure.add_argument('--months-ahead', type=int, default=MONTHS_AHEAD, help="Months to create ahead of now")
+
+    drop = commands.add_parser('drop-before', help="Drop the monthly partitions before a month")
+    drop.add_argument('month', type=parse_month)
+
+    commands.add_parser('convert', help="Convert an existing messages table to a partitioned one")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if not PARTITION_MESSAGES:
+        raise SystemExit("Partitioning is off: set MESSAGE_PARTITIONING=monthly with a Postgres DATABASE_URL")
+
+    with engine.begin() as conn:
+        if args.command == 'convert':
+            if is_partitioned(conn):
+                raise SystemExit("messages is already partitioned")
+            moved = convert_table(conn)
+            print(f"Moved {moved} messages into {len(list_partitions(conn))} partitions")
+
+        elif not is_partitioned(conn):
+            raise SystemExit("messages is not partitioned yet; run 'python partitions.py convert' first")
+
+        elif args.command == 'list':
+            for name in list_partitions(conn):
+                print(name)
+
+        elif args.command == 'ensure':
+            created = ensure_partitions(conn, since=args.since, months_ahead=args.months_ahead)
+            print(f"Created {len(created)} partitions: {', '.join(created) or 'none'}")
+
+        elif args.command == 'drop-before':
+            dropped = drop_partitions_before(conn, args.month)
+            print(f"Dropped {len(dropped)} partitions: {', '.join(dropped) or 'none'}")
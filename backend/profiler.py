@@ -0,0 +1,130 @@
+import gc
+import inspect
+import os
+import sys
+import threading
+from collections import Counter
+
+# The sampler must run on a real OS thread even when eventlet has monkey-patched
+# threading, otherwise it would only ever see its own green thread
+try:
+    from eventlet.patcher import original
+    _threading = original('threading')
+    _time = original('time')
+except ImportError:
+    import threading as _threading
+    import time as _time
+
+try:
+    from greenlet import greenlet as _greenlet
+except ImportError:
+    _greenlet = None
+
+class SamplingProfiler:
+    """
+    On-demand stack sampler producing collapsed stacks for flame graphs.
+    Nothing is hooked while it is idle; a profile runs a background OS
+    thread for a bounded window. Each stack is prefixed with the REST route
+    or socket event whose handler is on it, so time is attributed per handler.
+    """
+
+    def __init__(self, handlers=None):
+        """
+        Initialize the profiler
+        handlers is a callable returning {label: function}, used for attribution
+        """
+        self._handlers = handlers
+        self._lock = _threading.Lock()
+        self._thread = None
+        self._stop = None
+        self._stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.duration = 0.0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def _handler_labels(self):
+        """Map each handler's code object to its label"""
+        if not self._handlers:
+            return {}
+        return {inspect.unwrap(function).__code__: label for label, function in self._handlers().items()}
+
+    def start(self, duration, interval=0.005, include_waiting=False):
+        """
+        Start sampling every interval seconds for at most duration seconds
+        include_waiting also samples suspended green threads, at the cost of a
+        heap walk per sample
+        Raises RuntimeError if a profile is already running
+        """
+        with self._lock:
+            if self._thread is not None:
+                raise RuntimeError("A profile is already running")
+
+            self._stacks = Counter()
+            self.samples = 0
+            self.started_at = _time.time()
+            self.duration = 0.0
+            self._stop = _threading.Event()
+            self._thread = _threading.Thread(
+                target=self._run,
+                args=(duration, interval, include_waiting, self._handler_labels()),
+                name='sampling-profiler',
+                daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Stop sampling and return the profile in collapsed-stack format"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return ''
+            self._stop.set()
+        thread.join()
+        return self.collapsed()
+
+    def collapsed(self):
+        """The last profile as 'frame;frame;frame count' lines, heaviest first"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def _run(self, duration, interval, include_waiting, labels):
+        own_ident = _threading.get_ident()
+        start = _time.perf_counter()
+        deadline = start + duration
+
+        while not self._stop.wait(interval) and _time.perf_counter() < deadline:
+            # The original threading module only knows the threads it started itself
+            names = {
+                thread.ident: thread.name
+                for module in (threading, _threading) for thread in module.enumerate()
+            }
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    self._record(frame, f"thread:{names.get(ident, ident)}", labels)
+
+            if include_waiting and _greenlet is not None:
+                for obj in gc.get_objects():
+                    if isinstance(obj, _greenlet) and obj.gr_frame is not None:
+                        self._record(obj.gr_frame, 'greenlet:waiting', labels)
+
+            self.samples += 1
+
+        self.duration = _time.perf_counter() - start
+
+    def _record(self, frame, default_label, labels):
+        """Count one stack, rooted at the handler it belongs to if any"""
+        stack = []
+        label = default_label
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}")
+            if code in labels:
+                label = labels[code]
+            frame = frame.f_back
+
+        stack.append(label)
+        stack.reverse()
+        self._stacks[';'.join(stack)] += 1
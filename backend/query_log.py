@@ -0,0 +1,167 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+_WHITESPACE = re.compile(r'\s+')
+# IN lists and multi-row VALUES vary in length with their parameters
+_PARAMETER_LIST = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|\$\d+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|\$\d+)\s*\)')
+_EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')
+
+def normalize_statement(statement):
+    """Collapse a statement's whitespace and parameter lists, so its variants aggregate together"""
+    return _PARAMETER_LIST.sub('(...)', _WHITESPACE.sub(' ', statement).strip())
+
+def parameter_shape(parameters, executemany=False):
+    """Describe bound parameters by type only, so no message content or secret reaches the log"""
+    if executemany:
+        rows = list(parameters)
+        return f"{len(rows)} x {parameter_shape(rows[0]) if rows else '()'}"
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + '}'
+    if isinstance(parameters, (list, tuple)):
+        return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+    return type(parameters).__name__
+
+def explain(dbapi_connection, dialect_name, statement, parameters):
+    """
+    Get a statement's query plan as text lines, without running the statement
+    Uses a separate cursor, so a pending result set is left untouched
+    """
+    if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+        return None
+
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect_name == 'sqlite' else 'EXPLAIN '
+    # On Postgres a failed statement aborts the transaction, so the EXPLAIN gets its own savepoint
+    savepoint = dialect_name != 'sqlite'
+    cursor = dbapi_connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT query_log_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT query_log_explain')
+            raise
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT query_log_explain')
+    finally:
+        cursor.close()
+
+    return [row[-1] if dialect_name == 'sqlite' else row[0] for row in rows]
+
+class QueryStats:
+    """
+    Per-statement latency statistics collected from SQLAlchemy engine events.
+    Statements are aggregated by normalized text. Those slower than slow_ms
+    are logged with their parameter shapes, and the first slow execution of
+    each statement has its query plan captured.
+    """
+
+    ORDERINGS = ('total_ms', 'mean_ms', 'max_ms', 'calls', 'slow_calls')
+
+    def __init__(self, slow_ms=200, log=print, max_statements=1000):
+        """Initialize the statistics"""
+        self.slow_ms = slow_ms
+        self.log = log
+        self.max_statements = max_statements
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._statements = {}  # normalized statement -> stats
+        self._normalized = OrderedDict()  # raw statement -> normalized, oldest first
+        self.dropped = 0
+
+    def attach(self, engine):
+        """Start timing every statement executed through engine (a sync Engine)"""
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._on_error)
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @staticmethod
+    def _on_error(context):
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is not None and context.connection.info.get('query_start'):
+            context.connection.info['query_start'].pop()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info['query_start'].pop()) * 1000
+        normalized = self._normalize(statement)
+
+        with self._lock:
+            stats = self._statements.get(normalized)
+            if stats is None:
+                if len(self._statements) >= self.max_statements:
+                    self.dropped += 1
+                    return
+                stats = self._statements[normalized] = {
+                    'statement': normalized,
+                    'calls': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'slow_calls': 0,
+                    'parameters': None,
+                    'plan': None
+                }
+
+            stats['calls'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+            slow = elapsed_ms >= self.slow_ms
+            if slow:
+                stats['slow_calls'] += 1
+                stats['parameters'] = parameter_shape(parameters, executemany)
+            needs_plan = slow and stats['plan'] is None and not executemany
+
+        if not slow:
+            return
+
+        if needs_plan:
+            try:
+                stats['plan'] = explain(conn.connection.dbapi_connection, conn.dialect.name, statement, parameters)
+            except Exception as e:
+                stats['plan'] = [f"EXPLAIN failed: {e}"]
+
+        self.log(f"Slow query ({elapsed_ms:.1f}ms): {normalized} parameters={stats['parameters']}")
+
+    def _normalize(self, statement):
+        """Normalize a statement, caching results since the same compiled strings recur"""
+        normalized = self._normalized.get(statement)
+        if normalized is None:
+            normalized = self._normalized[statement] = normalize_statement(statement)
+            if len(self._normalized) > self.max_statements * 4:
+                self._normalized.popitem(last=False)
+        return normalized
+
+    def top(self, limit=20, order_by='total_ms'):
+        """Get the statements with the highest order_by, one of ORDERINGS"""
+        with self._lock:
+            rows = [dict(stats, mean_ms=stats['total_ms'] / stats['calls']) for stats in self._statements.values()]
+
+        rows.sort(key=lambda row: row[order_by], reverse=True)
+        return rows[:limit]
+
+    def reset(self):
+        """Forget all statistics"""
+        with self._lock:
+            self._statements.clear()
+            self.dropped = 0
+            self.started_at = time.time()
+
+    def summary(self, limit=20, order_by='total_ms'):
+        """The top statements plus collection metadata"""
+        return {
+            'since': self.started_at,
+            'slow_ms': self.slow_ms,
+            'distinct_statements': len(self._statements),
+            'dropped_statements': self.dropped,
+            'statements': self.top(limit, order_by)
+        }
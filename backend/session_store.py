@@ -0,0 +1,140 @@
+import time
+from collections import OrderedDict
+
+class MemorySessionStore:
+    """
+    In-process session store (session_id -> user_id).
+    Entries expire with their JWT and the least recently used ones are
+    evicted once max_size is reached, so memory stays bounded. Pinned
+    sessions, those of connected sockets, are kept apart and never evicted;
+    they end when the socket disconnects or the JWT expires.
+    """
+
+    # Calls never block on I/O, so the asyncio server makes them inline
+    blocking = False
+
+    def __init__(self, max_size=100000):
+        """Initialize the session store"""
+        self.max_size = max_size
+        self._entries = OrderedDict()  # session_id -> (user_id, expires_at)
+        self._pinned = {}  # session_id -> (user_id, expires_at), outside the LRU
+        self.evictions = 0
+        self.expirations = 0
+
+    def set(self, session_id, user_id, expires_at, pinned=False):
+        """Store a session until expires_at (a Unix timestamp); pinned sessions are never evicted"""
+        if pinned:
+            self._pinned[session_id] = (user_id, expires_at)
+            return
+
+        self._entries[session_id] = (user_id, expires_at)
+        self._entries.move_to_end(session_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, session_id):
+        """Get the user ID of a live session, or None"""
+        entries = self._pinned if session_id in self._pinned else self._entries
+        entry = entries.get(session_id)
+        if entry is None:
+            return None
+
+        user_id, expires_at = entry
+        if expires_at <= time.time():
+            entries.pop(session_id, None)
+            self.expirations += 1
+            return None
+
+        if entries is self._entries:
+            self._entries.move_to_end(session_id)
+        return user_id
+
+    def pop(self, session_id):
+        """Remove a session, returning its user ID"""
+        entry = self._pinned.pop(session_id, None) or self._entries.pop(session_id, None)
+        return entry[0] if entry else None
+
+    def sweep(self):
+        """Drop all expired sessions; returns how many were removed"""
+        now = time.time()
+        expired = 0
+        for entries in (self._entries, self._pinned):
+            for session_id in [session_id for session_id, (_, expires_at) in entries.items() if expires_at <= now]:
+                del entries[session_id]
+                expired += 1
+
+        self.expirations += expired
+        return expired
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+
+    def stats(self):
+        """Size and eviction metrics"""
+        return {
+            'backend': 'memory',
+            'size': len(self),
+            'pinned': len(self._pinned),
+            'max_size': self.max_size,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+class RedisSessionStore:
+    """
+    Session store shared between workers, backed by Redis.
+    Keys carry the session's TTL, so Redis handles expiry itself;
+    size limits and eviction follow the server's maxmemory policy.
+    """
+
+    # Every call is a network round-trip, so the asyncio server makes them in a worker thread
+    blocking = True
+
+    def __init__(self, url, prefix='zecret:session:'):
+        """Connect to the Redis server at url"""
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def set(self, session_id, user_id, expires_at, pinned=False):
+        """
+        Store a session until expires_at (a Unix timestamp)
+        Pinned sessions need no bookkeeping here, since Redis only evicts keys
+        under memory pressure; run it with maxmemory-policy noeviction so it never does
+        """
+        ttl = max(1, int(expires_at - time.time()))
+        self._redis.set(self.prefix + session_id, user_id, ex=ttl)
+
+    def get(self, session_id):
+        """Get the user ID of a live session, or None"""
+        return self._redis.get(self.prefix + session_id)
+
+    def pop(self, session_id):
+        """Remove a session, returning its user ID"""
+        return self._redis.getdel(self.prefix + session_id)
+
+    def sweep(self):
+        """Expired keys are removed by Redis"""
+        return 0
+
+    def __len__(self):
+        return sum(1 for _ in self._redis.scan_iter(match=self.prefix + '*', count=1000))
+
+    def stats(self):
+        """Size and eviction metrics (evictions and expirations are server-wide)"""
+        info = self._redis.info('stats')
+        return {
+            'backend': 'redis',
+            'size': len(self),
+            'evictions': info.get('evicted_keys', 0),
+            'expirations': info.get('expired_keys', 0)
+        }
+
+def create_session_store(url=None, max_size=100000):
+    """Create the session store for a SESSION_STORE_URL (redis://...), or an in-memory one"""
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisSessionStore(url)
+    return MemorySessionStore(max_size=max_size)
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+Sharding of message storage by conversation.
+With MESSAGE_SHARDS set, each conversation (the sorted pair of its
+participants, as in the socket room names) lives on one of several
+databases, chosen by rendezvous hashing over the shard names: its messages
+and both of its conversation index rows, so storing a message is still a
+single transaction. Users stay on the main DATABASE_URL.
+
+MESSAGE_SHARDS is a comma-separated list of name=url entries, e.g.
+  MESSAGE_SHARDS=a=sqlite:///shard_a.db,b=sqlite:///shard_b.db
+Shards are identified by name, so URLs may change freely; adding or
+removing a shard moves only the conversations whose owner changes.
+
+Without MESSAGE_SHARDS, messages live on the main database, which the
+tools below treat as the single shard main=DATABASE_URL. Listing the main
+database explicitly (MESSAGE_SHARDS=main=<DATABASE_URL>,...) keeps the
+conversations that hash to it where they are.
+
+Rebalancing after changing the shard list, or enabling sharding on an
+existing deployment:
+  1. python shards.py rebalance --to NEW_LIST    # copy moving conversations
+  2. deploy NEW_LIST as MESSAGE_SHARDS
+  3. python shards.py rebalance --to NEW_LIST --prune
+     # copy what was written to the old owners meanwhile, then delete it there
+Every rebalance also scans the main database, so step 3 still finds what
+was written there before the switch. Copies are idempotent (by message
+id), so either step can be rerun.
+
+Usage:
+  python shards.py list
+  python shards.py locate USER_ID USER_ID
+  python shards.py rebalance --to NEW_LIST [--prune] [--dry-run]
+"""
+
+import argparse
+import hashlib
+import os
+import re
+
+from sqlalchemy import MetaData, case, create_engine, make_url, select, delete, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import sessionmaker
+from models import Message, MessageId, Conversation, PARTITION_MESSAGES, DATABASE_URL, ASYNC_DRIVERS, engine as main_engine, _create_missing_columns, _create_missing_indexes, _drop_superseded_indexes
+
+_SHARD_ENTRY = re.compile(r'^(\w+)=(.+)$')
+
+# Name of the main database when it is scanned as a shard
+MAIN_SHARD = 'main'
+
+def parse_shards(value):
+    """Parse a name=url,name=url shard list into an ordered {name: url} dict"""
+    shards = {}
+    for entry in filter(None, (part.strip() for part in (value or '').split(','))):
+        match = _SHARD_ENTRY.match(entry)
+        if not match:
+            raise ValueError(f"Invalid shard entry {entry!r}, expected name=url")
+        name, url = match.groups()
+        if name in shards:
+            raise ValueError(f"Duplicate shard name {name!r}")
+        shards[name] = url
+    return shards
+
+def conversation_key(user_id, other_user_id):
+    """The key a conversation is placed by, matching the socket room name"""
+    return "_".join(sorted([user_id, other_user_id]))
+
+def shard_tables():
+    """
+    Copies of the conversation-keyed tables to create on shards
+    Without foreign keys, since users live on the main database, and
+    unpartitioned, since partition maintenance only covers the main database
+    """
+    metadata = MetaData()
+    for table in (Message.__table__, MessageId.__table__, Conversation.__table__):
+        copy = table.to_metadata(metadata)
+        for constraint in list(copy.foreign_key_constraints):
+            copy.constraints.discard(constraint)
+        copy.foreign_keys.clear()
+        for column in copy.columns:
+            column.foreign_keys.clear()
+        copy.dialect_options['postgresql']['partition_by'] = None
+    return metadata
+
+class ShardMap:
+    """
+    Routes conversations to shard databases by rendezvous hashing
+    Engines are created once per shard; a shard whose URL is the main
+    DATABASE_URL reuses the main engine.
+    """
+
+    def __init__(self, shards):
+        """Initialize the map from an ordered {name: url} dict"""
+        if not shards:
+            raise ValueError("At least one shard is required")
+
+        self.urls = dict(shards)
+        self.names = list(shards)
+        self.engines = {
+            name: main_engine if url == DATABASE_URL else create_engine(url)
+            for name, url in shards.items()
+        }
+        self._sessions = {name: sessionmaker(autocommit=False, autoflush=False, bind=bind) for name, bind in self.engines.items()}
+        self._async_engines = {}
+        self._async_sessions = {}
+
+    @staticmethod
+    def _score(name, key):
+        return hashlib.sha256(f"{name}:{key}".encode()).digest()[:8]
+
+    def shard_for(self, user_id, other_user_id):
+        """Name of the shard holding the conversation between two users"""
+        key = conversation_key(user_id, other_user_id)
+        return max(self.names, key=lambda name: self._score(name, key))
+
+    def session(self, name):
+        """Get a database session on a shard"""
+        return self._sessions[name]()
+
+    def session_for(self, user_id, other_user_id):
+        """Get a database session on the shard holding a conversation"""
+        return self.session(self.shard_for(user_id, other_user_id))
+
+    def async_session(self, name):
+        """Get an async database session on a shard, creating its async engine on first use"""
+        if name not in self._async_sessions:
+            from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+            url = make_url(self.urls[name])
+            self._async_engines[name] = create_async_engine(url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]))
+            self._async_sessions[name] = async_sessionmaker(self._async_engines[name], autoflush=False, expire_on_commit=False)
+        return self._async_sessions[name]()
+
+    def async_session_for(self, user_id, other_user_id):
+        """Get an async database session on the shard holding a conversation"""
+        return self.async_session(self.shard_for(user_id, other_user_id))
+
+    def init_shards(self):
+        """Create the message tables on every shard"""
+        metadata = shard_tables()
+        for bind in self.engines.values():
+            metadata.create_all(bind=bind)
+            with bind.begin() as conn:
+                _create_missing_columns(conn, metadata)
+                _create_missing_indexes(conn, metadata)
+                _drop_superseded_indexes(conn)
+
+def create_shard_map():
+    """Build the ShardMap configured by MESSAGE_SHARDS, or None if sharding is off"""
+    shards = parse_shards(os.getenv('MESSAGE_SHARDS'))
+    return ShardMap(shards) if shards else None
+
+def current_shard_map():
+    """The ShardMap messages are stored by now: MESSAGE_SHARDS, or the main database alone if sharding is off"""
+    return create_shard_map() or ShardMap({MAIN_SHARD: DATABASE_URL})
+
+# Rebalancing
+
+def _insert(conn):
+    return postgresql.insert if conn.dialect.name == 'postgresql' else sqlite.insert
+
+def _conversations(conn):
+    """
+    Yield each conversation on a shard once, as (user_id, other_user_id)
+    Found from the messages as well as the index, since a database whose
+    index was never backfilled still holds its conversations' messages
+    """
+    pairs = {
+        tuple(sorted(pair)) for pair in
+        conn.execute(select(Message.sender_id, Message.recipient_id).distinct()).all()
+    }
+    pairs.update(conn.execute(
+        select(Conversation.owner_id, Conversation.peer_id).where(Conversation.owner_id <= Conversation.peer_id)
+    ).all())
+    for user_id, other_user_id in sorted(pairs):
+        yield user_id, other_user_id
+
+def _between(user_id, other_user_id):
+    return (
+        ((Message.sender_id == user_id) & (Message.recipient_id == other_user_id)) |
+        ((Message.sender_id == other_user_id) & (Message.recipient_id == user_id))
+    )
+
+def copy_conversation(source, target, user_id, other_user_id, chunk_size=1000, read_ids=None):
+    """
+    Copy one conversation's messages and index rows from one shard connection to another
+    Messages already on the target are skipped; an index row moves only to
+    a newer message, and its version is bumped so cached histories are refetched
+    The ids of the messages read are appended to read_ids, if given
+    Returns the number of messages copied
+    """
+    insert = _insert(target)
+    columns = list(Message.__table__.columns)
+    copied = 0
+
+    rows = source.execution_options(yield_per=chunk_size).execute(
+        select(*columns).where(_between(user_id, other_user_id))
+    )
+    for chunk in rows.partitions():
+        if read_ids is not None:
+            read_ids.extend(row.id for row in chunk)
+        result = target.execute(
+            insert(Message.__table__).on_conflict_do_nothing(),
+            [dict(row._mapping) for row in chunk]
+        )
+        copied += max(result.rowcount, 0)
+        if PARTITION_MESSAGES:
+            target.execute(
+                insert(MessageId.__table__).on_conflict_do_nothing(),
+                [{'id': row.id, 'sender_id': row.sender_id, 'created_at': row.created_at} for row in chunk]
+            )
+
+    entries = source.execute(select(Conversation.__table__).where(
+        ((Conversation.owner_id == user_id) & (Conversation.peer_id == other_user_id)) |
+        ((Conversation.owner_id == other_user_id) & (Conversation.peer_id == user_id))
+    )).all()
+    for entry in entries:
+        stmt = insert(Conversation.__table__).values(**entry._mapping)
+        newer = Conversation.last_message_at < stmt.excluded.last_message_at
+        target.execute(stmt.on_conflict_do_update(
+            index_elements=[Conversation.owner_id, Conversation.peer_id],
+            set_={
+                'last_message_id': case((newer, stmt.excluded.last_message_id), else_=Conversation.last_message_id),
+                'last_message_at': case((newer, stmt.excluded.last_message_at), else_=Conversation.last_message_at),
+                'unread_count': case((newer, stmt.excluded.unread_count), else_=Conversation.unread_count),
+                'version': Conversation.version + stmt.excluded.version + 1
+            }
+        ))
+
+    return copied
+
+def delete_messages(conn, message_ids, chunk_size=500):
+    """Delete messages, and their claimed ids, by id from a shard connection"""
+    for start in range(0, len(message_ids), chunk_size):
+        chunk = message_ids[start:start + chunk_size]
+        if PARTITION_MESSAGES:
+            conn.execute(delete(MessageId.__table__).where(MessageId.id.in_(chunk)))
+        conn.execute(delete(Message.__table__).where(Message.id.in_(chunk)))
+
+def delete_conversation(conn, user_id, other_user_id, message_ids):
+    """
+    Delete a copied conversation from a shard connection: the given messages,
+    and its index rows unless messages written since the copy remain
+    Returns the number of messages left behind
+    """
+    delete_messages(conn, message_ids)
+
+    remaining = conn.execute(
+        select(func.count()).select_from(Message.__table__).where(_between(user_id, other_user_id))
+    ).scalar()
+    if not remaining:
+        conn.execute(delete(Conversation.__table__).where(
+            ((Conversation.owner_id == user_id) & (Conversation.peer_id == other_user_id)) |
+            ((Conversation.owner_id == other_user_id) & (Conversation.peer_id == user_id))
+        ))
+    return remaining
+
+def rebalance(current, target, prune=False, dry_run=False, log=print):
+    """
+    Move every conversation to its owner under the target ShardMap
+    current lists the shards to scan (typically the union of the old and
+    new lists); each conversation is copied and committed on its new owner
+    before, with prune, it is deleted from where it was. Pruning deletes
+    only the messages copied in the same pass, so a message written to the
+    old owner meanwhile stays there for the next run instead of being lost
+    Returns {(source, destination): conversations moved}
+    """
+    target.init_shards()
+    moves = {}
+
+    for source_name in current.names:
+        source_engine = current.engines[source_name]
+        with source_engine.connect() as source:
+            conversations = list(_conversations(source))
+
+        for user_id, other_user_id in conversations:
+            destination_name = target.shard_for(user_id, other_user_id)
+            if target.urls[destination_name] == current.urls[source_name]:
+                continue
+
+            moves[(source_name, destination_name)] = moves.get((source_name, destination_name), 0) + 1
+            if dry_run:
+                continue
+
+            read_ids = [] if prune else None
+            left = 0
+            # The destination commits first, so nothing is deleted before its copy is durable
+            with source_engine.begin() as source, target.engines[destination_name].begin() as destination:
+                copied = copy_conversation(source, destination, user_id, other_user_id, read_ids=read_ids)
+                if prune:
+                    left = delete_conversation(source, user_id, other_user_id, read_ids)
+            log(
+                f"{conversation_key(user_id, other_user_id)}: {source_name} -> {destination_name}, {copied} messages copied"
+                + (f", {left} written meanwhile left for the next run" if left else '')
+            )
+
+    return moves
+
+def rebalance_sources(current, target):
+    """
+    The ShardMap a rebalance to target scans: the current and target shards
+    and the main database, where messages were stored before sharding was enabled
+    """
+    shards = dict(target.urls, **current.urls)
+    if DATABASE_URL not in shards.values():
+        name = MAIN_SHARD
+        while name in shards:
+            name = f"_{name}"
+        shards[name] = DATABASE_URL
+    return ShardMap(shards)
+
+def shard_counts(shard_map):
+    """Count the messages and conversation index rows on each shard"""
+    counts = {}
+    for name, bind in shard_map.engines.items():
+        with bind.connect() as conn:
+            counts[name] = {
+                'messages': conn.execute(select(func.count()).select_from(Message.__table__)).scalar(),
+                'conversations': conn.execute(select(func.count()).select_from(Conversation.__table__)).scalar()
+            }
+    return counts
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Inspect and rebalance the message shards")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('list', help="Count the messages and conversations on each shard")
+
+    locate = commands.add_parser('locate', help="Show which shard holds a conversation")
+    locate.add_argument('user_id')
+    locate.add_argument('other_user_id')
+
+    move = commands.add_parser('rebalance', help="Move conversations to their owners under a new shard list")
+    move.add_argument('--to', required=True, help="The new name=url,... shard list")
+    move.add_argument('--prune', action='store_true', help="Delete moved conversations from their old shards")
+    move.add_argument('--dry-run', action='store_true', help="Only count the conversations that would move")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    shard_map = current_shard_map()
+
+    if args.command == 'list':
+        for name, counts in shard_counts(shard_map).items():
+            print(f"{name}: {counts['messages']} messages, {counts['conversations']} conversation entries")
+
+    elif args.command == 'locate':
+        print(shard_map.shard_for(args.user_id, args.other_user_id))
+
+    elif args.command == 'rebalance':
+        target = ShardMap(parse_shards(args.to))
+        # Scan the old shards, any new ones and the main database, so reruns after the switch find leftovers
+        scanned = rebalance_sources(shard_map, target)
+        moves = rebalance(scanned, target, prune=args.prune, dry_run=args.dry_run)
+        for (source, destination), count in sorted(moves.items()):
+            print(f"{source} -> {destination}: {count} conversations{' (dry run)' if args.dry_run else ''}")
+        if not moves:
+            print("Every conversation is already on its owner")
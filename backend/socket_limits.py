@@ -0,0 +1,167 @@
+import asyncio
+import threading
+from collections import Counter
+
+class SocketLimits:
+    """
+    Admission control and outbound backpressure for one worker's Socket.IO server.
+    Caps the sockets per worker and per user, and bounds each socket's
+    outbound queue: a consumer that falls max_queue packets behind has
+    further packets dropped, or is disconnected so it reconnects and
+    resyncs from the message history.
+    """
+
+    SLOW_CONSUMER_POLICIES = ('disconnect', 'drop')
+
+    def __init__(self, max_connections=0, max_per_user=0, max_queue=0, slow_consumer='disconnect', redirect_url=None):
+        """Initialize the limits; a limit of 0 means unlimited"""
+        if slow_consumer not in self.SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"slow_consumer must be one of {', '.join(self.SLOW_CONSUMER_POLICIES)}")
+
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.slow_consumer = slow_consumer
+        self.redirect_url = redirect_url
+
+        self._lock = threading.Lock()
+        self._users = {}  # sid -> user_id
+        self._user_sids = {}  # user_id -> set of sids
+        self._closing = set()  # eio sids being disconnected as slow consumers
+        self._server = None
+        self._async = False
+
+        self.rejected = Counter()  # reason -> count
+        self.dropped_packets = 0
+        self.slow_disconnects = 0
+
+    # Admission
+
+    def admit(self, sid, user_id):
+        """
+        Reserve a slot for a new socket of user_id, registering it under sid
+        The check and the reservation happen under one lock, so a burst of
+        reconnects cannot overshoot the limits while sessions are created;
+        callers unregister the sid if the connection is refused later on
+        Returns None if it may connect, otherwise the rejection to send to the client
+        """
+        with self._lock:
+            if self.max_connections and len(self._users) >= self.max_connections:
+                reason = 'server_full'
+            elif self.max_per_user and len(self._user_sids.get(user_id, ())) >= self.max_per_user:
+                reason = 'too_many_connections'
+            else:
+                self._users[sid] = user_id
+                self._user_sids.setdefault(user_id, set()).add(sid)
+                return None
+
+            self.rejected[reason] += 1
+
+        rejection = {'reason': reason}
+        if reason == 'server_full' and self.redirect_url:
+            rejection['redirect'] = self.redirect_url
+        return rejection
+
+    def user_for(self, sid):
+        """The user ID of an admitted socket, or None"""
+        return self._users.get(sid)
+
+    def unregister(self, sid):
+        """Forget a disconnected or refused socket, releasing its slot"""
+        with self._lock:
+            user_id = self._users.pop(sid, None)
+            sids = self._user_sids.get(user_id)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._user_sids[user_id]
+
+    # Backpressure
+
+    def install(self, server):
+        """Bound the outbound queues of a socketio.Server or socketio.AsyncServer"""
+        self._server = server
+        self._async = asyncio.iscoroutinefunction(server._send_packet)
+
+        # Direct emits go through _send_packet; room and broadcast fan-out through _send_eio_packet
+        for name in ('_send_packet', '_send_eio_packet'):
+            setattr(server, name, self._limited(getattr(server, name)))
+
+    def _limited(self, send):
+        """Wrap a server send method so packets pass _admit_packet first"""
+        if self._async:
+            async def limited_send(eio_sid, pkt):
+                if self._admit_packet(eio_sid):
+                    await send(eio_sid, pkt)
+        else:
+            def limited_send(eio_sid, pkt):
+                if self._admit_packet(eio_sid):
+                    send(eio_sid, pkt)
+        return limited_send
+
+    def _queue_depth(self, eio_sid):
+        socket = self._server.eio.sockets.get(eio_sid)
+        return socket.queue.qsize() if socket is not None else 0
+
+    def _admit_packet(self, eio_sid):
+        """Decide whether a packet may be queued for a socket, applying the slow-consumer policy"""
+        if eio_sid in self._closing:
+            self.dropped_packets += 1
+            return False
+
+        if not self.max_queue or self._queue_depth(eio_sid) < self.max_queue:
+            return True
+
+        self.dropped_packets += 1
+        if self.slow_consumer == 'disconnect':
+            self._closing.add(eio_sid)
+            self.slow_disconnects += 1
+            # Closed from a background task, since this runs inside another socket's handler
+            self._server.start_background_task(self._abort_async if self._async else self._abort, eio_sid)
+        return False
+
+    def _abort(self, eio_sid):
+        """Close a socket without flushing its queue"""
+        try:
+            socket = self._server.eio.sockets.get(eio_sid)
+            if socket is not None:
+                socket.close(wait=False, abort=True)
+                self._server.eio.sockets.pop(eio_sid, None)
+        finally:
+            self._closing.discard(eio_sid)
+
+    async def _abort_async(self, eio_sid):
+        """Close a socket without flushing its queue"""
+        try:
+            socket = self._server.eio.sockets.get(eio_sid)
+            if socket is not None:
+                await socket.close(wait=False, abort=True)
+                self._server.eio.sockets.pop(eio_sid, None)
+        finally:
+            self._closing.discard(eio_sid)
+
+    # Gauges
+
+    def stats(self):
+        """Connection counts, rejections and outbound queue depths for this worker"""
+        depths = sorted(
+            socket.queue.qsize() for socket in self._server.eio.sockets.values()
+        ) if self._server is not None else []
+
+        return {
+            'connections': len(self._users),
+            'users': len(self._user_sids),
+            'max_connections': self.max_connections,
+            'max_per_user': self.max_per_user,
+            'rejected': dict(self.rejected),
+            'queue': {
+                'max_depth': self.max_queue,
+                'total': sum(depths),
+                'p50': depths[len(depths) // 2] if depths else 0,
+                'p99': depths[min(len(depths) - 1, len(depths) * 99 // 100)] if depths else 0,
+                'max': depths[-1] if depths else 0,
+                'sockets_over_half': sum(1 for depth in depths if self.max_queue and depth * 2 >= self.max_queue)
+            },
+            'dropped_packets': self.dropped_packets,
+            'slow_disconnects': self.slow_disconnects
+        }
@@ -0,0 +1,2 @@
+#!/bin/bash
+uvicorn asgi:app --host 0.0.0.0 --port $PORT
\ No newline at end of file
@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# models reads DATABASE_URL at import time, so point it at a scratch database first
+_database = tempfile.NamedTemporaryFile(prefix='zecret-test-', suffix='.db', delete=False)
+os.environ['DATABASE_URL'] = f"sqlite:///{_database.name}"
+for name in ('MESSAGE_SHARDS', 'MESSAGE_PARTITIONING', 'SESSION_STORE_URL'):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models  # noqa: E402
+
+@pytest.fixture
+def db():
+    """Fresh tables on the scratch database, emptied again after the test"""
+    models.init_db()
+    yield models
+    with models.engine.begin() as conn:
+        for table in reversed(models.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+
+@pytest.fixture
+def make_user(db):
+    """Insert a bare user row and return its id"""
+    def make_user(user_id, display_name=None):
+        session = models.get_db()
+        try:
+            session.add(models.User(id=user_id, public_key='key', access_code_hash=f"hash-{user_id}", display_name=display_name))
+            session.commit()
+        finally:
+            session.close()
+        return user_id
+    return make_user
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import SQLAlchemyError
+
+from activity import ActivityRollups, day_bucket, hour_bucket
+from message_manager import MessageManager
+
+def test_workers_count_each_active_user_once_per_day(db):
+    first, second = ActivityRollups(), ActivityRollups()
+
+    first.record_message('alice')
+    first.record_message('alice')
+    second.record_message('alice')
+    second.record_registration('bob')
+    first.flush()
+    second.flush()
+    # Already flushed by this worker, so not even sent to the database again
+    first.record_active('alice')
+    assert not first._active
+
+    stats = first.stats(hours=2, days=2)
+    assert stats['messages_per_hour'][-1] == {'hour': hour_bucket(datetime.utcnow()).isoformat(), 'count': 3}
+    assert stats['registrations_per_day'][-1]['count'] == 1
+    assert stats['active_users_today'] == 2
+
+def test_failed_flush_keeps_the_counts(db, monkeypatch):
+    rollups = ActivityRollups()
+    rollups.record_message('alice')
+
+    def fail(self, db, insert, active):
+        raise SQLAlchemyError("database is down")
+
+    monkeypatch.setattr(ActivityRollups, '_insert_active', fail)
+    with pytest.raises(SQLAlchemyError):
+        rollups.flush()
+    monkeypatch.undo()
+
+    assert rollups.flush() == 2
+    assert rollups.stats(hours=1, days=1)['active_users_today'] == 1
+
+def test_stats_windows_are_clamped(db):
+    stats = ActivityRollups().stats(hours=0, days=1000)
+
+    assert len(stats['messages_per_hour']) == 1
+    assert len(stats['active_users_per_day']) == ActivityRollups.MAX_DAYS
+    assert stats['active_users_per_day'][-1]['day'] == day_bucket(datetime.utcnow()).isoformat()
+
+def test_backfill_counts_existing_rows_once(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    MessageManager().store_message(alice, bob, {'iv': 'x'}, 'k', 's')
+
+    rollups = ActivityRollups()
+    assert rollups.backfill() > 0
+    assert rollups.backfill() == 0
+
+    stats = rollups.stats(hours=1, days=1)
+    assert stats['messages_per_hour'][-1]['count'] == 1
+    assert stats['registrations_per_day'][-1]['count'] == 2
+    assert stats['active_users_today'] == 2
+
+    # Users the backfill counted today are not counted again by later flushes
+    rollups.record_active(alice)
+    rollups.flush()
+    assert rollups.stats(hours=1, days=1)['active_users_today'] == 2
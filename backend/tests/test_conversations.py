@@ -0,0 +1,127 @@
+from datetime import datetime
+
+import pytest
+
+import message_manager
+from message_manager import MessageManager
+from models import Conversation, Message, get_db
+
+CONTENT = {'iv': 'x', 'ciphertext': 'y'}
+
+class _Earlier(datetime):
+    """utcnow() in the past, as for a store that commits after a newer one"""
+
+    @classmethod
+    def utcnow(cls):
+        return datetime(2000, 1, 1)
+
+def add_conversations(owner_id, peer_ids, last_message_at):
+    session = get_db()
+    try:
+        for peer_id in peer_ids:
+            session.add(Conversation(
+                owner_id=owner_id, peer_id=peer_id, last_message_id=f"m-{peer_id}",
+                last_message_at=last_message_at, unread_count=0
+            ))
+        session.commit()
+    finally:
+        session.close()
+
+def all_pages(manager, user_id, limit):
+    peers, before = [], None
+    while True:
+        page = manager.get_conversations(user_id, limit=limit, before=before)
+        peers.extend(entry['user_id'] for entry in page['conversations'])
+        if not page['next_cursor']:
+            return peers
+        before = MessageManager.decode_conversations_cursor(page['next_cursor'])
+
+def test_pages_keep_conversations_sharing_a_timestamp(make_user):
+    owner = make_user('owner')
+    peers = [make_user(f"peer-{i}") for i in range(5)]
+    add_conversations(owner, peers, datetime(2024, 1, 1, 12, 0, 0))
+
+    listed = all_pages(MessageManager(), owner, limit=2)
+
+    assert sorted(listed) == sorted(peers)
+    assert len(listed) == len(set(listed))
+
+def test_pages_are_newest_first(make_user):
+    owner = make_user('owner')
+    for i in range(3):
+        add_conversations(owner, [make_user(f"peer-{i}")], datetime(2024, 1, 1, 12, i))
+
+    assert all_pages(MessageManager(), owner, limit=1) == ['peer-2', 'peer-1', 'peer-0']
+
+def test_inbox_pages_are_an_index_range_without_a_sort(db):
+    statement = MessageManager()._conversations_statement('owner', 10, (datetime(2024, 1, 1), 'peer'))
+    compiled = statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+
+    with db.engine.connect() as conn:
+        plan = ' '.join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}"))
+
+    assert 'ix_conversations_owner_last_message_at_peer' in plan
+    assert 'TEMP B-TREE' not in plan
+
+@pytest.mark.parametrize('cursor', ['not a cursor', 'WyJ4Il0=', '2024-01-02T00:00:00'])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError):
+        MessageManager.decode_conversations_cursor(cursor)
+
+@pytest.mark.parametrize('limit', [0, -5])
+def test_page_size_is_at_least_one(make_user, limit):
+    owner = make_user('owner')
+    add_conversations(owner, [make_user('a'), make_user('b')], datetime(2024, 1, 1))
+
+    page = MessageManager().get_conversations(owner, limit=limit)
+
+    assert len(page['conversations']) == 1
+    assert page['next_cursor'] is not None
+
+def test_a_late_commit_does_not_rewind_the_conversation_index(make_user, monkeypatch):
+    alice, bob = make_user('alice'), make_user('bob')
+    manager = MessageManager()
+
+    newest = manager.store_message(alice, bob, CONTENT, 'k', 's')
+    monkeypatch.setattr(message_manager, 'datetime', _Earlier)
+    older = manager.store_message(alice, bob, CONTENT, 'k', 's')
+    monkeypatch.undo()
+
+    state = manager.get_conversation_state(bob, alice)
+    assert state['last_message_id'] == newest['id']
+    assert manager.get_conversations(bob)['conversations'][0]['unread_count'] == 2
+
+    messages = manager.get_messages(bob, alice)
+    assert [message['id'] for message in messages] == [older['id'], newest['id']]
+    assert state['version'] == 2
+
+def test_the_generic_update_only_moves_forward(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    manager = MessageManager()
+    add_conversations(alice, [bob], datetime(2024, 1, 2))
+
+    session = get_db()
+    try:
+        manager._update_conversation(session, alice, bob, Message(id='old', created_at=datetime(2024, 1, 1)), unread_increment=1)
+        session.commit()
+        assert manager.get_conversation_state(alice, bob)['last_message_id'] == f"m-{bob}"
+
+        manager._update_conversation(session, alice, bob, Message(id='new', created_at=datetime(2024, 1, 3)), unread_increment=1)
+        session.commit()
+    finally:
+        session.close()
+
+    assert manager.get_conversation_state(alice, bob)['last_message_id'] == 'new'
+    assert manager.get_conversations(alice)['conversations'][0]['unread_count'] == 2
+
+def test_history_etag_changes_with_a_late_commit(make_user, monkeypatch):
+    alice, bob = make_user('alice'), make_user('bob')
+    manager = MessageManager()
+    assert manager.history_etag(manager.get_conversation_state(bob, alice)) == 'empty'
+
+    manager.store_message(alice, bob, CONTENT, 'k', 's')
+    cached = manager.history_etag(manager.get_conversation_state(bob, alice))
+    monkeypatch.setattr(message_manager, 'datetime', _Earlier)
+    manager.store_message(alice, bob, CONTENT, 'k', 's')
+
+    assert manager.history_etag(manager.get_conversation_state(bob, alice)) != cached
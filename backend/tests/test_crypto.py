@@ -0,0 +1,45 @@
+import itertools
+
+import pytest
+
+from crypto import CryptoManager
+
+SUITES = list(CryptoManager.SUITES)
+
+@pytest.fixture(scope='module')
+def keypairs():
+    return {suite: CryptoManager.generate_keypair(suite) for suite in SUITES}
+
+@pytest.mark.parametrize('sender_suite, recipient_suite', list(itertools.product(SUITES, SUITES)))
+def test_messages_round_trip_between_every_pair_of_suites(keypairs, sender_suite, recipient_suite):
+    sender, recipient = keypairs[sender_suite], keypairs[recipient_suite]
+    suite = CryptoManager.negotiate_suite(sender_suite, recipient_suite)
+
+    message = CryptoManager.prepare_message('alice', 'bob', 'hello', sender['private_key'], recipient['public_key'], suite=suite)
+    decrypted = CryptoManager.decrypt_message(message, recipient['private_key'], sender['public_key'])
+
+    assert message['suite'] == suite
+    assert decrypted['text'] == 'hello'
+
+def test_a_message_replayed_to_another_recipient_fails(keypairs):
+    sender, recipient = keypairs[CryptoManager.AESGCM_SUITE], keypairs[CryptoManager.CHACHA20_SUITE]
+    message = CryptoManager.prepare_message('alice', 'bob', 'hello', sender['private_key'], recipient['public_key'])
+
+    with pytest.raises(ValueError):
+        CryptoManager.decrypt_message(dict(message, recipient_id='carol'), recipient['private_key'], sender['public_key'])
+
+def test_a_key_of_the_wrong_type_is_rejected(keypairs):
+    sender, recipient = keypairs[CryptoManager.LEGACY_SUITE], keypairs[CryptoManager.AESGCM_SUITE]
+
+    with pytest.raises(ValueError):
+        CryptoManager.prepare_message('alice', 'bob', 'hello', sender['private_key'], recipient['public_key'], suite=CryptoManager.LEGACY_SUITE)
+
+def test_batches_report_failures_per_message(keypairs):
+    sender, recipient = keypairs[CryptoManager.CHACHA20_SUITE], keypairs[CryptoManager.CHACHA20_SUITE]
+    good = CryptoManager.prepare_message('alice', 'bob', 'hello', sender['private_key'], recipient['public_key'])
+    unknown = dict(good, sender_id='mallory')
+
+    results = CryptoManager.decrypt_messages([good, unknown], recipient['private_key'], {'alice': sender['public_key']})
+
+    assert results[0]['message']['text'] == 'hello' and results[0]['error'] is None
+    assert results[1]['message'] is None and 'mallory' in results[1]['error']
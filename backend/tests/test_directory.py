@@ -0,0 +1,55 @@
+import asyncio
+import json
+import sys
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import pytest
+from starlette.requests import Request
+
+from user_manager import UserManager
+
+@pytest.fixture
+def directory(make_user):
+    for i in range(5):
+        make_user(f"user-{i}", display_name=f"Name {i}")
+    make_user('odd', display_name=f"x{chr(sys.maxunicode)}y")
+    return UserManager()
+
+def test_page_size_is_clamped_to_at_least_one(directory):
+    for limit in (0, -1):
+        page = directory.search_users('name', limit=limit, include_keys=True)
+        assert len(page['users']) == 1
+        assert page['next_cursor']
+
+    assert len(directory.search_users('name', limit=1000)['users']) == 5
+
+def test_prefix_ending_in_the_last_code_point_matches(directory):
+    page = directory.search_users(f"x{chr(sys.maxunicode)}")
+
+    assert [user['id'] for user in page['users']] == ['odd']
+
+@pytest.mark.parametrize('prefix', ['a\x00', '\ud800', 'x' * 51])
+def test_invalid_prefixes_are_rejected(directory, prefix):
+    with pytest.raises(ValueError, match='Invalid search prefix'):
+        directory.search_users(prefix)
+
+def test_search_endpoint_reports_each_invalid_parameter(directory):
+    import asgi
+
+    token = jwt.encode({'user_id': 'user-0', 'exp': datetime.now(timezone.utc) + timedelta(minutes=5)}, asgi.user_manager.secret_key, algorithm='HS256')
+
+    def search(query):
+        request = Request({
+            'type': 'http', 'method': 'GET', 'path': '/api/users/search', 'query_string': query.encode(),
+            'headers': [(b'authorization', f"Bearer {token}".encode())]
+        })
+        response = asyncio.run(asgi.search_users(request))
+        return response.status_code, json.loads(response.body)
+
+    assert search('limit=ten') == (400, {'error': 'Invalid limit'})
+    assert search('cursor=!!!') == (400, {'error': 'Invalid cursor'})
+    assert search('q=%00') == (400, {'error': 'Invalid search prefix'})
+
+    status, page = search('q=name&limit=-1&include_keys=1')
+    assert status == 200 and len(page['users']) == 1
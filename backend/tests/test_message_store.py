@@ -0,0 +1,71 @@
+import pytest
+
+import message_manager
+from message_manager import MessageManager, _RecentAcks, new_message_id
+from models import MessageId, get_db
+
+CONTENT = {'iv': 'x', 'ciphertext': 'y'}
+
+def test_recent_acks_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(message_manager.time, 'monotonic', lambda: now[0])
+    acks = _RecentAcks(ttl=10, max_size=100)
+
+    acks.add(('alice', 'm1'), {'id': 'm1'})
+    now[0] += 5
+    assert acks.get(('alice', 'm1')) == {'id': 'm1'}
+    now[0] += 6
+    assert acks.get(('alice', 'm1')) is None
+
+def test_recent_acks_drop_the_oldest_beyond_max_size():
+    acks = _RecentAcks(ttl=60, max_size=2)
+    for i in range(3):
+        acks.add(('alice', f"m{i}"), {'id': f"m{i}"})
+
+    assert acks.get(('alice', 'm0')) is None
+    assert acks.get(('alice', 'm1')) and acks.get(('alice', 'm2'))
+
+def test_new_message_ids_are_time_ordered_uuid7():
+    first, second = new_message_id(), new_message_id()
+
+    assert first[14] == '7'
+    assert first[:13] <= second[:13]
+
+def test_retry_with_the_same_id_is_acknowledged_once(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    manager = MessageManager()
+
+    first = manager.store_message(alice, bob, CONTENT, 'k', 's', message_id='client-1')
+    # A fresh manager has no cached ack, so the retry is answered from the database
+    retry = MessageManager().store_message(alice, bob, CONTENT, 'k', 's', message_id='client-1')
+
+    assert first['duplicate'] is False
+    assert retry == dict(first, duplicate=True)
+    assert len(manager.get_messages(alice, bob)) == 1
+    assert manager.get_conversations(bob)['conversations'][0]['unread_count'] == 1
+
+def test_id_taken_by_another_sender_is_rejected(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    MessageManager().store_message(alice, bob, CONTENT, 'k', 's', message_id='client-1')
+
+    with pytest.raises(ValueError):
+        MessageManager().store_message(bob, alice, CONTENT, 'k', 's', message_id='client-1')
+
+def test_partitioned_stores_claim_the_id_before_inserting(make_user, monkeypatch):
+    # SQLite cannot partition messages, but the message_ids claim runs the same way
+    monkeypatch.setattr(message_manager, 'PARTITION_MESSAGES', True)
+    alice, bob = make_user('alice'), make_user('bob')
+
+    first = MessageManager().store_message(alice, bob, CONTENT, 'k', 's', message_id='client-1')
+    retry = MessageManager().store_message(alice, bob, CONTENT, 'k', 's', message_id='client-1')
+    with pytest.raises(ValueError):
+        MessageManager().store_message(bob, alice, CONTENT, 'k', 's', message_id='client-1')
+
+    assert retry == dict(first, duplicate=True)
+    assert len(MessageManager().get_messages(alice, bob)) == 1
+
+    session = get_db()
+    try:
+        assert session.get(MessageId, 'client-1').created_at == first['created_at']
+    finally:
+        session.close()
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, select
+
+import migrate_db
+from models import ActivityRollup, Base
+
+TABLE = ActivityRollup.__table__
+
+def test_datetime_keys_survive_the_checkpoint(tmp_path):
+    path = str(tmp_path / 'state.json')
+    state = {'run_id': 'run', 'tables': {'activity_rollups': {
+        'last_key': migrate_db.encode_key(['messages', datetime(2024, 5, 1, 13)]), 'rows': 1, 'done': False
+    }}}
+
+    migrate_db.save_state(path, state)
+    with open(path) as f:
+        state = migrate_db.json.load(f)
+
+    assert migrate_db.decode_key(state['tables']['activity_rollups']['last_key']) == ['messages', datetime(2024, 5, 1, 13)]
+
+@pytest.fixture
+def databases(tmp_path):
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    target = create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+    Base.metadata.create_all(bind=source)
+    Base.metadata.create_all(bind=target)
+
+    start = datetime(2024, 1, 1)
+    with source.begin() as conn:
+        conn.execute(TABLE.insert(), [
+            {'metric': metric, 'bucket': start + timedelta(hours=i), 'count': i}
+            for metric in ('active_users', 'messages') for i in range(10)
+        ])
+    return source, target
+
+def test_copy_resumes_after_an_interrupted_chunk(databases, tmp_path, monkeypatch):
+    source, target = databases
+    state_file = str(tmp_path / 'state.json')
+    insert_chunk = migrate_db.insert_chunk
+    calls = []
+
+    def failing_insert_chunk(conn, table, rows):
+        calls.append(len(rows))
+        insert_chunk(conn, table, rows)
+        if len(calls) == 3:
+            raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(migrate_db, 'insert_chunk', failing_insert_chunk)
+    state = migrate_db.load_state(state_file, 'source', 'target')
+    with pytest.raises(RuntimeError):
+        migrate_db.copy_table(source, target, TABLE, 4, state, state_file)
+
+    monkeypatch.setattr(migrate_db, 'insert_chunk', insert_chunk)
+    state = migrate_db.load_state(state_file, 'source', 'target')
+    assert state['tables']['activity_rollups']['rows'] == 8
+    migrate_db.copy_table(source, target, TABLE, 4, state, state_file)
+
+    assert state['tables']['activity_rollups'] == {
+        'last_key': ['messages', {'datetime': '2024-01-01T09:00:00'}], 'rows': 20, 'done': True
+    }
+    assert migrate_db.verify_table(source, target, TABLE, 4)
+    with target.connect() as conn:
+        assert len(conn.execute(select(TABLE)).all()) == 20
@@ -0,0 +1,34 @@
+from sqlalchemy import create_engine
+
+from query_log import QueryStats, normalize_statement, parameter_shape
+
+def test_statements_differing_in_list_length_normalize_alike():
+    short = normalize_statement("SELECT * FROM users\n  WHERE id IN (?, ?)")
+    long = normalize_statement("SELECT *  FROM users WHERE id IN (?, ?, ?, ?)")
+
+    assert short == long == "SELECT * FROM users WHERE id IN (...)"
+    assert normalize_statement("INSERT INTO t (a, b) VALUES (%(a)s, %(b)s), ($1, $2)") == \
+        "INSERT INTO t (a, b) VALUES (...), (...)"
+    assert normalize_statement("SELECT count(?)") == "SELECT count(?)"
+
+def test_parameter_shapes_hold_no_values():
+    assert parameter_shape({'id': 'secret', 'n': 3}) == '{id: str, n: int}'
+    assert parameter_shape(('secret', None)) == '(str, NoneType)'
+    assert parameter_shape([('a', 1), ('b', 2)], executemany=True) == '2 x (str, int)'
+    assert parameter_shape([], executemany=True) == '0 x ()'
+
+def test_slow_statements_are_aggregated_logged_and_explained():
+    engine = create_engine('sqlite://')
+    lines = []
+    stats = QueryStats(slow_ms=0, log=lines.append)
+    stats.attach(engine)
+
+    with engine.connect() as conn:
+        conn.exec_driver_sql("SELECT 1 WHERE 1 IN (?, ?)", (1, 2))
+        conn.exec_driver_sql("SELECT 1 WHERE 1 IN (?, ?, ?)", (1, 2, 3))
+
+    [row] = stats.top()
+    assert row['statement'] == "SELECT 1 WHERE 1 IN (...)"
+    assert (row['calls'], row['slow_calls'], row['parameters']) == (2, 2, '(int, int, int)')
+    assert row['plan']
+    assert len(lines) == 2 and lines[0].startswith("Slow query")
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+
+from models import User, get_db
+from session_store import MemorySessionStore
+from user_manager import AsyncUserManager, UserManager
+
+def test_sessions_expire_with_their_token():
+    store = MemorySessionStore()
+    store.set('live', 'alice', time.time() + 60)
+    store.set('expired', 'bob', time.time() - 1)
+
+    assert store.get('live') == 'alice'
+    assert store.get('expired') is None
+    assert store.expirations == 1
+
+def test_least_recently_used_sessions_are_evicted():
+    store = MemorySessionStore(max_size=2)
+    expires_at = time.time() + 60
+    store.set('a', 'alice', expires_at)
+    store.set('b', 'bob', expires_at)
+    store.get('a')
+    store.set('c', 'carol', expires_at)
+
+    assert store.get('b') is None
+    assert store.get('a') == 'alice' and store.get('c') == 'carol'
+    assert store.evictions == 1
+
+def test_pinned_sessions_are_never_evicted():
+    store = MemorySessionStore(max_size=1)
+    expires_at = time.time() + 60
+    store.set('socket', 'alice', expires_at, pinned=True)
+    for i in range(5):
+        store.set(f"rest-{i}", 'bob', expires_at)
+
+    assert store.get('socket') == 'alice'
+    assert store.pop('socket') == 'alice'
+    assert store.get('socket') is None
+
+def test_sweep_drops_expired_pinned_sessions():
+    store = MemorySessionStore()
+    store.set('gone', 'alice', time.time() - 1, pinned=True)
+    store.set('kept', 'bob', time.time() + 60, pinned=True)
+
+    assert store.sweep() == 1
+    assert len(store) == 1
+
+def is_online(user_id):
+    session = get_db()
+    try:
+        return session.get(User, user_id).is_online
+    finally:
+        session.close()
+
+def test_socket_session_survives_eviction_and_ends_offline(db):
+    manager = UserManager('secret', session_store=MemorySessionStore(max_size=1))
+    user = manager.register_anonymous_user('alice')
+    session = manager.create_session(user['id'], pinned=True)
+    for _ in range(3):
+        manager.create_session(user['id'])
+
+    assert manager.get_user_for_session(session['session_id'])['id'] == user['id']
+    assert manager.end_session(session['session_id'])
+    assert not is_online(user['id'])
+
+def test_end_session_marks_offline_without_a_stored_session(db):
+    manager = UserManager('secret')
+    user = manager.register_anonymous_user('alice')
+    manager.create_session(user['id'])
+
+    assert manager.end_session('unknown-session', user_id=user['id'])
+    assert not is_online(user['id'])
+
+class BlockingStore(MemorySessionStore):
+    """A store whose calls must stay off the event loop, recording where they ran"""
+
+    blocking = True
+
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def get(self, session_id):
+        self.threads.append(threading.get_ident())
+        return super().get(session_id)
+
+    def pop(self, session_id):
+        self.threads.append(threading.get_ident())
+        return super().pop(session_id)
+
+def test_async_manager_keeps_blocking_store_calls_off_the_loop():
+    store = BlockingStore()
+    manager = AsyncUserManager('secret', session_store=store)
+
+    async def main():
+        loop_thread = threading.get_ident()
+        assert await manager.get_user_for_session('missing') is None
+        assert await manager.end_session('missing') is False
+        return loop_thread
+
+    loop_thread = asyncio.run(main())
+
+    assert len(store.threads) == 2
+    assert loop_thread not in store.threads
@@ -0,0 +1,126 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+import shards
+from message_manager import MessageManager
+from models import Conversation, DATABASE_URL, Message, engine
+from shards import ShardMap, parse_shards
+
+CONTENT = {'iv': 'x', 'ciphertext': 'y'}
+
+def count_messages(bind):
+    with bind.connect() as conn:
+        return conn.execute(select(func.count()).select_from(Message.__table__)).scalar()
+
+def test_parse_shards_keeps_order_and_rejects_bad_entries():
+    assert list(parse_shards(' b=sqlite:///b.db, a=postgresql://h/a?x=1 ')) == ['b', 'a']
+    assert parse_shards('') == {}
+
+    with pytest.raises(ValueError):
+        parse_shards('a=sqlite:///a.db,a=sqlite:///b.db')
+    with pytest.raises(ValueError):
+        parse_shards('sqlite:///a.db')
+
+def test_adding_a_shard_only_moves_conversations_to_it(tmp_path):
+    urls = {name: f"sqlite:///{tmp_path / name}.db" for name in 'abc'}
+    before = ShardMap({name: urls[name] for name in 'ab'})
+    after = ShardMap(urls)
+    pairs = [(f"user-{i}", f"user-{i + 1}") for i in range(200)]
+
+    for user_id, other_user_id in pairs:
+        owner = before.shard_for(user_id, other_user_id)
+        assert owner == before.shard_for(other_user_id, user_id)
+        assert after.shard_for(user_id, other_user_id) in (owner, 'c')
+    assert {before.shard_for(*pair) for pair in pairs} == {'a', 'b'}
+
+def test_current_map_is_the_main_database_when_sharding_is_off():
+    shard_map = shards.current_shard_map()
+
+    assert shard_map.urls == {'main': DATABASE_URL}
+    assert shard_map.engines['main'] is engine
+
+def test_enabling_sharding_moves_messages_off_the_main_database(make_user, tmp_path):
+    users = [make_user(f"user-{i}") for i in range(6)]
+    unsharded = MessageManager()
+    for other_user_id in users[1:]:
+        unsharded.store_message(users[0], other_user_id, CONTENT, 'k', 's')
+
+    target = ShardMap({name: f"sqlite:///{tmp_path / name}.db" for name in 'ab'})
+    moves = shards.rebalance(shards.rebalance_sources(shards.current_shard_map(), target), target, log=lambda line: None)
+    assert sum(moves.values()) == 5
+    assert count_messages(engine) == 5
+
+    # Written to the main database after the copy, before the switch
+    late = unsharded.store_message(users[0], users[1], CONTENT, 'k', 's')
+
+    # After the switch MESSAGE_SHARDS lists only the new shards, and the main database is still scanned
+    shards.rebalance(shards.rebalance_sources(target, target), target, prune=True, log=lambda line: None)
+    assert count_messages(engine) == 0
+    with engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(Conversation.__table__)).scalar() == 0
+
+    sharded = MessageManager(shards=target)
+    assert [message['id'] for message in sharded.get_messages(users[1], users[0])][-1] == late['id']
+    inbox = sharded.get_conversations(users[0])['conversations']
+    assert sorted(entry['user_id'] for entry in inbox) == users[1:]
+    assert inbox[0]['user_id'] == users[1]
+
+def test_sharded_inbox_pages_merge_ties_across_shards(make_user, tmp_path):
+    owner = make_user('owner')
+    peers = [make_user(f"peer-{i}") for i in range(8)]
+    target = ShardMap({name: f"sqlite:///{tmp_path / name}.db" for name in 'ab'})
+    target.init_shards()
+
+    at = datetime(2024, 1, 1)
+    for peer_id in peers:
+        session = target.session_for(owner, peer_id)
+        try:
+            session.add(Conversation(owner_id=owner, peer_id=peer_id, last_message_id=f"m-{peer_id}", last_message_at=at, unread_count=0))
+            session.commit()
+        finally:
+            session.close()
+    assert {target.shard_for(owner, peer_id) for peer_id in peers} == {'a', 'b'}
+
+    manager = MessageManager(shards=target)
+    seen, before = [], None
+    while True:
+        page = manager.get_conversations(owner, limit=3, before=before)
+        seen.extend(entry['user_id'] for entry in page['conversations'])
+        if not page['next_cursor']:
+            break
+        before = MessageManager.decode_conversations_cursor(page['next_cursor'])
+
+    assert seen == sorted(peers, reverse=True)
+
+def test_rebalance_finds_conversations_missing_from_the_index(make_user, tmp_path):
+    alice, bob = make_user('alice'), make_user('bob')
+    MessageManager().store_message(alice, bob, CONTENT, 'k', 's')
+    with engine.begin() as conn:
+        conn.execute(Conversation.__table__.delete())
+
+    target = ShardMap({'a': f"sqlite:///{tmp_path / 'a'}.db"})
+    moves = shards.rebalance(shards.rebalance_sources(shards.current_shard_map(), target), target, prune=True, log=lambda line: None)
+
+    assert moves == {('main', 'a'): 1}
+    assert count_messages(engine) == 0
+    assert len(MessageManager(shards=target).get_messages(alice, bob)) == 1
+
+def test_prune_keeps_messages_written_after_the_copy(make_user, tmp_path):
+    alice, bob = make_user('alice'), make_user('bob')
+    unsharded = MessageManager()
+    unsharded.store_message(alice, bob, CONTENT, 'k', 's')
+    target = ShardMap({'a': f"sqlite:///{tmp_path / 'a'}.db"})
+    target.init_shards()
+
+    read_ids = []
+    with engine.begin() as source, target.engines['a'].begin() as destination:
+        shards.copy_conversation(source, destination, alice, bob, read_ids=read_ids)
+    # Written to the old owner by a server that has not switched yet
+    late = unsharded.store_message(bob, alice, CONTENT, 'k', 's')
+    with engine.begin() as source:
+        assert shards.delete_conversation(source, alice, bob, read_ids) == 1
+
+    assert [message['id'] for message in unsharded.get_messages(alice, bob)] == [late['id']]
+    assert unsharded.get_conversation_state(alice, bob)['last_message_id'] == late['id']
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+
+from socket_limits import SocketLimits
+
+def test_admission_reserves_the_slot():
+    limits = SocketLimits(max_connections=3, max_per_user=2)
+
+    assert limits.admit('s1', 'alice') is None
+    assert limits.admit('s2', 'alice') is None
+    assert limits.admit('s3', 'alice') == {'reason': 'too_many_connections'}
+    assert limits.admit('s4', 'bob') is None
+    assert limits.admit('s5', 'carol') == {'reason': 'server_full'}
+    assert limits.user_for('s1') == 'alice' and limits.user_for('s3') is None
+
+    # A connection refused after admission gives its slot back
+    limits.unregister('s4')
+    assert limits.admit('s5', 'carol') is None
+    assert limits.stats()['rejected'] == {'too_many_connections': 1, 'server_full': 1}
+
+def test_a_reconnect_storm_cannot_overshoot_the_limits():
+    limits = SocketLimits(max_connections=10, max_per_user=3)
+    admitted = []
+
+    async def connect(i):
+        if limits.admit(f"s{i}", f"user-{i % 4}") is None:
+            # Session creation awaits the database while other connects run
+            await asyncio.sleep(0)
+            admitted.append(i)
+
+    async def storm():
+        await asyncio.gather(*(connect(i) for i in range(100)))
+
+    asyncio.run(storm())
+    assert len(admitted) == 10
+    assert limits.stats()['connections'] == 10
+    assert max(len(sids) for sids in limits._user_sids.values()) <= 3
+
+def test_threads_admitting_at_once_stay_within_the_limit():
+    limits = SocketLimits(max_connections=5)
+    start = threading.Barrier(20)
+    results = []
+
+    def connect(i):
+        start.wait()
+        results.append(limits.admit(f"s{i}", f"user-{i}"))
+
+    threads = [threading.Thread(target=connect, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(None) == 5
@@ -1,13 +1,18 @@
 from crypto import CryptoManager
+import asyncio
 import jwt
 import os
+import sys
 import uuid
 import hashlib
 import secrets
-from datetime import datetime, timedelta
-from models import User, get_db
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+from models import User, get_db, get_async_db, display_name_key, lower_display_name
+from session_store import MemorySessionStore
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import update
+from sqlalchemy import select, update, tuple_
 
 class UserManager:
     """
@@ -15,9 +20,16 @@ class UserManager:
     Removed all threading locks to avoid concurrency issues in multi-threaded environments.
     """
     
-    def __init__(self, secret_key=None):
-        """Initialize the user manager"""
-        self.sessions = {}  # session_id -> user_id
+    DIRECTORY_PAGE_SIZE = 20
+    MAX_DIRECTORY_PAGE_SIZE = 100
+    
+    # Sessions live exactly as long as their JWT
+    SESSION_LIFETIME = timedelta(days=1)
+    
+    def __init__(self, secret_key=None, session_store=None, activity=None):
+        """Initialize the user manager, optionally recording activity rollups (see activity.py)"""
+        self.sessions = session_store if session_store is not None else MemorySessionStore()  # session_id -> user_id
+        self.activity = activity
         
         # For JWT token generation/validation
         self.secret_key = secret_key or os.urandom(24).hex()
@@ -27,13 +39,13 @@ class UserManager:
         """Hash an access code using SHA-256"""
         return hashlib.sha256(access_code.encode()).hexdigest()
     
-    def register_anonymous_user(self, display_name=None):
+    def _build_anonymous_user(self, display_name, start_session, suite):
         """
-        Register a new anonymous user with a newly generated key pair
-        Returns the user object and access code
+        Generate the key pair and access code for a new user
+        Returns the User row to insert and the result to hand back to the client
         """
-        # Generate RSA key pair
-        keypair = CryptoManager.generate_rsa_keypair()
+        # Generate the key pair for the user's crypto suite
+        keypair = CryptoManager.generate_keypair(suite)
         
         # Generate a unique access code (combination of a random part and the private key hash)
         random_part = secrets.token_hex(8)
@@ -46,25 +58,65 @@ class UserManager:
         # Create user object
         user_id = str(uuid.uuid4())
         
+        new_user = User(
+            id=user_id,
+            public_key=keypair['public_key'],
+            crypto_suite=suite,
+            access_code_hash=access_code_hash,
+            display_name=display_name,
+            is_online=start_session,
+            last_active=datetime.utcnow()
+        )
+        
+        result = {
+            'id': user_id,
+            'public_key': keypair['public_key'],
+            'suite': suite,
+            'display_name': display_name,
+            'private_key': keypair['private_key'],
+            'access_code': access_code
+        }
+        
+        return new_user, result
+    
+    @staticmethod
+    def _registered_session_user(result):
+        """The session's view of a user registered with start_session"""
+        return {
+            'id': result['id'],
+            'public_key': result['public_key'],
+            'suite': result['suite'],
+            'display_name': result['display_name'],
+            'is_online': True
+        }
+    
+    def _start_registered_session(self, result):
+        """Issue the session for a user registered with start_session"""
+        result['session'] = self._issue_session(self._registered_session_user(result))
+        return result
+    
+    def register_anonymous_user(self, display_name=None, start_session=False, suite=CryptoManager.LEGACY_SUITE):
+        """
+        Register a new anonymous user with a newly generated key pair
+        Returns the user object and access code
+        With start_session, the user is inserted as online and a session is
+        issued without any further database round-trips
+        Raises ValueError for an unsupported crypto suite
+        """
+        new_user, result = self._build_anonymous_user(display_name, start_session, suite)
+        
         db = get_db()
         try:
-            new_user = User(
-                id=user_id,
-                public_key=keypair['public_key'],
-                access_code_hash=access_code_hash,
-                display_name=display_name
-            )
-            
             db.add(new_user)
             db.commit()
             
-            return {
-                'id': user_id,
-                'public_key': keypair['public_key'],
-                'display_name': display_name,
-                'private_key': keypair['private_key'],
-                'access_code': access_code
-            }
+            if self.activity:
+                self.activity.record_registration(result['id'])
+            
+            if start_session:
+                return self._start_registered_session(result)
+            
+            return result
             
         except SQLAlchemyError as e:
             db.rollback()
@@ -72,33 +124,50 @@ class UserManager:
         finally:
             db.close()
     
-    def login_with_access_code(self, access_code):
+    @staticmethod
+    def _mark_online_statement(criterion):
+        """Build the UPDATE marking matching users online"""
+        return update(User).where(criterion).values(
+            is_online=True,
+            last_active=datetime.utcnow()
+        )
+    
+    # Columns describing a user to its own session
+    _SESSION_USER_COLUMNS = (User.id, User.public_key, User.crypto_suite, User.display_name, User.is_online)
+    
+    @staticmethod
+    def _session_user(row):
+        """Convert a row of _SESSION_USER_COLUMNS to a user dict"""
+        if not row:
+            return None
+        
+        return {
+            'id': row.id,
+            'public_key': row.public_key,
+            'suite': row.crypto_suite,
+            'display_name': row.display_name,
+            'is_online': row.is_online
+        }
+    
+    def _mark_online(self, criterion):
         """
-        Log in a user using their access code
-        Returns the user object and tokens if successful, None otherwise
+        Mark the user matching criterion as online and return its info
+        Uses a single UPDATE ... RETURNING where the dialect supports it
         """
         db = get_db()
         try:
-            # Hash the access code
-            access_code_hash = self._hash_access_code(access_code)
-            
-            # Find the user by access code hash
-            user = db.query(User).filter(User.access_code_hash == access_code_hash).first()
+            stmt = self._mark_online_statement(criterion)
             
-            if not user:
-                return None
+            if db.get_bind().dialect.update_returning:
+                row = db.execute(stmt.returning(*self._SESSION_USER_COLUMNS)).first()
+            else:
+                row = db.query(*self._SESSION_USER_COLUMNS).filter(criterion).first()
+                if row:
+                    db.execute(stmt)
             
-            # Update last active time and online status
-            user.last_active = datetime.utcnow()
-            user.is_online = True
             db.commit()
             
-            # Return the user info
-            return {
-                'id': user.id,
-                'public_key': user.public_key,
-                'display_name': user.display_name,
-            }
+            return self._session_user(row)
             
         except SQLAlchemyError as e:
             db.rollback()
@@ -106,6 +175,25 @@ class UserManager:
         finally:
             db.close()
     
+    def login_with_access_code(self, access_code):
+        """
+        Log in a user using their access code
+        Returns the user object if successful, None otherwise
+        """
+        access_code_hash = self._hash_access_code(access_code)
+        return self._mark_online(User.access_code_hash == access_code_hash)
+    
+    def login_and_create_session(self, access_code):
+        """
+        Log in a user and issue a session in one database round-trip
+        Returns the session (including the user) if successful, None otherwise
+        """
+        user = self.login_with_access_code(access_code)
+        if not user:
+            return None
+        
+        return self._issue_session(user)
+    
     def get_user(self, user_id):
         """Get a user by ID"""
         db = get_db()
@@ -117,35 +205,63 @@ class UserManager:
             return {
                 'id': user.id,
                 'public_key': user.public_key,
+                'suite': user.crypto_suite,
                 'display_name': user.display_name,
                 'is_online': user.is_online
             }
         finally:
             db.close()
     
-    def get_public_key(self, user_id):
-        """Get a user's public key"""
+    def get_created_at(self, user_id):
+        """Get a user's creation time without loading the row, or None if it does not exist"""
         db = get_db()
         try:
-            user = db.query(User).filter(User.id == user_id).first()
-            return user.public_key if user else None
+            row = db.query(User.created_at).filter(User.id == user_id).first()
+            return row.created_at if row else None
         finally:
             db.close()
     
-    def create_session(self, user_id):
-        """
-        Create a new session for a user
-        Returns a session token
-        """
-        # Get user to verify it exists
-        user = self.get_user(user_id)
-        if not user:
+    def get_profile(self, user_id):
+        """Get the public profile fields of a user"""
+        db = get_db()
+        try:
+            row = db.query(User.id, User.display_name).filter(User.id == user_id).first()
+            if not row:
+                return None
+            
+            return {
+                'id': row.id,
+                'display_name': row.display_name
+            }
+        finally:
+            db.close()
+    
+    @staticmethod
+    def _public_key(row):
+        """Convert a (public_key, crypto_suite) row to a public key record"""
+        if not row:
             return None
         
-        # Create JWT token
+        return {
+            'public_key': row.public_key,
+            'suite': row.crypto_suite
+        }
+    
+    def get_public_key(self, user_id):
+        """Get a user's public key and the crypto suite it belongs to"""
+        db = get_db()
+        try:
+            row = db.query(User.public_key, User.crypto_suite).filter(User.id == user_id).first()
+            return self._public_key(row)
+        finally:
+            db.close()
+    
+    def _new_session(self, user):
+        """Create a JWT and session ID for an already verified user, returning the session and its expiry"""
+        expires_at = datetime.now(timezone.utc) + self.SESSION_LIFETIME
         payload = {
-            'user_id': user_id,
-            'exp': datetime.utcnow() + timedelta(days=1)
+            'user_id': user['id'],
+            'exp': expires_at
         }
         
         token = jwt.encode(payload, self.secret_key, algorithm='HS256')
@@ -153,28 +269,36 @@ class UserManager:
         # Create session ID
         session_id = str(uuid.uuid4())
         
-        # Store session without using locks
-        self.sessions[session_id] = user_id
-            
-        # Update user's online status
-        db = get_db()
-        try:
-            db_user = db.query(User).filter(User.id == user_id).first()
-            if db_user:
-                db_user.is_online = True
-                db_user.last_active = datetime.utcnow()
-                db.commit()
-        except SQLAlchemyError as e:
-            db.rollback()
-            raise e
-        finally:
-            db.close()
+        if self.activity:
+            self.activity.record_active(user['id'])
         
         return {
             'token': token,
             'session_id': session_id,
             'user': user
-        }
+        }, expires_at.timestamp()
+    
+    def _issue_session(self, user, pinned=False):
+        """Create and store a session for an already verified user"""
+        session, expires_at = self._new_session(user)
+        
+        # Store session until the token expires
+        self.sessions.set(session['session_id'], user['id'], expires_at, pinned=pinned)
+        
+        return session
+    
+    def create_session(self, user_id, pinned=False):
+        """
+        Create a new session for a user
+        Sockets pin their sessions, so they are never evicted while connected
+        Returns a session token, or None if the user does not exist
+        """
+        # Verify the user exists and mark it online in one statement
+        user = self._mark_online(User.id == user_id)
+        if not user:
+            return None
+        
+        return self._issue_session(user, pinned)
     
     def validate_token(self, token):
         """Validate a session token"""
@@ -186,14 +310,13 @@ class UserManager:
         except jwt.InvalidTokenError:
             return None
     
-    def end_session(self, session_id):
-        """End a user session"""
-        # Get user ID before removing from sessions
-        user_id = self.sessions.get(session_id)
-        
-        # Remove session
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+    def end_session(self, session_id, user_id=None):
+        """
+        End a user session and mark its user offline
+        user_id, if known, is marked offline even when the session has already expired
+        """
+        # Remove session, keeping its user ID
+        user_id = self.sessions.pop(session_id) or user_id
         
         if user_id:
             # Update user's online status
@@ -204,6 +327,8 @@ class UserManager:
                     db_user.is_online = False
                     db_user.last_active = datetime.utcnow()
                     db.commit()
+                    if self.activity:
+                        self.activity.record_active(user_id)
                     return True
             except SQLAlchemyError as e:
                 db.rollback()
@@ -212,6 +337,104 @@ class UserManager:
         
         return False
     
+    @staticmethod
+    def _encode_directory_cursor(name_key, user_id):
+        """Encode the position after a directory entry as an opaque cursor"""
+        return base64.urlsafe_b64encode(json.dumps([name_key, user_id]).encode()).decode()
+    
+    @staticmethod
+    def decode_directory_cursor(cursor):
+        """Decode a directory cursor; raises ValueError if it is malformed"""
+        try:
+            name_key, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            raise ValueError("Invalid cursor")
+        return name_key, user_id
+    
+    @classmethod
+    def _directory_limit(cls, limit):
+        """Clamp a requested directory page size to 1..MAX_DIRECTORY_PAGE_SIZE"""
+        return max(1, min(cls.DIRECTORY_PAGE_SIZE if limit is None else limit, cls.MAX_DIRECTORY_PAGE_SIZE))
+    
+    @staticmethod
+    def check_directory_prefix(prefix):
+        """Reject search prefixes no display name can start with; raises ValueError"""
+        if len(prefix) > User.display_name.type.length or any(c == '\x00' or '\ud800' <= c <= '\udfff' for c in prefix):
+            raise ValueError("Invalid search prefix")
+    
+    @staticmethod
+    def _prefix_upper_bound(prefix):
+        """Smallest string sorting after every string starting with prefix, or None if there is none"""
+        prefix = prefix.rstrip(chr(sys.maxunicode))
+        if not prefix:
+            return None
+        following = ord(prefix[-1]) + 1
+        if 0xD800 <= following <= 0xDFFF:
+            following = 0xE000  # Surrogates cannot be encoded
+        return prefix[:-1] + chr(following)
+    
+    def _directory_statement(self, dialect_name, prefix, limit, cursor, include_keys):
+        """
+        Build the directory page query
+        Prefix matching is a range scan over the display name sort key index
+        """
+        key = display_name_key(dialect_name)
+        columns = [User.id, User.display_name, User.is_online, key.label('name_key')]
+        if include_keys:
+            columns.extend([User.public_key, User.crypto_suite])
+        
+        prefix = lower_display_name(dialect_name, prefix or '')
+        stmt = select(*columns).where(key >= prefix)
+        upper_bound = self._prefix_upper_bound(prefix)
+        if upper_bound is not None:
+            stmt = stmt.where(key < upper_bound)
+        if cursor:
+            stmt = stmt.where(tuple_(key, User.id) > tuple_(*cursor))
+        
+        return stmt.order_by(key, User.id).limit(limit)
+    
+    def _directory_page(self, rows, limit, include_keys):
+        """Convert directory rows to slim records with the next page's cursor"""
+        users = []
+        for row in rows:
+            user = {
+                'id': row.id,
+                'display_name': row.display_name,
+                'is_online': row.is_online
+            }
+            if include_keys:
+                user['public_key'] = row.public_key
+                user['suite'] = row.crypto_suite
+            users.append(user)
+        
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = self._encode_directory_cursor(rows[-1].name_key, rows[-1].id)
+        
+        return {
+            'users': users,
+            'next_cursor': next_cursor
+        }
+    
+    def search_users(self, prefix, limit=None, cursor=None, include_keys=False):
+        """
+        Search the user directory by display name prefix (case-insensitive)
+        Returns a page of slim user records ordered by name, and the cursor of the next page
+        Raises ValueError for an invalid prefix or cursor
+        """
+        self.check_directory_prefix(prefix or '')
+        limit = self._directory_limit(limit)
+        if cursor:
+            cursor = self.decode_directory_cursor(cursor)
+        
+        db = get_db()
+        try:
+            dialect_name = db.get_bind().dialect.name
+            rows = db.execute(self._directory_statement(dialect_name, prefix, limit, cursor, include_keys)).all()
+            return self._directory_page(rows, limit, include_keys)
+        finally:
+            db.close()
+    
     def get_online_users(self):
         """Get a list of online users"""
         db = get_db()
@@ -220,7 +443,8 @@ class UserManager:
             return [{
                 'id': user.id,
                 'display_name': user.display_name,
-                'public_key': user.public_key
+                'public_key': user.public_key,
+                'suite': user.crypto_suite
             } for user in online_users]
         finally:
             db.close()
@@ -237,6 +461,7 @@ class UserManager:
                 'id': user.id,
                 'display_name': user.display_name,
                 'public_key': user.public_key,
+                'suite': user.crypto_suite,
                 'is_online': user.is_online
             }
         finally:
@@ -263,4 +488,187 @@ class UserManager:
             db.rollback()
             return False
         finally:
-            db.close()
\ No newline at end of file
+            db.close()
+
+
+class AsyncUserManager(UserManager):
+    """
+    Asyncio variant of UserManager for the ASGI server.
+    Database methods are coroutines using the async engine; sessions and
+    tokens are handled exactly as in UserManager.
+    """
+    
+    async def _session_call(self, method, *args, **kwargs):
+        """Call a session store method, in a worker thread if the store blocks on I/O"""
+        call = getattr(self.sessions, method)
+        if self.sessions.blocking:
+            return await asyncio.to_thread(call, *args, **kwargs)
+        return call(*args, **kwargs)
+    
+    async def _issue_session(self, user, pinned=False):
+        """Create and store a session for an already verified user"""
+        session, expires_at = self._new_session(user)
+        await self._session_call('set', session['session_id'], user['id'], expires_at, pinned=pinned)
+        return session
+    
+    async def _start_registered_session(self, result):
+        """Issue the session for a user registered with start_session"""
+        result['session'] = await self._issue_session(self._registered_session_user(result))
+        return result
+    
+    async def register_anonymous_user(self, display_name=None, start_session=False, suite=CryptoManager.LEGACY_SUITE):
+        """Register a new anonymous user; key generation runs in a worker thread"""
+        new_user, result = await asyncio.to_thread(self._build_anonymous_user, display_name, start_session, suite)
+        
+        async with get_async_db() as db:
+            db.add(new_user)
+            await db.commit()
+        
+        if self.activity:
+            self.activity.record_registration(result['id'])
+        
+        if start_session:
+            return await self._start_registered_session(result)
+        
+        return result
+    
+    async def _mark_online(self, criterion):
+        """Mark the user matching criterion as online and return its info"""
+        async with get_async_db() as db:
+            stmt = self._mark_online_statement(criterion)
+            
+            if db.get_bind().dialect.update_returning:
+                row = (await db.execute(stmt.returning(*self._SESSION_USER_COLUMNS))).first()
+            else:
+                row = (await db.execute(select(*self._SESSION_USER_COLUMNS).where(criterion))).first()
+                if row:
+                    await db.execute(stmt)
+            
+            await db.commit()
+            
+            return self._session_user(row)
+    
+    async def login_with_access_code(self, access_code):
+        """Log in a user using their access code"""
+        access_code_hash = self._hash_access_code(access_code)
+        return await self._mark_online(User.access_code_hash == access_code_hash)
+    
+    async def login_and_create_session(self, access_code):
+        """Log in a user and issue a session in one database round-trip"""
+        user = await self.login_with_access_code(access_code)
+        if not user:
+            return None
+        
+        return await self._issue_session(user)
+    
+    async def create_session(self, user_id, pinned=False):
+        """Create a new session for a user, or None if the user does not exist"""
+        user = await self._mark_online(User.id == user_id)
+        if not user:
+            return None
+        
+        return await self._issue_session(user, pinned)
+    
+    async def end_session(self, session_id, user_id=None):
+        """End a user session and mark its user offline"""
+        user_id = await self._session_call('pop', session_id) or user_id
+        if not user_id:
+            return False
+        
+        async with get_async_db() as db:
+            try:
+                result = await db.execute(
+                    update(User).where(User.id == user_id).values(
+                        is_online=False,
+                        last_active=datetime.utcnow()
+                    )
+                )
+                await db.commit()
+                if self.activity and result.rowcount:
+                    self.activity.record_active(user_id)
+                return result.rowcount > 0
+            except SQLAlchemyError:
+                await db.rollback()
+                return False
+    
+    async def get_user(self, user_id):
+        """Get a user by ID"""
+        async with get_async_db() as db:
+            row = (await db.execute(
+                select(*self._SESSION_USER_COLUMNS).where(User.id == user_id)
+            )).first()
+            return self._session_user(row)
+    
+    async def get_user_for_session(self, session_id):
+        """Get the user associated with a session"""
+        user_id = await self._session_call('get', session_id)
+        if user_id:
+            return await self.get_user(user_id)
+        return None
+    
+    async def get_created_at(self, user_id):
+        """Get a user's creation time, or None if it does not exist"""
+        async with get_async_db() as db:
+            return await db.scalar(select(User.created_at).where(User.id == user_id))
+    
+    async def get_profile(self, user_id):
+        """Get the public profile fields of a user"""
+        async with get_async_db() as db:
+            row = (await db.execute(
+                select(User.id, User.display_name).where(User.id == user_id)
+            )).first()
+            if not row:
+                return None
+            
+            return {
+                'id': row.id,
+                'display_name': row.display_name
+            }
+    
+    async def get_public_key(self, user_id):
+        """Get a user's public key and the crypto suite it belongs to"""
+        async with get_async_db() as db:
+            row = (await db.execute(
+                select(User.public_key, User.crypto_suite).where(User.id == user_id)
+            )).first()
+            return self._public_key(row)
+    
+    async def search_users(self, prefix, limit=None, cursor=None, include_keys=False):
+        """Search the user directory by display name prefix (case-insensitive)"""
+        self.check_directory_prefix(prefix or '')
+        limit = self._directory_limit(limit)
+        if cursor:
+            cursor = self.decode_directory_cursor(cursor)
+        
+        async with get_async_db() as db:
+            dialect_name = db.get_bind().dialect.name
+            rows = (await db.execute(
+                self._directory_statement(dialect_name, prefix, limit, cursor, include_keys)
+            )).all()
+            return self._directory_page(rows, limit, include_keys)
+    
+    async def get_online_users(self):
+        """Get a list of online users"""
+        async with get_async_db() as db:
+            rows = await db.execute(
+                select(User.id, User.display_name, User.public_key, User.crypto_suite).where(User.is_online == True)
+            )
+            return [{
+                'id': row.id,
+                'display_name': row.display_name,
+                'public_key': row.public_key,
+                'suite': row.crypto_suite
+            } for row in rows]
+    
+    async def update_display_name(self, user_id, display_name):
+        """Update a user's display name"""
+        async with get_async_db() as db:
+            try:
+                result = await db.execute(
+                    update(User).where(User.id == user_id).values(display_name=display_name)
+                )
+                await db.commit()
+                return result.rowcount > 0
+            except SQLAlchemyError:
+                await db.rollback()
+                return False
\ No newline at end of file